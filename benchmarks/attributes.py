@@ -0,0 +1,92 @@
+"""
+Micro-benchmark for attribute reads on Objects: the original
+__getattribute__, which evaluates every attribute's get_lock, versus the
+current one, which skips attributes whose get_lock is a plain Pass().
+
+Run from the top of the repository:
+
+    python -m benchmarks.attributes [--objects N] [--rounds N]
+"""
+
+import argparse
+import timeit
+
+from muss import db, locks
+
+
+ATTRIBUTES = ["name", "description", "location", "owner", "type", "uid"]
+
+
+def old_getattribute(self, attr):
+    """
+    Object.__getattribute__ as it was before the fast path.
+    """
+    if attr == "__dict__" and locks.authority() is locks.SYSTEM:
+        return super(db.Object, self).__getattribute__(attr)
+
+    attr_locks = super(db.Object, self).__getattribute__("attr_locks")
+    if attr in attr_locks:
+        if attr_locks[attr].get_lock():
+            return super(db.Object, self).__getattribute__(attr)
+        else:
+            raise locks.LockFailedError("You don't have permission to get "
+                                        "{} from {}.".format(attr, self))
+    else:
+        return super(db.Object, self).__getattribute__(attr)
+
+
+def make_room(count):
+    """
+    Create a room holding a player and count objects, and return them.
+    """
+    with locks.authority_of(locks.SYSTEM):
+        room = db.Room("benchmark room")
+        db.store(room)
+        player = db.Player("Benchmarker", "password")
+        player.location = room
+        db.store(player)
+    with locks.authority_of(player):
+        for i in range(count):
+            obj = db.Object("object {}".format(i), room)
+            db.store(obj)
+    return room, player
+
+
+def read_all(objects):
+    for obj in objects:
+        for attr in ATTRIBUTES:
+            getattr(obj, attr)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("--objects", type=int, default=300,
+                            help="number of objects in the room")
+    arg_parser.add_argument("--rounds", type=int, default=20,
+                            help="number of times to read every attribute")
+    options = arg_parser.parse_args()
+
+    room, player = make_room(options.objects)
+    objects = list(db.contents_of(room))
+    reads = len(objects) * len(ATTRIBUTES) * options.rounds
+
+    new_getattribute = db.Object.__getattribute__
+    results = []
+    for implementation in [old_getattribute, new_getattribute]:
+        db.Object.__getattribute__ = implementation
+        try:
+            with locks.authority_of(player):
+                elapsed = min(timeit.repeat(lambda: read_all(objects),
+                                            number=options.rounds, repeat=3))
+        finally:
+            db.Object.__getattribute__ = new_getattribute
+        results.append(reads / elapsed)
+
+    print("{} objects, {} attribute reads".format(len(objects), reads))
+    print("old __getattribute__: {:12,.0f} reads/s".format(results[0]))
+    print("new __getattribute__: {:12,.0f} reads/s".format(results[1]))
+    print("speedup:              {:12.1f}x".format(results[1] / results[0]))
+
+
+if __name__ == "__main__":
+    main()
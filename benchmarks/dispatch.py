@@ -0,0 +1,152 @@
+"""
+Micro-benchmark for command name resolution: the original linear scan over
+every command class versus the CommandRegistry's name tries.
+
+Run from the top of the repository:
+
+    python -m benchmarks.dispatch [--commands N] [--lines N]
+"""
+
+import argparse
+import random
+import timeit
+
+from muss import handler, parser, utils
+
+
+SYLLABLES = ["ba", "ko", "ri", "ste", "lun", "mar", "qui", "zo", "pe", "dra",
+             "vel", "tho", "ne", "gru", "sa", "wi"]
+
+
+def make_commands(count, rng):
+    """
+    Generate count distinct command classes with one to three random names
+    each, and a nospace name on roughly one in ten of them.
+    """
+    taken = set()
+    command_list = []
+    for i in range(count):
+        names = []
+        for _ in range(rng.randint(1, 3)):
+            while True:
+                name = "".join(rng.choice(SYLLABLES)
+                               for _ in range(rng.randint(2, 4)))
+                if name not in taken:
+                    taken.add(name)
+                    names.append(name)
+                    break
+        attrs = {"name": names, "help_text": "Synthetic command."}
+        if i % 10 == 0:
+            attrs["nospace_name"] = "{}{}".format("!@$%^&*~"[i % 8], i)
+        if i % 25 == 0:
+            attrs["require_full"] = True
+        command_list.append(type("Synthetic{}".format(i), (parser.Command,),
+                                 attrs))
+    return command_list
+
+
+def make_lines(command_list, count, rng):
+    """
+    Generate input lines: a mix of full command names, abbreviations, nospace
+    invocations, and misses.
+    """
+    lines = []
+    for _ in range(count):
+        command = rng.choice(command_list)()
+        roll = rng.random()
+        if roll < 0.4:
+            word = rng.choice(command.names)
+        elif roll < 0.7:
+            name = rng.choice(command.names)
+            word = name[:rng.randint(2, len(name))]
+        elif roll < 0.8 and command.nospace_names:
+            lines.append(command.nospace_names[0] + "some text")
+            continue
+        else:
+            word = "xyzzy"
+        lines.append(word + " some arguments")
+    return lines
+
+
+def old_dispatch(line, command_list):
+    """
+    Resolve a line the way NormalMode and CommandName used to, scanning and
+    instantiating every command class.
+    """
+    nospace_matches = []
+    for command in command_list:
+        for name in command().nospace_names:
+            if line.startswith(name):
+                nospace_matches.append((name, command))
+
+    first = line.split(None, 1)[0].lower()
+    perfect_matches, partial_matches = utils.find_by_name(
+        first, command_list, attributes=["names"])
+    matches = ([command for _, command in perfect_matches] +
+               [command for _, command in partial_matches
+                if not command.require_full])
+    try:
+        return nospace_matches, utils.find_one(first, matches,
+                                               attributes=["names"])
+    except parser.MatchError:
+        return nospace_matches, None
+
+
+def new_dispatch(line, registry):
+    """
+    Resolve a line the way NormalMode and CommandName do now.
+    """
+    nospace_matches = registry.find_nospace_prefixes(line)
+
+    first = line.split(None, 1)[0].lower()
+    perfect_matches, partial_matches = registry.find_by_name(first,
+                                                             full_only=True)
+    partial_matches = [(name, command) for name, command in partial_matches
+                       if not command.require_full]
+    try:
+        return nospace_matches, utils.best_match(first, perfect_matches,
+                                                 partial_matches)
+    except parser.MatchError:
+        return nospace_matches, None
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("--commands", type=int, default=300,
+                            help="number of synthetic commands to register")
+    arg_parser.add_argument("--lines", type=int, default=2000,
+                            help="number of input lines to resolve")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    options = arg_parser.parse_args()
+
+    rng = random.Random(options.seed)
+    command_list = make_commands(options.commands, rng)
+    lines = make_lines(command_list, options.lines, rng)
+    registry = handler.CommandRegistry(command_list)
+
+    # Sanity check: both implementations must agree.
+    for line in lines:
+        old_nospace, old_match = old_dispatch(line, command_list)
+        new_nospace, new_match = new_dispatch(line, registry)
+        assert set(old_nospace) == set(new_nospace), line
+        assert old_match == new_match, line
+
+    timer = timeit.default_timer
+    start = timer()
+    for line in lines:
+        old_dispatch(line, command_list)
+    old_time = timer() - start
+
+    start = timer()
+    for line in lines:
+        new_dispatch(line, registry)
+    new_time = timer() - start
+
+    print("{} commands, {} lines".format(len(command_list), len(lines)))
+    print("old dispatch: {:10.1f} us/line".format(old_time / len(lines) * 1e6))
+    print("new dispatch: {:10.1f} us/line".format(new_time / len(lines) * 1e6))
+    print("speedup:      {:10.1f}x".format(old_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Load benchmark: build a synthetic world, connect every player to a protocol
+that throws its output away, and drive scripted sessions through each
+player's NormalMode in-process, the way WorldProtocol does. Reports overall
+commands per second, and the rate and p50/p99 latency of each command class.
+
+Run from the top of the repository:
+
+    python -m benchmarks.load [--rooms N] [--players N] [--items N]
+                              [--depth N] [--commands N] [--seed N]
+"""
+
+import argparse
+import random
+import timeit
+
+from muss import handler, locks, server
+from benchmarks import world as world_module
+
+
+# How often each command class comes up in a session, roughly.
+MIX = [("Look", 30), ("Go", 20), ("Say", 25), ("Take", 10), ("Set", 10),
+       ("Who", 5)]
+
+
+class NullTransport(object):
+    """
+    Just enough of a transport for a LineTelnetProtocol, counting what's
+    written to it instead of sending it anywhere.
+    """
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, data):
+        self.written += sum(len(piece) for piece in data)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+def connect(factory, player):
+    """
+    Connect player to factory through a NullTransport, as if they'd just
+    logged in. Returns the transport.
+    """
+    transport = NullTransport()
+    protocol = server.LineTelnetProtocol()
+    protocol.makeConnection(transport)
+    factory.allProtocols[player.name] = protocol
+    player.enter_mode(handler.NormalMode())
+    return transport
+
+
+def next_command(player, world, rng):
+    """
+    Choose what player does next. Returns the command class's name, the line
+    to time, and a line to undo it with afterwards, untimed (or None).
+    """
+    total = sum(weight for _, weight in MIX)
+    roll = rng.uniform(0, total)
+    for command, weight in MIX:
+        roll -= weight
+        if roll <= 0:
+            break
+
+    with locks.authority_of(locks.SYSTEM):
+        room = player.location
+    if command == "Look":
+        targets = world.items[room] + world.exits[room]
+        if targets and rng.random() < 0.5:
+            return command, "look {}".format(rng.choice(targets).name), None
+        return command, "look", None
+    if command == "Go":
+        exit = rng.choice(world.exits[room])
+        if rng.random() < 0.5:
+            return command, exit.name, None
+        return command, "go {}".format(exit.name), None
+    if command == "Say":
+        text = "the {} is {}".format(rng.choice(world_module.NOUNS),
+                                     rng.choice(world_module.ADJECTIVES))
+        if rng.random() < 0.5:
+            return command, "'" + text, None
+        return command, "say " + text, None
+    if command == "Take":
+        name = rng.choice(world.items[room]).name
+        return command, "take {}".format(name), "drop {}".format(name)
+    if command == "Set":
+        return command, "set me.mood = \"{}\"".format(
+            rng.choice(world_module.ADJECTIVES)), None
+    return command, "who", None
+
+
+def handle(player, line):
+    """
+    Handle one line of input from player, just as WorldProtocol would.
+    """
+    with server.coalesced_output():
+        with locks.authority_of(player):
+            player.mode.handle(player, line)
+        if player.mode.blank_line:
+            player.send("")
+
+
+def percentile(ordered, fraction):
+    """
+    The nearest-rank percentile of an already sorted list.
+    """
+    index = max(0, int(round(fraction * len(ordered))) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("--rooms", type=int, default=200,
+                            help="number of rooms to dig")
+    arg_parser.add_argument("--players", type=int, default=100,
+                            help="number of players to connect")
+    arg_parser.add_argument("--items", type=int, default=5,
+                            help="loose items and equipment in each room")
+    arg_parser.add_argument("--depth", type=int, default=2,
+                            help="how deeply containers nest in each room")
+    arg_parser.add_argument("--commands", type=int, default=5000,
+                            help="number of commands to time")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    options = arg_parser.parse_args()
+
+    world = world_module.make_world(options.rooms, options.players,
+                                    options.items, options.depth, options.seed)
+    factory = server.WorldFactory()
+    transports = [connect(factory, player) for player in world.players]
+    handler.registry.load()
+
+    rng = random.Random(options.seed)
+    latencies = dict((command, []) for command, _ in MIX)
+    timer = timeit.default_timer
+    elapsed = 0.0
+    for _ in range(options.commands):
+        player = rng.choice(world.players)
+        command, line, undo = next_command(player, world, rng)
+        start = timer()
+        handle(player, line)
+        latency = timer() - start
+        elapsed += latency
+        latencies[command].append(latency)
+        if undo is not None:
+            handle(player, undo)
+
+    print("{} rooms, {} players, {} commands".format(
+        len(world.rooms), len(world.players), options.commands))
+    print("overall: {:10.0f} commands/s, {:,} bytes sent".format(
+        options.commands / elapsed,
+        sum(transport.written for transport in transports)))
+    print("{:8} {:>8} {:>12} {:>10} {:>10}".format(
+        "command", "count", "commands/s", "p50 us", "p99 us"))
+    for command, _ in MIX:
+        times = sorted(latencies[command])
+        if not times:
+            continue
+        print("{:8} {:8} {:12.0f} {:10.1f} {:10.1f}".format(
+            command, len(times), len(times) / sum(times),
+            percentile(times, 0.5) * 1e6, percentile(times, 0.99) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
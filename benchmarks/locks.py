@@ -0,0 +1,110 @@
+"""
+Micro-benchmark for evaluating deeply nested locks: interpreting the lock
+tree node by node, switching authority at each one, versus calling the lock,
+which runs its compiled predicate.
+
+Run from the top of the repository:
+
+    python -m benchmarks.locks [--depth N] [--width N] [--locks N] [--checks N]
+"""
+
+import argparse
+import random
+import timeit
+
+from muss import db, locks
+
+
+def make_lock(depth, width, leaves, rng):
+    """
+    Build a random tree of And, Or, and Not locks, depth levels deep, with
+    width children per And or Or, and leaves drawn from the given list.
+    """
+    if depth == 0:
+        return rng.choice(leaves)
+    kind = rng.choice([locks.And, locks.Or, locks.Not])
+    if kind is locks.Not:
+        return locks.Not(make_lock(depth - 1, width, leaves, rng))
+    return kind(*[make_lock(depth - 1, width, leaves, rng)
+                  for _ in range(width)])
+
+
+def interpret(lock, player):
+    """
+    Evaluate a lock the way Lock.__call__ used to, entering SYSTEM authority
+    separately for every node of the tree.
+    """
+    if isinstance(lock, locks.Pass):
+        return True
+    with locks.authority_of(locks.SYSTEM):
+        if isinstance(lock, locks.And):
+            return all(interpret(child, player) for child in lock.locks)
+        if isinstance(lock, locks.Or):
+            return any(interpret(child, player) for child in lock.locks)
+        if isinstance(lock, locks.Not):
+            return not interpret(lock.lock, player)
+        return lock.check(player)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("--depth", type=int, default=6,
+                            help="levels of And/Or/Not above the leaves")
+    arg_parser.add_argument("--width", type=int, default=3,
+                            help="children of each And or Or")
+    arg_parser.add_argument("--locks", type=int, default=20,
+                            help="number of random lock trees")
+    arg_parser.add_argument("--checks", type=int, default=50,
+                            help="times to check each tree per player")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    options = arg_parser.parse_args()
+
+    rng = random.Random(options.seed)
+    with locks.authority_of(locks.SYSTEM):
+        players = [db.Player("Player{}".format(i), "password")
+                   for i in range(4)]
+        things = [db.Object("thing {}".format(i), owner=rng.choice(players))
+                  for i in range(8)]
+        for thing in things:
+            thing.location = rng.choice(players)
+    leaves = ([locks.Is(player) for player in players] +
+              [locks.Owns(thing) for thing in things] +
+              [locks.Has(thing) for thing in things] +
+              [locks.Pass(), locks.Fail()])
+    lock_trees = [make_lock(options.depth, options.width, leaves, rng)
+                  for _ in range(options.locks)]
+
+    # Sanity check: both ways must agree.
+    for lock in lock_trees:
+        for player in players:
+            assert interpret(lock, player) == lock(player)
+
+    # Start a new cache generation before every check, so the comparison is
+    # between evaluating the trees, not looking up remembered results.
+    def run_interpreted():
+        for lock in lock_trees:
+            for player in players:
+                locks.invalidate()
+                interpret(lock, player)
+
+    def run_compiled():
+        for lock in lock_trees:
+            for player in players:
+                locks.invalidate()
+                lock(player)
+
+    checks = len(lock_trees) * len(players) * options.checks
+    old_time = min(timeit.repeat(run_interpreted, number=options.checks,
+                                 repeat=3))
+    new_time = min(timeit.repeat(run_compiled, number=options.checks,
+                                 repeat=3))
+
+    print("{} lock trees, depth {}, width {}; {} checks".format(
+        len(lock_trees), options.depth, options.width, checks))
+    print("interpreted: {:10.1f} us/check".format(old_time / checks * 1e6))
+    print("compiled:    {:10.1f} us/check".format(new_time / checks * 1e6))
+    print("speedup:     {:10.1f}x".format(old_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Memory benchmark: how many bytes each Object takes up, counting the object
+itself and everything it holds that no other object shares -- its __dict__,
+its attr_locks and the AttributeLocks in it, its Locks namespace, and the
+locks themselves.
+
+For comparison, it also counts what the same objects would take if each lock
+and AttributeLock kept its attributes in a __dict__ instead of __slots__, and
+prints the figure recorded before locks were shrunk.
+
+Run from the top of the repository:
+
+    python -m benchmarks.memory [--objects N] [--attributes N]
+"""
+
+import argparse
+import gc
+import sys
+import types
+
+from muss import db, locks
+
+
+# Referents of these types are never counted; they're shared by everything.
+SHARED_TYPES = (type, types.ModuleType, types.FunctionType,
+                types.BuiltinFunctionType)
+
+# Bytes per object before locks declared __slots__, were shared where
+# possible, and stopped getting a set lock per attribute, with the default
+# options.
+RECORDED_BASELINE = 12177
+
+
+class _DictBacked(object):
+    pass
+
+
+def _slot_values(item):
+    values = {}
+    for cls in type(item).__mro__:
+        for attr in cls.__dict__.get("__slots__", ()):
+            if hasattr(item, attr):
+                values[attr] = getattr(item, attr)
+    return values
+
+
+def dict_backed_size(item):
+    """
+    Return the size in bytes that item would take if it kept the values of
+    its slots in a __dict__ instead: the size of a plain instance plus that
+    of its __dict__.
+    """
+    copy = _DictBacked()
+    copy.__dict__.update(_slot_values(item))
+    return sys.getsizeof(copy) + sys.getsizeof(copy.__dict__)
+
+
+def footprint(obj, shared, dict_backed=False):
+    """
+    Return the total size in bytes of obj and everything reachable from it,
+    stopping at anything in shared (a set of ids) or of a shared type, and at
+    any other Object. Everything counted is added to shared, so that it's
+    only counted once. If dict_backed, locks and AttributeLocks are counted
+    as though they had no __slots__.
+    """
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in shared or isinstance(item, SHARED_TYPES):
+            continue
+        if item is not obj and isinstance(item, db.Object):
+            continue
+        shared.add(id(item))
+        if dict_backed and isinstance(item, (locks.Lock, locks.AttributeLock)):
+            total += dict_backed_size(item)
+        else:
+            total += sys.getsizeof(item)
+        stack.extend(gc.get_referents(item))
+    return total
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("--objects", type=int, default=100000,
+                            help="number of objects in the world")
+    arg_parser.add_argument("--attributes", type=int, default=3,
+                            help="extra attributes set on each object")
+    options = arg_parser.parse_args()
+
+    with locks.authority_of(locks.SYSTEM):
+        player = db.Player("Benchmarker", "password")
+    objects = []
+    with locks.authority_of(player):
+        for i in range(options.objects):
+            obj = db.Object("object {}".format(i))
+            for j in range(options.attributes):
+                setattr(obj, "attribute{}".format(j), j)
+            objects.append(obj)
+
+    def measure(dict_backed):
+        # Don't count anything the player holds, or strings interned
+        # everywhere.
+        shared = set()
+        with locks.authority_of(locks.SYSTEM):
+            footprint(player, shared, dict_backed)
+            return sum(footprint(obj, shared, dict_backed) for obj in objects)
+    total = measure(False)
+    baseline = measure(True)
+
+    print("{} objects, {} extra attributes each".format(len(objects),
+                                                        options.attributes))
+    print("total:               {:12,} bytes".format(total))
+    print("per object:          {:12,.0f} bytes"
+          .format(float(total) / len(objects)))
+    print("with dict-backed locks:")
+    print("  per object:        {:12,.0f} bytes"
+          .format(float(baseline) / len(objects)))
+    print("recorded before locks were shrunk (default options):")
+    print("  per object:        {:12,} bytes".format(RECORDED_BASELINE))
+
+
+if __name__ == "__main__":
+    main()
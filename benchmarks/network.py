@@ -0,0 +1,397 @@
+"""
+Network load benchmark: serve a synthetic world from a WorldFactory in a
+separate process on a loopback port, then connect many telnet clients to it.
+Each logs in, then walks exits, looks around, talks, chats on the Public
+channel and poses, waiting a random think time between commands. Reports the
+round trip of each command, from writing it to the transport to receiving
+the blank line that ends its output, by command class.
+
+Run from the top of the repository:
+
+    python -m benchmarks.network [--clients N] [--duration SECONDS]
+                                 [--think SECONDS] [--ramp N] [--rooms N]
+                                 [--seed N] [--json FILE]
+
+The same arguments always build the same world and send the same commands,
+so reports (--json writes one out as well) can be compared between runs to
+track regressions. Every client needs a file descriptor here and another in
+the server, so raise `ulimit -n` for very large runs.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from twisted.conch import telnet
+from twisted.internet import protocol, reactor
+
+from muss import db, locks, server
+from benchmarks import world as world_module
+
+
+# How often each command class comes up in a session, roughly.
+MIX = [("Go", 35), ("Look", 20), ("Say", 20), ("Pose", 15), ("Chat", 10)]
+
+
+class Stats(object):
+    """
+    Everything the clients measured.
+
+    Attributes:
+        start, end: The measurement window. Only commands sent within it are
+            counted, so ramping up and winding down don't skew the results.
+        logins: Login round trips, in seconds.
+        failed_logins: How many clients couldn't log in.
+        disconnects: How many clients were disconnected early.
+        latencies: A dict mapping command classes to lists of round trips.
+        received: Bytes received by all clients.
+        remaining: How many clients haven't finished yet.
+    """
+    def __init__(self, clients):
+        self.start = float("inf")
+        self.end = float("inf")
+        self.logins = []
+        self.failed_logins = 0
+        self.disconnects = 0
+        self.latencies = dict((command, []) for command, _ in MIX)
+        self.received = 0
+        self.remaining = clients
+
+    def finished(self):
+        """
+        Called as each client finishes. Stops the reactor after the last.
+        """
+        self.remaining -= 1
+        if not self.remaining:
+            reactor.stop()
+
+
+class Map(object):
+    """
+    A plain copy of the parts of a World the clients need, so they can keep
+    track of where they are without touching the database.
+
+    Attributes:
+        exits: A dict mapping each room's name to a list of (exit name,
+            destination room name) pairs.
+        items: A dict mapping each room's name to the names of things in it.
+        starts: A dict mapping each player's name to their starting room's.
+    """
+    def __init__(self, world):
+        with locks.authority_of(locks.SYSTEM):
+            self.exits = dict(
+                (room.name, [(exit.name, exit.destination.name)
+                             for exit in world.exits[room]])
+                for room in world.rooms)
+            self.items = dict((room.name, [item.name
+                                           for item in world.items[room]])
+                              for room in world.rooms)
+            self.starts = dict((player.name, player.location.name)
+                               for player in world.players)
+
+
+class LoadClient(telnet.StatefulTelnetProtocol):
+    """
+    One simulated player. Logs in once the greeting is over, then sends a
+    command, waits for its output to end, thinks, and sends another, until
+    the measurement window closes.
+    """
+    state = "Greeting"
+
+    def __init__(self, name, world_map, stats, think, rng):
+        self.name = name
+        self.map = world_map
+        self.stats = stats
+        self.think = think
+        self.rng = rng
+        self.room = world_map.starts[name]
+        self.pending = 0  # Blank lines still to come before a command is done
+        self.command = None
+        self.destination = None
+        self.sent = None
+        self.call = None
+
+    def dataReceived(self, data):
+        self.stats.received += len(data)
+        telnet.StatefulTelnetProtocol.dataReceived(self, data)
+
+    def connectionLost(self, reason):
+        telnet.StatefulTelnetProtocol.connectionLost(self, reason)
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        if self.state != "Done":
+            self.stats.disconnects += 1
+        self.state = "Done"
+        self.stats.finished()
+
+    def telnet_Greeting(self, line):
+        if line.rstrip("\r") == "To disconnect, type 'quit'.":
+            self.sent = timeit.default_timer()
+            self.sendLine("{} password".format(self.name))
+            return "Login"
+
+    def telnet_Login(self, line):
+        line = line.rstrip("\r")
+        if line == "Invalid login.":
+            self.stats.failed_logins += 1
+            self.state = "Done"
+            self.transport.loseConnection()
+        elif line == "Hello, {}!".format(self.name):
+            self.stats.logins.append(timeit.default_timer() - self.sent)
+            # One blank line after the greeting, one after the room's Look.
+            self.pending = 2
+            return "Playing"
+
+    def telnet_Playing(self, line):
+        if line.rstrip("\r") or not self.pending:
+            return
+        self.pending -= 1
+        if self.pending:
+            return
+        if self.command is not None:
+            now = timeit.default_timer()
+            if self.stats.start <= self.sent < self.stats.end:
+                self.stats.latencies[self.command].append(now - self.sent)
+            if self.destination is not None:
+                self.room = self.destination
+        self.call = reactor.callLater(self.rng.expovariate(1.0 / self.think),
+                                      self.next_command)
+
+    def next_command(self):
+        self.call = None
+        if timeit.default_timer() >= self.stats.end:
+            self.state = "Done"
+            self.transport.loseConnection()
+            return
+
+        total = sum(weight for _, weight in MIX)
+        roll = self.rng.uniform(0, total)
+        for command, weight in MIX:
+            roll -= weight
+            if roll <= 0:
+                break
+        self.command = command
+        self.destination = None
+        noun = self.rng.choice(world_module.NOUNS)
+        adjective = self.rng.choice(world_module.ADJECTIVES)
+
+        if command == "Go":
+            exit, self.destination = self.rng.choice(self.map.exits[self.room])
+            line = exit if self.rng.random() < 0.5 else "go " + exit
+        elif command == "Look":
+            targets = self.map.items[self.room]
+            if targets and self.rng.random() < 0.5:
+                line = "look " + self.rng.choice(targets)
+            else:
+                line = "look"
+        elif command == "Say":
+            line = "say the {} is {}".format(noun, adjective)
+        elif command == "Pose":
+            if self.rng.random() < 0.5:
+                line = "pose holding a {} {}".format(adjective, noun)
+            else:
+                line = ":admires the {} {}.".format(adjective, noun)
+        else:
+            line = ".Public has anyone seen a {} {}?".format(adjective, noun)
+
+        self.pending = 1
+        self.sent = timeit.default_timer()
+        self.sendLine(line)
+
+
+class LoadClientFactory(protocol.ClientFactory):
+    def __init__(self, name, world_map, stats, think, rng):
+        self.name = name
+        self.map = world_map
+        self.stats = stats
+        self.think = think
+        self.rng = rng
+
+    def buildProtocol(self, addr):
+        return telnet.TelnetTransport(LoadClient, self.name, self.map,
+                                      self.stats, self.think, self.rng)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.stats.disconnects += 1
+        self.stats.finished()
+
+
+def raise_file_limit():
+    """
+    Allow as many open files as we're permitted, one per connection.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def make_world(options, password_hash=None):
+    db.PASSWORD_ROUNDS = options.password_rounds
+    return world_module.make_world(options.rooms, options.clients,
+                                   options.items, options.depth, options.seed,
+                                   password_hash)
+
+
+def serve(options):
+    """
+    Build the world and serve it on a loopback port until killed, printing
+    the port number. The journal and snapshots go in a temporary directory.
+    """
+    raise_file_limit()
+    make_world(options)
+    directory = tempfile.mkdtemp(prefix="muss-benchmark-")
+    db.DATABASE_FILE = os.path.join(directory, "muss.db")
+    db.JOURNAL_FILE = os.path.join(directory, "muss.journal")
+    try:
+        port = reactor.listenTCP(0, server.WorldFactory(), backlog=1024,
+                                 interface="127.0.0.1")
+        print("port {}".format(port.getHost().port))
+        sys.stdout.flush()
+        reactor.run()
+    finally:
+        shutil.rmtree(directory)
+
+
+def percentile(ordered, fraction):
+    """
+    The nearest-rank percentile of an already sorted list.
+    """
+    index = max(0, int(round(fraction * len(ordered))) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def summarize(times, seconds):
+    times = sorted(times)
+    if not times:
+        return {"count": 0}
+    return {"count": len(times), "per_second": len(times) / seconds,
+            "p50_ms": percentile(times, 0.5) * 1e3,
+            "p99_ms": percentile(times, 0.99) * 1e3,
+            "max_ms": times[-1] * 1e3}
+
+
+def report(options, stats):
+    """
+    Return the results as a dict, ready to print or save.
+    """
+    all_times = sum(stats.latencies.values(), [])
+    return {
+        "options": dict((option, value)
+                        for option, value in vars(options).items()
+                        if option not in ["json", "serve"]),
+        "logins": dict(summarize(stats.logins, options.duration),
+                       failed=stats.failed_logins),
+        "disconnects": stats.disconnects,
+        "received_bytes": stats.received,
+        "commands": dict((command, summarize(stats.latencies[command],
+                                             options.duration))
+                         for command, _ in MIX),
+        "all": summarize(all_times, options.duration),
+    }
+
+
+def print_report(results):
+    options = results["options"]
+    print("{} clients, {} rooms, seed {}, {} s measured".format(
+        options["clients"], options["rooms"], options["seed"],
+        options["duration"]))
+    logins = results["logins"]
+    print("logins: {} ok, {} failed, {} disconnected early".format(
+        logins["count"], logins["failed"], results["disconnects"]))
+    print("received: {:,} bytes".format(results["received_bytes"]))
+    print("{:8} {:>8} {:>12} {:>10} {:>10} {:>10}".format(
+        "command", "count", "commands/s", "p50 ms", "p99 ms", "max ms"))
+    rows = [(command, results["commands"][command]) for command, _ in MIX]
+    rows += [("login", logins), ("all", results["all"])]
+    for name, row in rows:
+        if not row["count"]:
+            continue
+        print("{:8} {:8} {:12.1f} {:10.2f} {:10.2f} {:10.2f}".format(
+            name, row["count"], row["per_second"], row["p50_ms"],
+            row["p99_ms"], row["max_ms"]))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("--clients", type=int, default=1000,
+                            help="number of players to connect")
+    arg_parser.add_argument("--duration", type=float, default=30,
+                            help="seconds to measure for, once everyone's in")
+    arg_parser.add_argument("--think", type=float, default=5,
+                            help="mean seconds between a player's commands")
+    arg_parser.add_argument("--ramp", type=int, default=200,
+                            help="new connections per second")
+    arg_parser.add_argument("--rooms", type=int, default=200,
+                            help="number of rooms to dig")
+    arg_parser.add_argument("--items", type=int, default=5,
+                            help="loose items and equipment in each room")
+    arg_parser.add_argument("--depth", type=int, default=2,
+                            help="how deeply containers nest in each room")
+    arg_parser.add_argument("--password-rounds", type=int, default=1000,
+                            help="hash rounds, so logins aren't all hashing")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--json", metavar="FILE",
+                            help="also write the report to FILE")
+    arg_parser.add_argument("--serve", action="store_true",
+                            help=argparse.SUPPRESS)
+    options = arg_parser.parse_args()
+
+    if options.serve:
+        serve(options)
+        return
+
+    raise_file_limit()
+    arguments = ["--serve"]
+    for option in ["clients", "rooms", "items", "depth", "password_rounds",
+                   "seed"]:
+        arguments += ["--" + option.replace("_", "-"),
+                      str(getattr(options, option))]
+    child = subprocess.Popen([sys.executable, "-m", "benchmarks.network"] +
+                             arguments, stdout=subprocess.PIPE)
+    try:
+        for line in iter(child.stdout.readline, ""):
+            if line.startswith("port "):
+                port = int(line.split()[1])
+                break
+        else:
+            raise RuntimeError("The server didn't start.")
+
+        # The same seed builds the same world the server's built, so the
+        # clients can find their way around. Don't bother hashing passwords.
+        world_map = Map(make_world(options, password_hash="unused"))
+        names = sorted(world_map.starts)
+        stats = Stats(len(names))
+        rng = random.Random(options.seed)
+        ramp = float(len(names)) / options.ramp
+        for i, name in enumerate(names):
+            factory = LoadClientFactory(name, world_map, stats, options.think,
+                                        random.Random(rng.random()))
+            reactor.callLater(i / float(options.ramp), reactor.connectTCP,
+                              "127.0.0.1", port, factory)
+
+        def measure():
+            stats.start = timeit.default_timer()
+            stats.end = stats.start + options.duration
+        # Wait out the ramp and a think time, so everyone's busy by the start.
+        reactor.callLater(ramp + options.think, measure)
+        reactor.run()
+    finally:
+        child.terminate()
+        child.wait()
+
+    results = report(options, stats)
+    print_report(results)
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Synthetic world generator for the load benchmarks: a ring of rooms with extra
+random exits between them, each room holding loose items, pieces of
+equipment, and containers nested inside one another, and players scattered
+among the rooms, each wearing something.
+
+Run from the top of the repository to see what a world of a given size looks
+like:
+
+    python -m benchmarks.world [--rooms N] [--players N] [--items N]
+                               [--depth N] [--seed N]
+"""
+
+import argparse
+import random
+
+from muss import db, equipment, locks
+
+
+DIRECTIONS = ["north", "south", "east", "west", "northeast", "northwest",
+              "southeast", "southwest", "up", "down"]
+ADJECTIVES = ["red", "dusty", "shiny", "cracked", "tiny", "heavy", "wooden",
+              "glass", "striped", "ancient", "soggy", "golden"]
+NOUNS = ["apple", "book", "lamp", "coin", "spoon", "rock", "candle", "key",
+         "mask", "bottle", "feather", "rope"]
+CONTAINERS = ["box", "crate", "chest", "bag", "basket", "jar"]
+WEARABLES = ["hat", "cloak", "boots", "gloves", "scarf", "ring"]
+
+
+class World(object):
+    """
+    Everything make_world() built.
+
+    Attributes:
+        builder: The player who owns every room, exit and item.
+        rooms: A list of Rooms.
+        exits: A dict mapping each room to a list of its exits.
+        items: A dict mapping each room to a list of the things that can be
+            taken from it (loose items, equipment, and the outermost
+            containers).
+        players: A list of Players.
+    """
+    def __init__(self, builder):
+        self.builder = builder
+        self.rooms = []
+        self.exits = {}
+        self.items = {}
+        self.players = []
+
+
+def _item_name(rng, nouns, taken):
+    """
+    Pick a random "adjective noun" name not already in taken, numbering it if
+    every combination is used up.
+    """
+    for _ in range(10):
+        name = "{} {}".format(rng.choice(ADJECTIVES), rng.choice(nouns))
+        if name not in taken:
+            break
+    else:
+        name = "{} {}".format(name, len(taken))
+    taken.add(name)
+    return name
+
+
+def _connect(world, source, destination, rng):
+    """
+    Open an exit from source to destination under a direction name not
+    already used in source. Returns False if source has run out of names.
+    """
+    used = set(exit.name for exit in world.exits[source])
+    free = [d for d in DIRECTIONS if d not in used]
+    if not free:
+        return False
+    exit = db.Exit(rng.choice(free), source, destination)
+    db.store(exit)
+    world.exits[source].append(exit)
+    return True
+
+
+def make_world(rooms=200, players=100, items=5, depth=2, seed=0,
+               password_hash=None):
+    """
+    Build a world and store everything in it in the database.
+
+    Args:
+        rooms: How many rooms to dig.
+        players: How many players to create.
+        items: How many loose items and pieces of equipment to leave in each
+            room. Each room also gets one stack of containers.
+        depth: How deeply to nest the containers in each room. Each one holds
+            an item as well as the next container.
+        seed: Seed for the random choices, so that the same arguments always
+            build the same world.
+        password_hash: Every player's stored password (default: a hash of
+            "password"). Hashing is deliberately slow, so it's done once.
+
+    Returns:
+        A World.
+    """
+    rng = random.Random(seed)
+    if password_hash is None:
+        password_hash = db.hash_password("password")
+
+    with locks.authority_of(locks.SYSTEM):
+        builder = db.Player("Builder", None, password_hash)
+        db.store(builder)
+    world = World(builder)
+
+    with locks.authority_of(builder):
+        for i in range(rooms):
+            room = db.Room("Room {}".format(i))
+            room.description = "A generated room, number {}.".format(i)
+            db.store(room)
+            world.rooms.append(room)
+            world.exits[room] = []
+            world.items[room] = []
+
+        # A ring in both directions, so everywhere can be reached, and then
+        # some shortcuts.
+        for i, room in enumerate(world.rooms):
+            if rooms > 1:
+                following = world.rooms[(i + 1) % rooms]
+                _connect(world, room, following, rng)
+                _connect(world, following, room, rng)
+        for room in world.rooms:
+            for _ in range(rng.randint(0, 2)):
+                _connect(world, room, rng.choice(world.rooms), rng)
+
+        for room in world.rooms:
+            taken = set()
+            for _ in range(items):
+                if rng.random() < 0.25:
+                    item = equipment.Equipment(
+                        _item_name(rng, WEARABLES, taken), room)
+                else:
+                    item = db.Object(_item_name(rng, NOUNS, taken), room)
+                db.store(item)
+                world.items[room].append(item)
+
+            location = room
+            for level in range(depth):
+                container = db.Container(_item_name(rng, CONTAINERS, taken),
+                                         location)
+                db.store(container)
+                if level == 0:
+                    world.items[room].append(container)
+                filler = db.Object(_item_name(rng, NOUNS, taken), container)
+                db.store(filler)
+                location = container
+
+    for i in range(players):
+        with locks.authority_of(locks.SYSTEM):
+            player = db.Player("Player{}".format(i), None, password_hash)
+        with locks.authority_of(player):
+            player.location = rng.choice(world.rooms)
+            db.store(player)
+            worn = equipment.Equipment(rng.choice(WEARABLES), player)
+            db.store(worn)
+            worn.equip()
+        world.players.append(player)
+
+    return world
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("--rooms", type=int, default=200,
+                            help="number of rooms to dig")
+    arg_parser.add_argument("--players", type=int, default=100,
+                            help="number of players to create")
+    arg_parser.add_argument("--items", type=int, default=5,
+                            help="loose items and equipment in each room")
+    arg_parser.add_argument("--depth", type=int, default=2,
+                            help="how deeply containers nest in each room")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    options = arg_parser.parse_args()
+
+    world = make_world(options.rooms, options.players, options.items,
+                       options.depth, options.seed)
+    exits = sum(len(exits) for exits in world.exits.values())
+    with locks.authority_of(locks.SYSTEM):
+        objects = len(db.find_all())
+    print("{} rooms, {} exits, {} players, {} objects in all".format(
+        len(world.rooms), exits, len(world.players), objects))
+
+
+if __name__ == "__main__":
+    main()
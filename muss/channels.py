@@ -27,13 +27,19 @@ class Channel(object):
         self.players.remove(player)
 
     def _send_all(self, line):
-        for player in self.players:
-            player.send(line)
+        # Channel chatter is the first thing a slow client can do without.
+        # server imports db, which imports us, so import it here.
+        from muss import server
+        with server.noncritical_output():
+            for player in self.players:
+                player.send(line)
 
     def say(self, player, line):
-        for i in self.players:
-            if i is not player:
-                i.send('[{}] {} says, "{}"'.format(self, player, line))
+        from muss import server
+        with server.noncritical_output():
+            for i in self.players:
+                if i is not player:
+                    i.send('[{}] {} says, "{}"'.format(self, player, line))
         player.send('[{}] You say, "{}"'.format(self, line))
 
     def pose(self, player, line):
@@ -1,10 +1,11 @@
 import code
+import os
 import sys
 import StringIO
 
 import pyparsing
 
-from muss import handler, locks, parser, utils
+from muss import db, handler, locks, parser, timing, utils
 
 
 class Python(parser.Command):
@@ -28,7 +29,12 @@ class Python(parser.Command):
         player.send("")
 
         def check_password(line):
-            if player.hash(line) == player.password:
+            d = player.check_password(line)
+            d.addCallback(locks.bind_authority(password_checked))
+            return d
+
+        def password_checked(correct):
+            if correct:
                 with locks.authority_of(locks.SYSTEM):
                     player.enter_mode(PythonMode(player))
             else:
@@ -84,3 +90,111 @@ class Sudo(parser.Command):
                 player.mode.handle(player, line)
         else:
             player.send("You're not set for debugging!")
+
+
+class Rehash(parser.Command):
+    name = "rehash"
+    help_text = ("Reload every command module, so that changes to commands take "
+                 "effect without restarting the server. Requires sudo. This "
+                 "command cannot be abbreviated.")
+    require_full = True
+
+    def execute(self, player, args):
+        if locks.authority() is not locks.SYSTEM:
+            raise utils.UserError("You need sudo to reload commands.")
+        handler.registry.load(reload_modules=True)
+        # Modes players are in now are still instances of the classes from
+        # before the reload, which checks like isinstance(player.mode, SayMode)
+        # wouldn't recognize.
+        for other in db.objects_of_type('player'):
+            if not other.connected:
+                continue
+            for mode in other.mode_stack:
+                handler.rebind_mode(mode)
+        player.send("Reloaded {} commands.".format(
+            len(handler.registry.commands)))
+
+
+class Stats(parser.Command):
+    name = "stats"
+    usage = ["stats", "stats on", "stats off", "stats reset"]
+    help_text = ("Show how long each command has been taking to handle, and "
+                 "how much output is waiting for slow clients. Turn command "
+                 "timing on or off, or forget the timings so far. Requires "
+                 "sudo.")
+
+    @classmethod
+    def args(cls, player):
+        return pyparsing.Optional(
+            pyparsing.oneOf("on off reset", caseless=True)("action"))
+
+    def execute(self, player, args):
+        if locks.authority() is not locks.SYSTEM:
+            raise utils.UserError("You need sudo to see server statistics.")
+
+        action = args.get("action")
+        if action == "on":
+            timing.ENABLED = True
+            player.send("Command timing is on.")
+            return
+        if action == "off":
+            timing.ENABLED = False
+            player.send("Command timing is off.")
+            return
+        if action == "reset":
+            timing.reset()
+            player.send("Command timings reset.")
+            return
+
+        if not timing.ENABLED:
+            player.send("Command timing is off.")
+        lines = timing.summary()
+        if lines:
+            player.send("Command timings:")
+            for line in lines:
+                player.send(line)
+        else:
+            player.send("No commands timed yet.")
+
+        from muss.server import factory
+        if factory is not None:
+            output = factory.outputStats()
+            player.send("Output: {connections} connected, {paused} behind, "
+                        "{queued_bytes} bytes queued (peak {peak_queued_bytes})"
+                        ", {dropped_lines} lines ({dropped_bytes} bytes) "
+                        "dropped.".format(**output))
+
+
+class Scans(parser.Command):
+    name = "scans"
+    usage = ["scans", "scans reset"]
+    help_text = ("Show where in the code the whole database has been scanned "
+                 "for objects, and how much of it, or forget the counts so "
+                 "far. Requires sudo.")
+
+    @classmethod
+    def args(cls, player):
+        return pyparsing.Optional(
+            pyparsing.CaselessKeyword("reset")("action"))
+
+    def execute(self, player, args):
+        if locks.authority() is not locks.SYSTEM:
+            raise utils.UserError("You need sudo to see database scans.")
+
+        if args.get("action") == "reset":
+            db.reset_scan_counts()
+            player.send("Scan counts reset.")
+            return
+
+        counts = sorted(db.scan_counts().items(), key=lambda item: -item[1][1])
+        if not counts:
+            player.send("No scans yet.")
+            return
+        # Show paths from the top of the repository.
+        root = os.path.dirname(os.path.dirname(os.path.abspath(db.__file__)))
+        for (filename, line, function), (calls, examined, returned) in counts:
+            if filename.startswith(root):
+                filename = os.path.relpath(filename, root)
+            player.send("{}:{} ({}): {} calls, {} objects examined, {} "
+                        "returned".format(filename, line, function, calls,
+                                          examined, returned))
@@ -18,10 +18,11 @@ class Help(parser.Command):
     def execute(self, player, args):
         if args.get("command"):
             try:
-                name, command = utils.find_one(
-                    args["command"],
-                    handler.all_commands(),
-                    attributes=["names", "nospace_names"])
+                perfect_matches, partial_matches = \
+                    handler.registry.find_by_name(args["command"])
+                name, command = utils.best_match(args["command"],
+                                                 perfect_matches,
+                                                 partial_matches)
             except parser.NotFoundError as e:
                 e.token = "command"
                 raise e
@@ -38,11 +39,8 @@ class Help(parser.Command):
                 player.send("")
                 player.send(command.help_text)
         else:
-            # when we get command storage sorted out, this'll be replaced
-            all_names = []
-            for command in handler.all_commands():
-                all_names.extend(command().names)
-                all_names.extend(command().nospace_names)
+            all_names = [name for name, _ in handler.registry.names +
+                                             handler.registry.nospace_names]
             all_names = sorted(set(all_names))
             player.send('Available commands: {}\nUse \"help <command>\" for '
                         'more information about a specific command.'
@@ -10,6 +10,8 @@ class Chat(parser.Command):
     nospace_name = "."
     usage = [".", "chat <channel>", "chat <channel> <text>"]
     help_text = "Chat on a specific channel, or enter/leave channel modes."
+    # The channel list can change without anyone moving.
+    cache_args = False
 
     @classmethod
     def args(cls, player):
@@ -98,12 +100,13 @@ class SayMode(handler.Mode):
             for name in command().nospace_names:
                 if line.startswith(name):
                     arguments = line.split(name, 1)[1]
-                    args = command.args(player).parseString(arguments).asDict()
+                    args = command.args_for(player).parseString(
+                        arguments).asDict()
 
                     command().execute(player, args)
                     return
 
-        args = Say.args(player).parseString(line).asDict()
+        args = Say.args_for(player).parseString(line).asDict()
         Say().execute(player, args)
 
 
@@ -238,8 +241,8 @@ class Who(parser.Command):
     help_text = "List the connected players."
 
     def execute(self, player, args):
-        players = db.find_all(lambda x: isinstance(x, db.Player) and
-                                        x.connected)
+        players = [x for x in db.objects_of_type('player')
+                   if isinstance(x, db.Player) and x.connected]
         player.send("{number} {playersare} connected: {players}.".format(
             number=len(players),
             playersare="player is" if len(players) == 1 else "players are",
@@ -1,10 +1,31 @@
 import hashlib
+import hmac
+import mmap
+import os
 import pickle
+import pickletools
+import StringIO
+import struct
+import sys
 import textwrap
+import time
+import traceback
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import log, threadpool
 
 from muss import channels, locks, utils
 
 
+# Attributes which locks depend on (see locks.invalidate), besides which
+# attributes exist.
+_LOCK_INPUTS = frozenset(["owner", "_location", "attr_locks"])
+
+# Object overrides __getattribute__, so it uses this to look things up
+# normally. (Same as super(Object, self).__getattribute__, but quicker.)
+_getattribute = object.__getattribute__
+
+
 class Object(object):
 
     """
@@ -57,8 +78,7 @@ class Object(object):
             self.description = "You see nothing special."
             self.locks.take = locks.Pass()
             self.locks.drop = locks.Pass()
-            self.locks.insert = locks.Is(self)
-            self.locks.remove = locks.Is(self)
+            self.locks.insert = self.locks.remove = locks.Is(self)
             self.locks.destroy = locks.Owns(self)
             if location:
                 self.location = location
@@ -84,45 +104,63 @@ class Object(object):
         if attr == "__dict__" and locks.authority() is locks.SYSTEM:
             # This comes up when we're unpickling the db, and attr_locks
             # doesn't exist yet
-            return super(Object, self).__getattribute__(attr)
+            __dict__ = _getattribute(self, attr)
+            if not __dict__:
+                _materialize(self)
+            return __dict__
 
-        attr_locks = super(Object, self).__getattribute__("attr_locks")
-        if attr in attr_locks:
-            if attr_locks[attr].get_lock():
-                # Lock passes; grant access
-                return super(Object, self).__getattribute__(attr)
-            else:
-                # Lock fails; deny access
-                raise locks.LockFailedError("You don't have permission to get "
-                                            "{} from {}.".format(attr, self))
+        try:
+            attr_locks = _getattribute(self, "attr_locks")
+        except AttributeError:
+            # Maybe restore() left us unloaded.
+            if not _materialize(self):
+                raise
+            attr_locks = _getattribute(self, "attr_locks")
+        lock = attr_locks.get(attr)
+        if lock is None or lock.unguarded or lock.get_lock():
+            # No lock is defined, or it's Pass(), or it passes; grant access
+            return _getattribute(self, attr)
         else:
-            # No lock is defined; grant access
-            return super(Object, self).__getattribute__(attr)
+            # Lock fails; deny access
+            raise locks.LockFailedError("You don't have permission to get "
+                                        "{} from {}.".format(attr, self))
 
     def __setattr__(self, attr, value):
+        __dict__ = super(Object, self).__getattribute__("__dict__")
+        if not __dict__:
+            # Maybe restore() left us unloaded.
+            _materialize(self)
+
         # Does the attribute already exist?
-        if attr not in super(Object, self).__getattribute__("__dict__"):
+        if attr not in __dict__:
             # No, it's a new one; allow the write and also create a default lock
             super(Object, self).__setattr__(attr, value)
-            lock = locks.AttributeLock(set_lock=locks.OwnsAttribute(self, attr))
+            lock = locks.AttributeLock()
             with locks.authority_of(locks.SYSTEM):
                 self.attr_locks[attr] = lock
+            locks.invalidate()
         else:
             # Yes, so check the lock
             with locks.authority_of(locks.SYSTEM):
-                if attr not in self.attr_locks:
-                    # No lock is defined; allow the write
-                    return super(Object, self).__setattr__(attr, value)
-                else:
-                    set_lock = self.attr_locks[attr].set_lock
+                attr_lock = self.attr_locks.get(attr)
 
-            if set_lock():
-                return super(Object, self).__setattr__(attr, value)
+            if attr_lock is None or attr_lock.may_set():
+                # No lock is defined, or the lock passes; allow the write
+                super(Object, self).__setattr__(attr, value)
+                if attr in _LOCK_INPUTS:
+                    locks.invalidate()
             else:
                 # Lock fails; deny the write
                 raise locks.LockFailedError("You don't have permission to set "
                                             "{} on {}.".format(attr, self))
 
+        if attr == "send":
+            _reindex_listener(self)
+        elif attr == "type":
+            _reindex_type(self)
+        if _journal is not None:
+            _journal_attr(self, attr)
+
     def __delattr__(self, attr):
         try:
             with locks.authority_of(locks.SYSTEM):
@@ -139,6 +177,13 @@ class Object(object):
             super(Object, self).__delattr__(attr)
             with locks.authority_of(locks.SYSTEM):
                 del self.attr_locks[attr]
+            locks.invalidate()
+            if attr == "send":
+                _reindex_listener(self)
+            elif attr == "type":
+                _reindex_type(self)
+            if _journal is not None:
+                _journal_attr(self, attr)
         else:
             raise locks.LockFailedError("You don't have permission to unset {} "
                                         "on {}.".format(attr, self))
@@ -164,6 +209,9 @@ class Object(object):
         if set_lock is not None:
             lock.set_lock = set_lock
 
+        if _journal is not None:
+            _journal_attr(self, attr)
+
     @property
     def name(self):
         return self._name
@@ -175,16 +223,22 @@ class Object(object):
 
         if hasattr(self, "name"):
             with locks.authority_of(locks.SYSTEM):
-                lock = self.attr_locks["name"].set_lock
-            if lock():
+                attr_lock = self.attr_locks["name"]
+            if attr_lock.may_set():
                 with locks.authority_of(locks.SYSTEM):
+                    stored = _is_stored(self)
+                    if stored:
+                        _unindex_name(self)
                     self._name = name
+                    if stored:
+                        _index_name(self)
+                        _touch(self)
+                        _touch(self._location)
             else:
                 raise locks.LockFailedError("You don't have permission to set "
                                             "name on {}.".format(self))
         else:
-            lock = locks.OwnsAttribute(self, "name")
-            attr_lock = locks.AttributeLock(set_lock=lock)
+            attr_lock = locks.AttributeLock()
             with locks.authority_of(locks.SYSTEM):
                 self.attr_locks["name"] = attr_lock
             self._name = name
@@ -222,6 +276,9 @@ class Object(object):
         # Locks passed or non-applicable. Proceed with the move.
         with locks.authority_of(locks.SYSTEM):
             self._location = destination
+            if _is_stored(self):
+                _unindex_location(self, origin)
+                _index_location(self, destination)
 
         with locks.authority_of(self):
             # this gets to use self authority because it should always happen,
@@ -259,16 +316,11 @@ class Object(object):
         """
         if self.location:
             result = [self.location]
-        else:
-            result = []
-
-        if self.location:
             # Add everything in the same place, as well as our contents
-            result.extend(find_all(lambda obj: obj.location == self or
-                                               obj.location == self.location))
+            result.extend(contents_of(self) | contents_of(self.location))
         else:
             # We have no location; add only our contents
-            result.extend(find_all(lambda obj: obj.location == self))
+            result = list(contents_of(self))
 
         return result
 
@@ -285,7 +337,8 @@ class Object(object):
 
     def emit(self, line, exceptions=None):
         """
-        Send a line to each of this object's neighbors.
+        Send a line to each of this object's neighbors. Only those that do
+        something with it (see listeners_in) are bothered.
 
         Args:
             line: The line to send.
@@ -293,10 +346,18 @@ class Object(object):
                 sent.
         """
         if exceptions is None:
-            exceptions = set()
+            exceptions = ()
 
-        for obj in set(self.neighbors()).difference(exceptions):
-            obj.send(line)
+        recipients = set(_listeners.get(self, ()))
+        location = self.location
+        if location is not None:
+            recipients.update(_listeners.get(location, ()))
+            if _is_listener(location):
+                recipients.add(location)
+
+        for obj in recipients:
+            if obj not in exceptions:
+                obj.send(line)
 
     def position_string(self):
         """
@@ -319,8 +380,7 @@ class Object(object):
         no one's inside the object, return an empty string.
         """
 
-        population = find_all(lambda x: x.type == 'player' and
-                                        x.location is self)
+        population = [x for x in contents_of(self) if x.type == 'player']
         if population:
             names = []
             for player in population:
@@ -337,10 +397,9 @@ class Object(object):
         List the object's contents as a string formatted for display. If no
         contents, return an empty string.
         """
-        objects = find_all(lambda x: x.type != 'player' and x.type != 'exit'
-                                     and x.location is self
-                                     and not (hasattr(x, 'equipped')
-                                              and x.equipped))
+        objects = [x for x in contents_of(self)
+                   if x.type != 'player' and x.type != 'exit'
+                   and not (hasattr(x, 'equipped') and x.equipped)]
         names = [o.position_string() for o in objects]
         text = utils.comma_and(names)
 
@@ -354,9 +413,9 @@ class Object(object):
         List the object's equipment as a string formatted for display. If no
         equipment, return an empty string.
         """
-        objects = find_all(lambda x: x.type != 'player' and x.type != 'exit'
-                                     and x.location is self
-                                     and hasattr(x, 'equipped') and x.equipped)
+        objects = [x for x in contents_of(self)
+                   if x.type != 'player' and x.type != 'exit'
+                   and hasattr(x, 'equipped') and x.equipped]
         names = [o.position_string() for o in objects]
         text = utils.comma_and(names)
 
@@ -373,7 +432,7 @@ class Object(object):
         Exits from an object are pretty unlikely if the object isn't a room,
         but they're not illegal.
         """
-        exits = find_all(lambda x: x.type == 'exit' and x.location is self)
+        exits = [x for x in contents_of(self) if x.type == 'exit']
         text = utils.comma_and(map(str, exits))
         if exits:
             return "Exits: {}".format(text)
@@ -405,6 +464,10 @@ class Locks(object):
         try:
             return super(Locks, self).__getattribute__(attr)
         except AttributeError:
+            if attr.startswith("__"):
+                # Special method lookups (e.g. __getnewargs__ by pickle) need
+                # to fail properly.
+                raise
             return locks.Fail()
 
     def __getstate__(self):
@@ -462,13 +525,14 @@ class Player(Object):
         name: Both the name as described on Object and the login name. Unique
             among Players.
         password: Result of calling this class's hash() method with the correct
-            password.
+            password: the hashing scheme, its parameters, a salt, and the hash
+            (see hash_password()).
         mode: Whatever Mode we're currently in (if connected). Read-only.
         mode_stack: The stack of modes, current mode last (if connected). No
             read except SYSTEM.
     """
 
-    def __init__(self, name, password):
+    def __init__(self, name, password, password_hash=None):
         """
         Create a brand-new player and add it to the database.
 
@@ -476,13 +540,18 @@ class Player(Object):
             name: The player's name.
             password: The player's password, in plaintext, to be discarded
                 forever after this method call.
+            password_hash: The result of hash_password(password), if it's
+                already been computed (default None). If given, password is
+                ignored.
         """
         Object.__init__(self, name, location=get(0), owner=self)
         with locks.authority_of(locks.SYSTEM):
             self.type = 'player'
             self.lock_attr("name", set_lock=locks.Fail())
             self.lock_attr("owner", set_lock=locks.Fail())
-            self.password = self.hash(password)
+            if password_hash is None:
+                password_hash = self.hash(password)
+            self.password = password_hash
             self.textwrapper = textwrap.TextWrapper()
             # Initialize the mode stack empty, but enter_mode() must be called
             # before any input is handled.
@@ -531,41 +600,64 @@ class Player(Object):
 
     def hash(self, password):
         """
-        Generate a hash from this Player's name and the given password. This
-        method is called in creating and authenticating players.
+        Generate a hash of the given password, with a new salt, to be stored
+        as this Player's password.
 
         Args:
             password: The password to hash.
         """
-        # Hash the username and password together
-        m = hashlib.sha512()
-        m.update(self.name)
-        m.update(password)
-        return m.hexdigest()
+        return hash_password(password)
+
+    def check_password(self, password):
+        """
+        Check whether the given password is this Player's, without holding up
+        the server while it's hashed. If it is, but the stored hash was made
+        some other way than hash_password() would make it now, replace it.
+
+        Returns:
+            A Deferred which fires with True if the password is correct, False
+            otherwise.
+        """
+        with locks.authority_of(locks.SYSTEM):
+            stored = self.password
+        d = _in_hash_pool(_verify_and_rehash, self.name, password, stored)
+
+        def verified(result):
+            correct, new_hash = result
+            if new_hash is not None:
+                with locks.authority_of(locks.SYSTEM):
+                    # Unless it's been changed in the meantime.
+                    if self.password == stored:
+                        self.password = new_hash
+            return correct
+        return d.addCallback(verified)
 
     def send(self, line):
         """
         If this player is connected, send the line to the client.
         """
         from muss.server import factory
-        lines = line.split("\n")
-        wrapped = []
-        for i in lines:
-            if i:
-                wrapped.extend(self.textwrapper.wrap(i))
-            else:  # TextWrapper strips blank lines, so let's preserve them
-                wrapped.append("")
-
         try:
-            for wrapped_line in wrapped:
-                factory.allProtocols[self.name].sendLine(wrapped_line)
+            protocol = factory.allProtocols[self.name]
         except KeyError:
-            pass
+            # Not connected, so don't bother wrapping.
+            return
+
+        for wrapped_line in utils.wrap(self.textwrapper, line):
+            protocol.sendLine(wrapped_line)
+
+    def __getstate__(self):
+        """
+        Return this player's state for pickling. Modes belong to a live
+        connection, so they aren't saved.
+        """
+        state = dict(self.__dict__)
+        state["mode_stack"] = []
+        return state
 
     def contents_string(self):
-        contents = find_all(lambda x: x.location == self
-                                      and not (hasattr(x, 'equipped')
-                                               and x.equipped))
+        contents = [x for x in contents_of(self)
+                    if not (hasattr(x, 'equipped') and x.equipped)]
         text = utils.comma_and(map(str, list(contents)))
         if contents:
             return "{} is carrying {}.".format(self.name, text)
@@ -573,9 +665,8 @@ class Player(Object):
             return ""
 
     def equipment_string(self):
-        equipment = find_all(lambda x: x.location == self
-                                       and hasattr(x, 'equipped')
-                                       and x.equipped)
+        equipment = [x for x in contents_of(self)
+                     if hasattr(x, 'equipped') and x.equipped]
         text = utils.comma_and(map(str, list(equipment)))
         if equipment:
             return "{} is wearing {}.".format(self.name, text)
@@ -635,26 +726,681 @@ class Exit(Object):
             pass
 
 
+# A stored password hash is a string of four fields separated by "$": the
+# name of the scheme (a key of PASSWORD_SCHEMES), its work factor, and the
+# salt and hash in hex. Whenever a player logs in with a hash made with some
+# other scheme or work factor than the current ones, it's replaced with a new
+# one. Hashes from before there were schemes, SHA-512 of the player's name and
+# password with no salt, are replaced the same way.
+#
+# Each scheme is a function taking the password, salt, and work factor, and
+# returning the hash as a string of bytes.
+PASSWORD_SCHEMES = {
+    "pbkdf2_sha256": lambda password, salt, rounds: hashlib.pbkdf2_hmac(
+        "sha256", password, salt, rounds),
+    "pbkdf2_sha512": lambda password, salt, rounds: hashlib.pbkdf2_hmac(
+        "sha512", password, salt, rounds),
+}
+# The scheme and work factor for new hashes.
+PASSWORD_SCHEME = "pbkdf2_sha256"
+PASSWORD_ROUNDS = 100000
+# How many bytes of salt new hashes get.
+SALT_SIZE = 16
+
+# Hashing passwords is meant to be slow, so when the server is running, it's
+# done on a pool of worker threads (started by start_hash_pool()) instead of
+# holding up everyone else's input. If the pool isn't running, as in tests,
+# passwords are hashed right away.
+#
+# How many passwords can be hashed at once.
+HASH_THREADS = 4
+
+_hash_pool = None  # The pool of hashing threads, if it's running
+
+
+def hash_password(password):
+    """
+    Hash a password with a new salt, using the current PASSWORD_SCHEME and
+    PASSWORD_ROUNDS, for storing as a player's password attribute. Touches
+    nothing else, so it's safe to call from any thread.
+    """
+    salt = os.urandom(SALT_SIZE)
+    password_hash = PASSWORD_SCHEMES[PASSWORD_SCHEME](password, salt,
+                                                      PASSWORD_ROUNDS)
+    return "$".join([PASSWORD_SCHEME, str(PASSWORD_ROUNDS),
+                     salt.encode("hex"), password_hash.encode("hex")])
+
+
+def verify_password(name, password, stored):
+    """
+    Check a player's password against their stored hash, taking the same
+    time however much of it matches. Safe to call from any thread.
+
+    Args:
+        name: The player's name, which unsalted old hashes include.
+        password: The password to check.
+        stored: The player's password attribute.
+
+    Returns:
+        A tuple of whether the password is correct, and whether the stored
+        hash should be replaced with a new one from hash_password().
+    """
+    if "$" not in stored:
+        m = hashlib.sha512()
+        m.update(name)
+        m.update(password)
+        return hmac.compare_digest(m.hexdigest(), stored), True
+
+    scheme, rounds, salt, password_hash = stored.split("$")
+    rounds = int(rounds)
+    attempt = PASSWORD_SCHEMES[scheme](password, salt.decode("hex"), rounds)
+    correct = hmac.compare_digest(attempt, password_hash.decode("hex"))
+    return correct, (scheme, rounds) != (PASSWORD_SCHEME, PASSWORD_ROUNDS)
+
+
+def _verify_and_rehash(name, password, stored):
+    """
+    Call verify_password(), then hash_password() if the password is correct
+    and needs a new hash.
+
+    Returns:
+        A tuple of whether the password is correct, and the new hash or None.
+    """
+    correct, outdated = verify_password(name, password, stored)
+    if correct and outdated:
+        return correct, hash_password(password)
+    return correct, None
+
+
+def _in_hash_pool(func, *args):
+    """
+    Call func(*args) on the hashing pool, if it's running, or else right
+    away.
+
+    Returns:
+        A Deferred which fires with the result.
+    """
+    if _hash_pool is None:
+        return defer.maybeDeferred(func, *args)
+    return threads.deferToThreadPool(reactor, _hash_pool, func, *args)
+
+
+def hash_password_in_thread(password):
+    """
+    Call hash_password() on the hashing pool, if it's running.
+
+    Returns:
+        A Deferred which fires with the hash.
+    """
+    return _in_hash_pool(hash_password, password)
+
+
+def start_hash_pool():
+    """
+    Start the pool of HASH_THREADS threads for hashing passwords, if it isn't
+    running already. With HASH_THREADS set to 0, do nothing, so passwords are
+    always hashed right away.
+    """
+    global _hash_pool
+    if _hash_pool is not None or not HASH_THREADS:
+        return
+    _hash_pool = threadpool.ThreadPool(0, HASH_THREADS, "password hashing")
+    _hash_pool.start()
+
+
+def stop_hash_pool():
+    """
+    Stop the hashing pool, once the hashes it's already working on are done.
+    """
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.stop()
+        _hash_pool = None
+
+
+# The database is saved as a snapshot of the whole world (DATABASE_FILE) plus
+# an append-only journal of every change since (JOURNAL_FILE). Each snapshot
+# has a generation number. The journal begins with the generation it applies
+# to, and snapshot() adds a marker to the journal at the moment each new
+# snapshot is taken; on restore, only the records after the loaded snapshot's
+# marker are replayed, and a journal from before that snapshot is ignored.
+#
+# A snapshot holds each object's state as a separate pickle, followed by an
+# index of where each one is (along with what the location, type, and player
+# name indexes need to know about it) and, last, the offset of the index.
+# restore() reads only the index; each object starts out as an empty instance
+# and loads its state from the snapshot the first time one of its attributes
+# is used. A snapshot in the old format, which is the whole database in one
+# pickle, is still loaded all at once.
+#
+# The journal records store() and delete() calls and assignments to (or
+# deletions of) attributes on stored objects. It can't see changes made inside
+# a mutable attribute value, like a list or an object's locks namespace; call
+# store() on the object afterward to record those.
+DATABASE_FILE = "muss.db"
+JOURNAL_FILE = "muss.journal"
+# How often, in seconds, to call snapshot().
+SNAPSHOT_INTERVAL = 300
+# How often, in seconds, to check whether a snapshot in progress is done.
+SNAPSHOT_POLL_INTERVAL = 0.1
+
+_journal = None  # The open journal file, if we're journaling
+_generation = 0  # The latest snapshot generation, including any in progress
+_journal_end = None  # Where the last good record in the journal ends, if any
+_dirty = False  # Whether anything has been journaled since the last snapshot
+# The snapshot being written by a child process, if any: a tuple of its pid,
+# generation, where its marker ends in the journal, and when it started.
+_snapshot_in_progress = None
+# How many seconds the most recent successful snapshot took to write.
+last_snapshot_duration = None
+
+# The first bytes of a snapshot in the indexed format.
+_SNAPSHOT_FORMAT = "MUSS snapshot 2\n"
+_snapshot_data = None  # The restored snapshot, mapped into memory
+# Maps each object that hasn't been loaded from _snapshot_data yet to its index
+# entry: (uid, class, offset, length, location uid, type, name).
+_unloaded = {}
+# Maps each uid in the restored snapshot to its object, even if it's since
+# been deleted, for loading references to it.
+_snapshot_objects = {}
+
+
+def _write_snapshot(generation):
+    """
+    Write the database to a temporary file and sync it to disk, then move it
+    into place over the old snapshot, so that a crash partway through (or a
+    power cut soon after) leaves the old one intact. Requires SYSTEM
+    authority.
+    """
+    # Objects from the restored snapshot that have been deleted since. The
+    # new snapshot won't have them, so anything that refers to one has to be
+    # loaded and pickled afresh, with its own copy of the deleted object.
+    deleted = set(uid for uid, obj in _snapshot_objects.iteritems()
+                  if _objects.get(uid) is not obj)
+    temp_file = DATABASE_FILE + ".tmp"
+    with open(temp_file, 'wb') as f:
+        f.write(_SNAPSHOT_FORMAT)
+        index = []
+        for uid, obj in _objects.iteritems():
+            entry = _unloaded.get(obj)
+            offset = f.tell()
+            if entry is not None:
+                data = _snapshot_data[entry[2]:entry[2] + entry[3]]
+                if not (deleted and _references(data) & deleted):
+                    # Still exactly as it was in the last snapshot.
+                    f.write(data)
+                    index.append(entry[:2] + (offset,) + entry[3:])
+                    continue
+                _materialize(obj)
+            _JournalPickler(f, pickle.HIGHEST_PROTOCOL).dump(_state(obj))
+            location = obj.location
+            if location is not None:
+                location = _uid_of(location)
+            index.append((uid, type(obj), offset, f.tell() - offset, location,
+                          obj.type, obj.name))
+        index_offset = f.tell()
+        pickle.dump((_nextUid, generation, index), f, pickle.HIGHEST_PROTOCOL)
+        f.write(struct.pack("<Q", index_offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_file, DATABASE_FILE)
+
+
 def backup():
     """
-    Dump the contents of the database to a backup file "muss.db", overwriting
-    any existing one.
+    Dump the contents of the database to a new snapshot, replacing any
+    existing one, and wait for it to be written. If journaling, start a new,
+    empty journal to go with it.
     """
-    with open("muss.db", 'wb') as f:
-        pickle.dump(_nextUid, f)
-        pickle.dump(_objects, f)
+    global _generation, _dirty
+    _reap_snapshot()
+    _generation += 1
+    _write_snapshot(_generation)
+    _dirty = False
+
+    if _journal is not None:
+        _journal.seek(0)
+        _journal.truncate()
+        _start_journal()
+
+
+def snapshot():
+    """
+    If anything has been journaled since the last snapshot, write a new one
+    without holding up the server.
+
+    A forked child process writes the snapshot from its own copy of the
+    database, frozen at the moment of the fork, while the server carries on.
+    Changes made in the meantime go in the journal after a marker for the new
+    snapshot, and once the child finishes, the journal is cut down to just
+    those. If the child fails, nothing is lost: the old snapshot and the whole
+    journal are still there, and the next call tries again. Where there's no
+    fork(), this falls back to backup().
+
+    Returns:
+        A Deferred which fires when the snapshot is done.
+    """
+    global _generation, _dirty, _snapshot_in_progress
+    if _journal is None or not _dirty or _snapshot_in_progress is not None:
+        return defer.succeed(None)
+
+    start = time.time()
+    if not hasattr(os, "fork"):
+        with locks.authority_of(locks.SYSTEM):
+            backup()
+        _log_snapshot(_generation, start)
+        return defer.succeed(None)
+
+    _generation += 1
+    _journal_write(("generation", _generation), None)
+    os.fsync(_journal.fileno())
+    _dirty = False
+    pid = os.fork()
+    if pid == 0:
+        # This is the child. Only the thread that forked is running here; the
+        # others (such as the password hashing pool's) were left behind,
+        # along with any locks they held. So the child only writes the
+        # snapshot, which takes no locks, and leaves with os._exit(), without
+        # running any of the parent's cleanup. Even logging could deadlock,
+        # so a failure goes straight to stderr, and the parent logs the exit
+        # status.
+        status = 1
+        try:
+            with locks.authority_of(locks.SYSTEM):
+                _write_snapshot(_generation)
+            status = 0
+        except Exception:
+            os.write(2, "Unable to write snapshot {}:\n{}"
+                     .format(_generation, traceback.format_exc()))
+        finally:
+            os._exit(status)
+    _snapshot_in_progress = (pid, _generation, _journal_end, start)
+
+    def poll():
+        if _reap_snapshot(os.WNOHANG):
+            loop.stop()
+    loop = task.LoopingCall(poll)
+    return loop.start(SNAPSHOT_POLL_INTERVAL, now=False)
+
+
+def _reap_snapshot(options=0):
+    """
+    If a child process is writing a snapshot, wait for it to finish (or, with
+    os.WNOHANG, just check whether it has) and clean up after it.
+
+    Returns:
+        True if there's no longer a snapshot in progress, False otherwise.
+    """
+    global _dirty, _snapshot_in_progress
+    if _snapshot_in_progress is None:
+        return True
+    pid, generation, marker_end, start = _snapshot_in_progress
+    finished, status = os.waitpid(pid, options)
+    if not finished:
+        return False
+    _snapshot_in_progress = None
+
+    if status == 0:
+        if _journal is not None:
+            _trim_journal(generation, marker_end)
+        _log_snapshot(generation, start)
+    else:
+        # The changes from before the marker are still only in the journal.
+        _dirty = True
+        log.msg("Snapshot {} failed (status {}); will retry in {} seconds."
+                .format(generation, status, SNAPSHOT_INTERVAL))
+    return True
+
+
+def _log_snapshot(generation, start):
+    global last_snapshot_duration
+    last_snapshot_duration = time.time() - start
+    log.msg("Wrote snapshot {} in {:.3f} seconds (every {} seconds)."
+            .format(generation, last_snapshot_duration, SNAPSHOT_INTERVAL))
+
+
+def _trim_journal(generation, offset):
+    """
+    Now that the snapshot of the given generation is written, replace the
+    journal with one holding only the records after its marker, which ends at
+    offset.
+    """
+    global _journal, _journal_end
+    _journal.seek(offset)
+    tail = _journal.read()
+    temp_file = JOURNAL_FILE + ".tmp"
+    with open(temp_file, 'wb') as f:
+        pickle.dump(("generation", generation), f)
+        f.write(tail)
+        f.flush()
+        os.fsync(f.fileno())
+    _journal.close()
+    os.rename(temp_file, JOURNAL_FILE)
+    _journal = open(JOURNAL_FILE, 'r+b')
+    _journal.seek(0, os.SEEK_END)
+    _journal_end = _journal.tell()
 
 
 def restore():
     """
-    Read the contents of backup file "muss.db" and populate the database with
-    them.
+    Read the latest snapshot and populate the database with it, then replay any
+    journal written since.
     """
-    with open("muss.db", 'rb') as f:
+    with open(DATABASE_FILE, 'rb') as f:
         global _nextUid
         global _objects
-        _nextUid = pickle.load(f)
-        _objects = pickle.load(f)
+        global _generation
+        global _snapshot_data
+        global _unloaded
+        global _snapshot_objects
+        _objects = {}
+        _unloaded = {}
+        if f.read(len(_SNAPSHOT_FORMAT)) == _SNAPSHOT_FORMAT:
+            _snapshot_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            index_offset, = struct.unpack("<Q", _snapshot_data[-8:])
+            _nextUid, _generation, index = pickle.loads(
+                _snapshot_data[index_offset:-8])
+            for entry in index:
+                uid, cls = entry[:2]
+                obj = cls.__new__(cls)
+                _objects[uid] = obj
+                _unloaded[obj] = entry
+            _snapshot_objects = dict(_objects)
+        else:
+            f.seek(0)
+            _nextUid = pickle.load(f)
+            _objects = pickle.load(f)
+            try:
+                _generation = pickle.load(f)
+            except EOFError:
+                # Written before snapshots had generations.
+                _generation = 0
+    _replay_journal()
+    _rebuild_indexes()
+    locks.invalidate()
+
+
+def _materialize(obj):
+    """
+    If obj hasn't been loaded from the snapshot yet, load it. If loading
+    fails, it's left unloaded, so its state in the snapshot isn't lost.
+
+    Returns:
+        True if obj was loaded, False if there was nothing to load.
+    """
+    entry = _unloaded.get(obj)
+    if entry is None:
+        return False
+    offset, length = entry[2:4]
+    unpickler = _JournalUnpickler(
+        StringIO.StringIO(_snapshot_data[offset:offset + length]))
+    unpickler.pending = _snapshot_objects
+    with locks.authority_of(locks.SYSTEM):
+        state = unpickler.load()
+    del _unloaded[obj]
+    super(Object, obj).__getattribute__("__dict__").update(state)
+    return True
+
+
+def _references(data):
+    """
+    Return the set of uids that an object's pickled state (as written by
+    _JournalPickler) refers to, without unpickling it.
+    """
+    uids = set()
+    previous = None
+    for opcode, arg, _ in pickletools.genops(data):
+        if opcode.name == "BINPERSID":
+            uids.add(previous)
+        elif opcode.name == "PERSID":
+            uids.add(int(arg))
+        previous = arg
+    return uids
+
+
+def _uid_of(obj):
+    """
+    Return obj.uid, without loading obj if it isn't loaded.
+    """
+    entry = _unloaded.get(obj)
+    if entry is not None:
+        return entry[0]
+    return obj.uid
+
+
+def open_journal():
+    """
+    Begin recording every change to the journal, continuing from the one we
+    restored if possible. Otherwise, take a fresh snapshot first, so that the
+    new journal has something to apply to.
+    """
+    global _journal
+    if _journal is not None:
+        return
+    if _journal_end is None:
+        with locks.authority_of(locks.SYSTEM):
+            backup()
+        _journal = open(JOURNAL_FILE, 'w+b')
+        _start_journal()
+    else:
+        # Cut off anything after the last good record before appending.
+        _journal = open(JOURNAL_FILE, 'r+b')
+        _journal.truncate(_journal_end)
+        _journal.seek(_journal_end)
+
+
+def close_journal():
+    """
+    Stop journaling.
+    """
+    global _journal, _journal_end
+    if _journal is not None:
+        _journal_end = _journal.tell()
+        _journal.close()
+        _journal = None
+
+
+def _start_journal():
+    global _journal_end
+    pickle.dump(("generation", _generation), _journal)
+    _journal.flush()
+    os.fsync(_journal.fileno())
+    _journal_end = _journal.tell()
+
+
+class _JournalPickler(pickle.Pickler):
+    """
+    Pickles references to stored objects as their uids, so that a journal
+    record only contains the one object it's about.
+    """
+    def persistent_id(self, obj):
+        if isinstance(obj, Object):
+            if obj in _unloaded:
+                uid = _unloaded[obj][0]
+                if _objects.get(uid) is obj:
+                    return uid
+                # Deleted before it was ever loaded; pickle it whole.
+                _materialize(obj)
+            elif _is_stored(obj):
+                return obj.uid
+        return None
+
+
+class _JournalUnpickler(pickle.Unpickler):
+    """
+    Resolves uids written by _JournalPickler to objects in the database (or to
+    the object currently being replayed, which may not be in it yet). If not
+    resolving, as when skipping records, every uid comes back as None.
+    """
+    def __init__(self, f, resolve=True):
+        pickle.Unpickler.__init__(self, f)
+        self.pending = {}
+        self.resolve = resolve
+
+    def persistent_load(self, uid):
+        if not self.resolve:
+            return None
+        if uid in self.pending:
+            return self.pending[uid]
+        return _objects[uid]
+
+
+def _state(obj):
+    """
+    Return the attributes of obj that should be saved. Requires SYSTEM
+    authority.
+    """
+    getstate = getattr(type(obj), "__getstate__", None)
+    if getstate is not None:
+        return getstate(obj)
+    return obj.__dict__
+
+
+def _journal_write(header, payload):
+    """
+    Append one record to the journal: a header tuple, then a payload. The
+    record is assembled in memory first, so it's written all at once or (if it
+    can't be pickled) not at all.
+    """
+    global _journal_end, _dirty
+    buf = StringIO.StringIO()
+    try:
+        with locks.authority_of(locks.SYSTEM):
+            pickler = _JournalPickler(buf, pickle.HIGHEST_PROTOCOL)
+            pickler.dump(header)
+            pickler.dump(payload)
+    except Exception:
+        log.err(None, "Unable to journal {}".format(header))
+        return
+    _journal.write(buf.getvalue())
+    _journal.flush()
+    _journal_end = _journal.tell()
+    _dirty = True
+
+
+def _journal_store(obj):
+    with locks.authority_of(locks.SYSTEM):
+        state = _state(obj)
+    _journal_write(("store", obj.uid, type(obj)), state)
+
+
+def _journal_attr(obj, attr):
+    """
+    Record the current value (or absence) and lock of one attribute of obj.
+    """
+    with locks.authority_of(locks.SYSTEM):
+        if not _is_stored(obj):
+            return
+        state = _state(obj)
+        lock = obj.attr_locks.get(attr)
+    _journal_write(("attr", obj.uid, attr),
+                   (attr in state, state.get(attr), lock))
+
+
+def _journal_delete(obj):
+    _journal_write(("delete", obj.uid), None)
+
+
+def _replay_journal():
+    """
+    Apply each record in the journal to the database, if the journal goes with
+    the snapshot we loaded. If the journal began before that snapshot was
+    taken, skip ahead to the snapshot's marker. Stop at the first damaged
+    record, which may have been cut off by a crash. Requires SYSTEM authority.
+    """
+    global _journal_end, _generation, _dirty
+    _journal_end = None
+    _dirty = False
+    try:
+        f = open(JOURNAL_FILE, 'rb')
+    except IOError:
+        return
+
+    with f:
+        try:
+            kind, generation = pickle.load(f)
+        except Exception:
+            return
+        if kind != "generation" or generation > _generation:
+            return
+        snapshot_generation = _generation
+        skipping = generation < snapshot_generation
+        end = f.tell()
+
+        while True:
+            try:
+                marker = _replay_record(_JournalUnpickler(f, not skipping))
+            except EOFError:
+                break
+            except Exception:
+                print("WARNING: The journal {} is damaged after byte {}. "
+                      "Changes after that point are lost."
+                      .format(JOURNAL_FILE, end))
+                break
+            if marker is None:
+                _dirty = _dirty or not skipping
+            else:
+                # Never reuse the generation of a snapshot that was started,
+                # even if it didn't finish.
+                _generation = max(_generation, marker)
+                if marker == snapshot_generation:
+                    skipping = False
+            end = f.tell()
+
+        if not skipping:
+            _journal_end = end
+
+
+def _replay_record(unpickler):
+    """
+    Read one record and, unless the unpickler isn't resolving uids, apply it.
+    Nothing changes until the whole record has been read.
+
+    Returns:
+        The generation, if the record is a snapshot marker; otherwise None.
+    """
+    global _nextUid
+    header = unpickler.load()
+    kind, uid = header[:2]
+    if kind == "generation":
+        unpickler.load()
+        return uid
+    if not unpickler.resolve:
+        unpickler.load()
+    elif kind == "store":
+        cls = header[2]
+        obj = _objects.get(uid)
+        if obj is None:
+            obj = cls.__new__(cls)
+        # The record replaces everything in the snapshot.
+        _unloaded.pop(obj, None)
+        unpickler.pending[uid] = obj
+        state = unpickler.load()
+        obj.__dict__.clear()
+        obj.__dict__.update(state)
+        _objects[uid] = obj
+        _nextUid = max(_nextUid, uid + 1)
+    elif kind == "attr":
+        attr = header[2]
+        present, value, lock = unpickler.load()
+        obj = _objects[uid]
+        attr_locks = obj.__dict__["attr_locks"]
+        if present:
+            obj.__dict__[attr] = value
+        else:
+            obj.__dict__.pop(attr, None)
+        if lock is not None:
+            attr_locks[attr] = lock
+        else:
+            attr_locks.pop(attr, None)
+    elif kind == "delete":
+        unpickler.load()
+        # If it was never loaded, leave it loadable, for anything that still
+        # refers to it.
+        _objects.pop(uid, None)
+    else:
+        raise ValueError("Unknown journal record {}".format(header))
+    return None
 
 
 def store(obj):
@@ -681,7 +1427,11 @@ def store(obj):
         # It already has a UID, so it's already in the database somewhere
         if obj.uid in _objects:
             # Update the DB
+            _unindex(_objects[obj.uid])
             _objects[obj.uid] = obj
+            _index(obj)
+            if _journal is not None:
+                _journal_store(obj)
         else:
             # Uh oh -- the object we were passed doesn't exist, judging by its
             # UID.
@@ -693,6 +1443,9 @@ def store(obj):
             obj.uid = _nextUid
         _nextUid += 1
         _objects[obj.uid] = obj
+        _index(obj)
+        if _journal is not None:
+            _journal_store(obj)
 
 
 def delete(obj):
@@ -711,6 +1464,9 @@ def delete(obj):
         IndexError: If there's no such object to be deleted.
     """
     del _objects[obj.uid]
+    _unindex(obj)
+    if _journal is not None:
+        _journal_delete(obj)
 
 
 def find_all(condition=(lambda x: True)):
@@ -720,7 +1476,7 @@ def find_all(condition=(lambda x: True)):
     Args:
         condition: Any function that takes an object and returns True or False.
     """
-    return set(obj for obj in _objects.values() if condition(obj))
+    return _scan(condition, sys._getframe(1))
 
 
 def find(condition=(lambda x: True)):
@@ -733,7 +1489,7 @@ def find(condition=(lambda x: True)):
     Raises:
         KeyError: If there are zero, or plural, objects matching the condition.
     """
-    results = find_all(condition)
+    results = _scan(condition, sys._getframe(1))
     if not results:
         raise KeyError("Nothing in the database matching {} (expected exactly "
                        "1)".format(condition))
@@ -743,6 +1499,263 @@ def find(condition=(lambda x: True)):
     return results.pop()
 
 
+# Every find_all() or find() examines every object in the database, so they're
+# counted, in total (for scan_totals()) and by the place they were called from
+# (for scan_counts()).
+_scans = 0
+_examined = 0
+# Mapping from (filename, line number, function name) to a list of [calls,
+# objects examined, objects returned].
+_scan_counts = {}
+
+
+def _scan(condition, frame):
+    global _scans, _examined
+    results = set(obj for obj in _objects.values() if condition(obj))
+    _scans += 1
+    _examined += len(_objects)
+    code = frame.f_code
+    site = (code.co_filename, frame.f_lineno, code.co_name)
+    try:
+        counts = _scan_counts[site]
+    except KeyError:
+        counts = _scan_counts[site] = [0, 0, 0]
+    counts[0] += 1
+    counts[1] += len(_objects)
+    counts[2] += len(results)
+    return results
+
+
+def scan_totals():
+    """
+    Return how many times find_all() (or find()) has been called, and how many
+    objects they've examined between them, since startup. Compare before and
+    after to see how much of the database something scans.
+    """
+    return _scans, _examined
+
+
+def scan_counts():
+    """
+    Return how much of the database find_all() and find() have scanned, by
+    where they were called from.
+
+    Returns:
+        A dict mapping (filename, line number, function name) to a tuple of
+        (calls, objects examined, objects returned).
+    """
+    return dict((site, tuple(counts))
+                for site, counts in _scan_counts.items())
+
+
+def reset_scan_counts():
+    """
+    Forget the counts reported by scan_counts(), but not scan_totals().
+    """
+    _scan_counts.clear()
+
+
+def contents_of(obj):
+    """
+    Return a set of all objects in the database located inside the given
+    object. Equivalent to find_all(lambda x: x.location is obj), but uses the
+    location index rather than examining every object.
+    """
+    return set(_contents.get(obj, ()))
+
+
+def listeners_in(obj):
+    """
+    Return a set of the objects in the database located inside the given
+    object which do anything when a line is sent to them: those whose send()
+    isn't Object's, which ignores it. Uses the listener index, which is kept
+    alongside the location index.
+    """
+    return set(_listeners.get(obj, ()))
+
+
+def _is_listener(obj):
+    return (type(obj).send.im_func is not Object.send.im_func
+            or "send" in _getattribute(obj, "__dict__"))
+
+
+def _reindex_listener(obj):
+    """
+    Update the listener index after obj's send attribute has been set or
+    deleted, since that may change whether it's a listener.
+    """
+    location = _getattribute(obj, "_location")
+    if location is None or not _is_stored(obj):
+        return
+    if _is_listener(obj):
+        _listeners.setdefault(location, set()).add(obj)
+    else:
+        _unindex_location(obj, location)
+        _index_location(obj, location)
+
+
+def _reindex_type(obj):
+    """
+    Update the type and player name indexes after obj's type attribute has
+    been set or deleted.
+    """
+    if not _is_stored(obj):
+        return
+    for objects in _types.values():
+        objects.discard(obj)
+    with locks.authority_of(locks.SYSTEM):
+        _unindex_name(obj)
+        try:
+            type_ = obj.type
+        except AttributeError:
+            return
+        _types.setdefault(type_, set()).add(obj)
+        _index_name(obj)
+
+
+# How many times each object's contents have changed, counting renames of the
+# object or anything in it; and how many times the player name index has. A
+# grammar built from these (see parser.Command.args_for) is stale once they
+# change.
+_contents_versions = {}
+_players_version = 0
+
+
+def contents_version(obj):
+    """
+    Return a number that changes whenever anything enters or leaves obj, or obj
+    or anything inside it is renamed.
+    """
+    return _contents_versions.get(obj, 0)
+
+
+def players_version():
+    """
+    Return a number that changes whenever a player is created, renamed, or
+    deleted.
+    """
+    return _players_version
+
+
+def _touch(obj):
+    if obj is not None:
+        _contents_versions[obj] = _contents_versions.get(obj, 0) + 1
+
+
+def objects_of_type(type_):
+    """
+    Return a set of all objects in the database whose type attribute is the
+    given string, e.g. 'player' or 'room'. Equivalent to
+    find_all(lambda x: x.type == type_), but uses the type index rather than
+    examining every object.
+    """
+    return set(_types.get(type_, ()))
+
+
+def _is_stored(obj):
+    """
+    Determine whether this exact object is in the database, as opposed to not
+    yet stored, or deleted.
+    """
+    return obj.uid is not None and _objects.get(obj.uid) is obj
+
+
+def _index_location(obj, location):
+    """
+    Record obj in the location index as being inside location, and in the
+    listener index too if it's a listener.
+    """
+    if location is not None:
+        _contents.setdefault(location, set()).add(obj)
+        _touch(location)
+        if _is_listener(obj):
+            _listeners.setdefault(location, set()).add(obj)
+
+
+def _unindex_location(obj, location):
+    """
+    Remove obj from the location and listener index entries for location, if
+    it's there.
+    """
+    contents = _contents.get(location)
+    if contents is not None:
+        contents.discard(obj)
+        _touch(location)
+        if not contents:
+            del _contents[location]
+    listeners = _listeners.get(location)
+    if listeners is not None:
+        listeners.discard(obj)
+        if not listeners:
+            del _listeners[location]
+
+
+def _index_name(obj):
+    """
+    If obj is a player, record it in the case-folded player name index.
+    """
+    global _players_version
+    if obj.type == 'player':
+        _players_by_name[obj.name.lower()] = obj
+        _players_version += 1
+
+
+def _unindex_name(obj):
+    """
+    Remove obj from the player name index, if it's there.
+    """
+    global _players_version
+    key = obj.name.lower()
+    if _players_by_name.get(key) is obj:
+        del _players_by_name[key]
+        _players_version += 1
+
+
+def _index(obj):
+    """
+    Add a newly stored object to every index.
+    """
+    _index_location(obj, obj.location)
+    _types.setdefault(obj.type, set()).add(obj)
+    _index_name(obj)
+
+
+def _unindex(obj):
+    """
+    Remove an object from every index. Its type may have changed since it was
+    indexed, so check all of them.
+    """
+    _unindex_location(obj, obj.location)
+    for objects in _types.values():
+        objects.discard(obj)
+    _unindex_name(obj)
+
+
+def _rebuild_indexes():
+    """
+    Regenerate the location, type, and player name indexes from scratch, e.g.
+    after restore(). Requires SYSTEM authority.
+    """
+    global _contents, _listeners, _types, _players_by_name, _players_version
+    _players_version += 1
+    _contents = {}
+    _listeners = {}
+    _types = {}
+    _players_by_name = {}
+    for obj in _objects.values():
+        entry = _unloaded.get(obj)
+        if entry is None:
+            _index(obj)
+            continue
+        # Use what the snapshot's index says, rather than loading obj.
+        location, type_, name = entry[4:]
+        if location is not None:
+            _index_location(obj, _objects.get(location))
+        _types.setdefault(type_, set()).add(obj)
+        if type_ == 'player':
+            _players_by_name[name.lower()] = obj
+
+
 def get(uid):
     """
     Return the single object in the database with the given UID. More efficient
@@ -766,11 +1779,11 @@ def player_by_name(name, case_sensitive=False):
         KeyError: Sorry, buddy, there's nobody here by that name.
     """
 
-    if case_sensitive:
-        return find(lambda obj: obj.type == 'player' and obj.name == name)
-    else:
-        return find(lambda obj: obj.type == 'player' and
-                                obj.name.lower() == name.lower())
+    player = _players_by_name.get(name.lower())
+    if player is None or (case_sensitive and player.name != name):
+        raise KeyError("Nothing in the database matching {} (expected exactly "
+                       "1)".format(name))
+    return player
 
 
 def player_name_taken(name):
@@ -778,11 +1791,7 @@ def player_name_taken(name):
     Determine whether there exists a player with a particular name. Returns
     False if player_by_name(name) would raise KeyError.
     """
-    try:
-        player_by_name(name)
-        return True
-    except KeyError:
-        return False
+    return name.lower() in _players_by_name
 
 
 with locks.authority_of(locks.SYSTEM):
@@ -792,13 +1801,18 @@ with locks.authority_of(locks.SYSTEM):
         if e.errno == 2:
             # These ought to be calls to twisted.python.log.msg, but logging
             # hasn't started yet when this module is loaded.
-            print("WARNING: Database file muss.db not found. If MUSS is "
-                  "starting for the first time, this is normal.")
+            print("WARNING: Database file {} not found. If MUSS is "
+                  "starting for the first time, this is normal."
+                  .format(DATABASE_FILE))
         else:
-            print("ERROR: Unable to load database file muss.db. The database "
+            print("ERROR: Unable to load database file {}. The database "
                   "will be populated as if MUSS is starting for the first "
-                  "time.")
+                  "time.".format(DATABASE_FILE))
         _nextUid = 0
         _objects = {}
+        _contents = {}
+        _listeners = {}
+        _types = {}
+        _players_by_name = {}
         lobby = Room("lobby")
         store(lobby)
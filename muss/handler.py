@@ -1,10 +1,11 @@
 import inspect
 import pkgutil
+import sys
 import pyparsing
 
 from twisted.internet import defer
 
-from muss import commands, db, locks, utils, parser
+from muss import commands, db, locks, utils, parser, timing
 
 
 class Mode(object):
@@ -34,11 +35,18 @@ class Mode(object):
         Subclasses are expected to implement this method; the default
         implementation raises NotImplementedError.
 
+        If handling the line means waiting for something (like a password to
+        be checked), return a Deferred; no more lines from the same client
+        are handled until it fires.
+
         Args:
             factory: The instance of server.WorldFactory responsible for
                 maintaining state.
             player: The db.Player that sent the line.
             line: The line that was sent.
+
+        Returns:
+            None, or a Deferred to wait for before handling the next line.
         """
         raise NotImplementedError("Current mode did not override handle()")
 
@@ -60,6 +68,18 @@ class NormalMode(Mode):
         if not line:
             return
 
+        timer = timing.start_line("nospace")
+        try:
+            self._dispatch(player, line, timer)
+        finally:
+            if timer is not None:
+                timer.finish()
+
+    def _dispatch(self, player, line, timer):
+        """
+        Find and run the command for a (stripped, nonblank) line, moving timer
+        (if not None) into each phase as it's reached.
+        """
         split_line = line.split(None, 1)
         if len(split_line) == 1:
             split_line.append("")
@@ -68,15 +88,10 @@ class NormalMode(Mode):
         name = ""
         command = None
 
-        # Check for nospace commands
-        nospace_matches = []
-        for command in all_commands():
-            for name in command().nospace_names:
-                # We can't use find_by_name because we don't know where the
-                # nospace command ends.
-                if line.startswith(name):
-                    # No partial matching, for the same reason.
-                    nospace_matches.append((name, command))
+        # Check for nospace commands. We can't use find_by_name because we
+        # don't know where the nospace command ends, and no partial matching
+        # for the same reason.
+        nospace_matches = registry.find_nospace_prefixes(line)
         if len(nospace_matches) == 1:
             name, command = nospace_matches[0]
             if len(line) > len(name):
@@ -91,6 +106,8 @@ class NormalMode(Mode):
                                                 parser.Command, nospace_matches)
 
                 # Check for normal command matches
+                if timer is not None:
+                    timer.enter("name")
                 pattern = parser.CommandName(fullOnly=True)("command")
                 parse_result = pattern.parseString(first, parseAll=True)
                 matched = parse_result["command"]
@@ -105,9 +122,11 @@ class NormalMode(Mode):
                     name, command = parse_result["command"]
             except parser.NotFoundError as e:
                 # No commands match, what about exits?
+                if timer is not None:
+                    timer.enter("exits")
                 exits = [(exit.name, exit) for exit in
-                         db.find_all(lambda x: x.type == 'exit' and
-                                               x.location == player.location)]
+                         db.contents_of(player.location)
+                         if exit.type == 'exit']
                 try:
                     pattern = parser.OneOf(exits)("exit").setName("exit")
                     parse_result = pattern.parseString(first, parseAll=True)
@@ -129,11 +148,13 @@ class NormalMode(Mode):
             if not nospace_matches:
                 message = e.verbose()
                 # Check whether a require_full command would have matched
-                rf_commands = [c for c in all_commands() if c.require_full]
                 # (ignoring perfect matches because we would have already seen
                 # them)
-                rf_matches = utils.find_by_name(e.pstr, rf_commands,
-                                                attributes=["names"])[1]
+                partial_matches = registry.find_by_name(e.pstr,
+                                                        full_only=True)[1]
+                rf_matches = [(rf_name, rf_command)
+                              for rf_name, rf_command in partial_matches
+                              if rf_command.require_full]
                 if len(rf_matches) == 1:
                     rf_name, rf_command = rf_matches[0]
                     message += (" (If you mean \"{},\" you'll need to use the "
@@ -149,6 +170,8 @@ class NormalMode(Mode):
         except parser.AmbiguityError as e:
             # it's not clear from the name which command the user intended,
             # so see if any of their argument specs match what we got
+            if timer is not None:
+                timer.enter("ambiguity")
             parsable_matches = []
             for possible_name, possible_command in e.matches + nospace_matches:
                 try:
@@ -157,7 +180,7 @@ class NormalMode(Mode):
                         test_arguments = line.split(possible_name, 1)[1]
                     else:
                         test_arguments = rest_of_line
-                    pattern = possible_command.args(player)
+                    pattern = possible_command.args_for(player)
                     args = pattern.parseString(test_arguments, parseAll=True)
                     parsable_matches.append((possible_name, possible_command))
                 except pyparsing.ParseException:
@@ -182,8 +205,14 @@ class NormalMode(Mode):
                 return
 
         # okay! we have a command! let's parse it.
+        if timer is not None:
+            timer.command = command
+            timer.enter("args")
         try:
-            args = command.args(player).parseString(arguments, parseAll=True)
+            args = command.args_for(player).parseString(arguments,
+                                                        parseAll=True)
+            if timer is not None:
+                timer.enter("execute")
             command().execute(player, args)
         except utils.UserError as e:
             if hasattr(e, "verbose"):
@@ -215,6 +244,7 @@ def prompt(player, prompt):
 class LineCaptureMode(Mode):
     """
     Records one line received, then exits itself and calls back the Deferred.
+    If the callbacks wait on another Deferred, so does the player's next line.
 
     If you're trying to prompt the player for input, consider instead the
     prompt function in this module, which uses this Mode.
@@ -227,6 +257,7 @@ class LineCaptureMode(Mode):
     def handle(self, player, line):
         player.exit_mode()
         self.d.callback(line)
+        return self.d
 
 
 def all_command_modules():
@@ -242,15 +273,236 @@ def all_command_modules():
         yield __import__(name, fromlist=[""])
 
 
+def rebind_mode(mode):
+    """
+    If the module defining mode's class has been reloaded since mode was
+    made, make mode an instance of the new class of the same name, so that
+    isinstance() checks against the new class still recognize it.
+    """
+    cls = type(mode)
+    module = sys.modules.get(cls.__module__)
+    new_cls = getattr(module, cls.__name__, None)
+    if (new_cls is cls or not inspect.isclass(new_cls) or
+            not issubclass(new_cls, Mode)):
+        return
+    try:
+        mode.__class__ = new_cls
+    except TypeError:
+        # The new class has a different layout; leave it as it was.
+        pass
+
+
+class NameTrie(object):
+
+    """
+    A prefix tree over (name, value) tuples, which finds perfect and partial
+    matches for a name the same way utils.find_by_name does, in time
+    proportional to the length of the name rather than the number of tuples.
+
+    Every word-suffix of each name is inserted (for "big blue cat": "big blue
+    cat", "blue cat", and "cat"), so a partial match is just a prefix of some
+    path through the tree. Each node remembers every tuple at or below it.
+
+    Args:
+        entries: An iterable of (name, value) tuples to start with.
+        case_sensitive: If False (default), names are compared in lowercase.
+    """
+
+    def __init__(self, entries=(), case_sensitive=False):
+        self.case_sensitive = case_sensitive
+        self._root = _TrieNode()
+        for name, value in entries:
+            self.add(name, value)
+
+    def _key(self, name):
+        if self.case_sensitive:
+            return name
+        else:
+            return name.lower()
+
+    def add(self, name, value):
+        """
+        Insert a (name, value) tuple.
+        """
+        entry = (name, value)
+        key = self._key(name)
+        starts = [0] + [i + 1 for i, char in enumerate(key) if char == " "]
+        for start in starts:
+            node = self._root
+            node.add_below(entry)
+            for char in key[start:]:
+                node = node.children.setdefault(char, _TrieNode())
+                node.add_below(entry)
+            if start == 0:
+                node.here.append(entry)
+
+    def find(self, name):
+        """
+        Return two lists of (name, value) tuples: those whose name exactly
+        matches the given name, and those which partially match it (see
+        utils.find_by_name).
+        """
+        node = self._root
+        for char in self._key(name):
+            node = node.children.get(char)
+            if node is None:
+                return ([], [])
+        perfect_matches = list(node.here)
+        partial_matches = [entry for entry in node.below
+                           if entry not in perfect_matches]
+        return (perfect_matches, partial_matches)
+
+    def find_prefixes(self, string):
+        """
+        Return a list of the (name, value) tuples whose whole name is a prefix
+        of the given string, shortest first.
+        """
+        matches = []
+        node = self._root
+        matches.extend(node.here)
+        for char in self._key(string):
+            node = node.children.get(char)
+            if node is None:
+                break
+            matches.extend(node.here)
+        return matches
+
+
+class _TrieNode(object):
+    """
+    Storage for NameTrie.
+
+    Attributes:
+        children: A dict mapping characters to child nodes.
+        here: The entries whose whole name ends at this node.
+        below: The entries with any inserted suffix passing through this node.
+    """
+    __slots__ = ["children", "here", "below", "_below_set"]
+
+    def __init__(self):
+        self.children = {}
+        self.here = []
+        self.below = []
+        self._below_set = set()
+
+    def add_below(self, entry):
+        if entry not in self._below_set:
+            self._below_set.add(entry)
+            self.below.append(entry)
+
+
+class CommandRegistry(object):
+
+    """
+    Every command class defined in muss.commands, along with tables of their
+    names, so that handling a line doesn't require walking the package.
+
+    The registry loads itself the first time it's used (the server also loads
+    it explicitly at startup) and after that only changes when load() is
+    called again.
+
+    Args:
+        commands: If given, a list of command classes to use instead of
+            walking muss.commands. (load() will still walk the package.)
+
+    Attributes:
+        commands: A list of every command class.
+        names: A list of (name, command) tuples, one for each name of each
+            command.
+        nospace_names: A list of (nospace name, command) tuples, likewise.
+    """
+
+    def __init__(self, commands=None):
+        self._commands = None
+        if commands is not None:
+            self._index(commands)
+
+    def load(self, reload_modules=False):
+        """
+        Walk muss.commands and rebuild the registry from scratch.
+
+        Args:
+            reload_modules: If True, also reload every command module, so that
+                changes to their source take effect without a restart.
+        """
+        command_list = []
+        for module in all_command_modules():
+            if reload_modules:
+                module = reload(module)
+            for name in dir(module):
+                cls = getattr(module, name)
+                if (inspect.isclass(cls) and issubclass(cls, parser.Command) and
+                        cls is not parser.Command and cls not in command_list):
+                    command_list.append(cls)
+        self._index(command_list)
+
+    def _index(self, command_list):
+        names = []
+        nospace_names = []
+        for command in command_list:
+            instance = command()
+            names.extend((name, command) for name in instance.names)
+            nospace_names.extend((name, command)
+                                 for name in instance.nospace_names)
+
+        self._commands = command_list
+        self._names = names
+        self._nospace_names = nospace_names
+        self._name_trie = NameTrie(names)
+        self._any_name_trie = NameTrie(names + nospace_names)
+        self._nospace_trie = NameTrie(nospace_names, case_sensitive=True)
+
+    @property
+    def commands(self):
+        if self._commands is None:
+            self.load()
+        return self._commands
+
+    @property
+    def names(self):
+        if self._commands is None:
+            self.load()
+        return self._names
+
+    @property
+    def nospace_names(self):
+        if self._commands is None:
+            self.load()
+        return self._nospace_names
+
+    def find_by_name(self, name, full_only=False):
+        """
+        Find commands by name, case-insensitively. Equivalent to calling
+        utils.find_by_name on every command class with attributes ["names"]
+        (if full_only is set) or ["names", "nospace_names"], without
+        instantiating them all.
+
+        Returns two lists of (name, command) tuples, for perfect and partial
+        matches.
+        """
+        if self._commands is None:
+            self.load()
+        if full_only:
+            return self._name_trie.find(name)
+        else:
+            return self._any_name_trie.find(name)
+
+    def find_nospace_prefixes(self, line):
+        """
+        Return a list of (nospace name, command) tuples for every nospace name
+        the line begins with (case-sensitively).
+        """
+        if self._commands is None:
+            self.load()
+        return self._nospace_trie.find_prefixes(line)
+
+
+registry = CommandRegistry()
+
+
 def all_commands():
     """
-    Returns a generator yielding every command class defined in every module in
+    Returns a list of every command class defined in every module in
     muss.commands.
     """
-
-    for module in all_command_modules():
-        for name in dir(module):
-            cls = getattr(module, name)
-            if (inspect.isclass(cls) and issubclass(cls, parser.Command) and
-                    cls is not parser.Command):
-                yield cls
+    return registry.commands
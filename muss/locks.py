@@ -1,16 +1,24 @@
 import contextlib
+import functools
+import threading
 
 from muss import utils
 
 
-_authority = None
+class _Context(threading.local):
+    # The current authority belongs to whatever thread is running, so that
+    # commands handled on other threads can't see or disturb each other's.
+    authority = None
+
+
+_context = _Context()
 
 
 def authority():
     """
     Who is the current authority?
     """
-    return _authority
+    return _context.authority
 
 
 @contextlib.contextmanager
@@ -25,22 +33,85 @@ def authority_of(player):
         locked_action(x)  # Allowed, if Alice passes the lock.
         locked_action(y)  # Raises LockFailedError, if Alice fails the lock.
 
+    The authority only applies to the thread that declared it. Code that runs
+    later -- a Deferred's callback, or a function passed to another thread --
+    doesn't inherit it; wrap it with bind_authority() for that.
+
     Args:
         player: The player to be passed to all locks inside the "with"
             statement.
     """
-    global _authority
-
-    old_authority, _authority = _authority, player
+    old_authority, _context.authority = _context.authority, player
     try:
         yield
     finally:
-        _authority = old_authority
+        _context.authority = old_authority
+
+
+def bind_authority(func):
+    """
+    Return a function which calls func with the authority that's current now,
+    whenever and on whichever thread it's eventually called. Use it for
+    callbacks:
+
+    with authority_of(alice):
+        d.addCallback(bind_authority(locked_action))  # Checked against Alice.
+    """
+    player = authority()
+
+    @functools.wraps(func)
+    def bound(*args, **kwargs):
+        with authority_of(player):
+            return func(*args, **kwargs)
+    return bound
+
+
+class _System(object):
+    def __repr__(self):
+        return "SYSTEM"
+
+    def __reduce__(self):
+        # Pickle by reference, so the unpickled SYSTEM is still SYSTEM.
+        return "SYSTEM"
 
 
 # If this is the current authority, no locks are checked; everything is
 # permitted.
-SYSTEM = object()
+SYSTEM = _System()
+
+
+# Lock results are remembered, keyed by (lock, player, generation), until
+# anything a lock might depend on changes: an object's owner or location, or
+# the existence or ownership of an attribute. Whatever makes one of those
+# changes calls invalidate(), which starts a new generation. Only locks whose
+# results depend on nothing else (those with cacheable set) are remembered.
+#
+# Locks may be checked on any thread, so a check can overlap an invalidate()
+# on another. Each check uses the generation as it was when the check began,
+# both to look results up and to store them, and doesn't store one at all if
+# the generation has moved on by the time it's done. So a result computed
+# from state that's since changed is never found by a later check.
+_generation = 0
+_results = {}
+_results_generation = 0
+# Once this many results are remembered, start over.
+CACHE_SIZE = 65536
+
+
+def generation():
+    """
+    Return a number that changes whenever a lock's result might have.
+    """
+    return _generation
+
+
+def invalidate():
+    """
+    Note that something a lock might depend on has changed, so every
+    remembered result is stale.
+    """
+    global _generation
+    _generation += 1
 
 
 class AttributeLock(object):
@@ -64,10 +135,18 @@ class AttributeLock(object):
             AttributeLock is created)
         get_lock: the Lock which must be passed to read the attribute (defaults
             to Pass())
-        set_lock: the Lock which must be passed to write to the attribute
-            (defaults to Is(owner), but you may want to set it explicitly to an
-            OwnsAttribute lock on the attribute, in case ownership changes)
+        set_lock: the Lock which must be passed to write to the attribute, or
+            None (the default) if only the attribute's owner may write it,
+            whoever that is at the time. Use may_set() to check it.
+        unguarded: True if get_lock is a plain Pass(), so reading the
+            attribute needn't check it at all. Kept up to date by assigning
+            get_lock.
     """
+
+    # There's one of these for every attribute of every object, so keep them
+    # small.
+    __slots__ = ("owner", "_get_lock", "set_lock", "unguarded")
+
     def __init__(self, owner=None, get_lock=None, set_lock=None):
         if owner is not None:
             self.owner = owner
@@ -79,23 +158,76 @@ class AttributeLock(object):
         else:
             self.get_lock = Pass()
 
-        if set_lock is not None:
-            self.set_lock = set_lock
-        else:
-            self.set_lock = Is(owner)
+        self.set_lock = set_lock
+
+    def __setattr__(self, attr, value):
+        super(AttributeLock, self).__setattr__(attr, value)
+        if attr == "owner":
+            # OwnsAttribute locks depend on this.
+            invalidate()
+
+    @property
+    def get_lock(self):
+        return self._get_lock
+
+    @get_lock.setter
+    def get_lock(self, lock):
+        self._get_lock = lock
+        self.unguarded = type(lock) is Pass
+
+    def may_set(self, player=None):
+        """
+        Returns True if the given player (by default, the current authority)
+        may write to the attribute.
+        """
+        if self.set_lock is not None:
+            return self.set_lock(player)
+        if player is None:
+            player = authority()
+            if player is None:
+                raise MissingAuthorityError
+        return player is SYSTEM or player is self.owner
+
+    def __getstate__(self):
+        return {"owner": self.owner, "get_lock": self._get_lock,
+                "set_lock": self.set_lock}
+
+    def __setstate__(self, state):
+        # Older saves have _get_lock and unguarded in place of get_lock, and
+        # always have a set_lock.
+        self.owner = state["owner"]
+        self.get_lock = state.get("get_lock", state.get("_get_lock"))
+        self.set_lock = state.get("set_lock")
 
 
 class Lock(object):
     """
     Superclass of all lock types: rules for determining whether a particular
     action is available to a particular player.
+
+    Locks are compiled (see compile()) the first time they're checked, so
+    they shouldn't be changed after that; make a new one instead.
+
+    Subclasses should declare __slots__ for their own attributes, since there
+    are a lot of locks around.
+
+    Attributes:
+        cacheable: True if the result depends only on the lock, the player,
+            and the things that call invalidate() when they change, so it can
+            be remembered until the next invalidate(). Defaults to False.
     """
 
+    __slots__ = ("_compiled",)
+
+    cacheable = False
+
     def __call__(self, player=None):
         """
         Returns True if the given player passes this lock, False otherwise.
         Defaults to checking against the current authority.
         """
+        global _results_generation
+
         if player is None:
             if authority() is None:
                 raise MissingAuthorityError
@@ -104,25 +236,80 @@ class Lock(object):
 
         if player is SYSTEM:
             return True
-        else:
+        try:
+            predicate = self._compiled
+        except AttributeError:
+            predicate = self._compiled = self.compile()
+        if not self.cacheable:
             with authority_of(SYSTEM):
-                return self.check(player)
+                return predicate(player)
+
+        generation = _generation
+        if _results_generation < generation:
+            _results.clear()
+            _results_generation = generation
+        key = (self, player, generation)
+        try:
+            return _results[key]
+        except KeyError:
+            pass
+        with authority_of(SYSTEM):
+            result = predicate(player)
+        if _generation == generation:
+            if len(_results) >= CACHE_SIZE:
+                _results.clear()
+            _results[key] = result
+        return result
 
     def check(self, player):
         raise NotImplementedError
 
+    def compile(self):
+        """
+        Return a function which takes a player and returns the same thing as
+        check(player), for __call__ to use. It's called with SYSTEM authority
+        already in effect, so a lock made of other locks can check them all
+        in one go, without switching authority for each one.
+
+        By default, this is just check. Subclasses may override it to return
+        something quicker, and must if they override __call__ instead of
+        check.
+        """
+        return self.check
+
+    def __getstate__(self):
+        state = dict(getattr(self, "__dict__", ()))
+        for cls in type(self).__mro__:
+            for attr in cls.__dict__.get("__slots__", ()):
+                if hasattr(self, attr):
+                    state[attr] = getattr(self, attr)
+        state.pop("_compiled", None)
+        return state
+
+    def __setstate__(self, state):
+        for attr, value in state.iteritems():
+            setattr(self, attr, value)
+
 
 class Is(Lock):
     """
     Passes only for the given player.
     """
 
+    __slots__ = ("trustee",)
+
+    cacheable = True
+
     def __init__(self, trustee):
         self.trustee = trustee
 
     def check(self, player):
         return (self.trustee is player)
 
+    def compile(self):
+        trustee = self.trustee
+        return lambda player: trustee is player
+
     def __repr__(self):
         return "Is({!r})".format(self.trustee)
 
@@ -134,12 +321,18 @@ class In(Lock):
     creation time.
     """
 
+    __slots__ = ("trustees",)
+
     def __init__(self, trustees):
         self.trustees = trustees
 
     def check(self, player):
         return (player in self.trustees)
 
+    def compile(self):
+        trustees = self.trustees
+        return lambda player: player in trustees
+
     def __repr__(self):
         return "In({!r})".format(self.trustees)
 
@@ -149,12 +342,20 @@ class Has(Lock):
     Passes iff the player is holding the given object.
     """
 
+    __slots__ = ("key",)
+
+    cacheable = True
+
     def __init__(self, key):
         self.key = key
 
     def check(self, player):
         return (self.key.location is player)
 
+    def compile(self):
+        key = self.key
+        return lambda player: key.location is player
+
     def __repr__(self):
         return "Has({!r})".format(self.key)
 
@@ -164,12 +365,20 @@ class Owns(Lock):
     Passes iff the player is the owner of the given object.
     """
 
+    __slots__ = ("prop",)
+
+    cacheable = True
+
     def __init__(self, prop):
         self.prop = prop
 
     def check(self, player):
         return (self.prop.owner is player)
 
+    def compile(self):
+        prop = self.prop
+        return lambda player: prop.owner is player
+
     def __repr__(self):
         return "Owns({!r})".format(self.prop)
 
@@ -179,6 +388,10 @@ class OwnsAttribute(Lock):
     Passes iff the player is the owner of the given attribute.
     """
 
+    __slots__ = ("obj", "attr")
+
+    cacheable = True
+
     def __init__(self, obj, attr):
         self.obj = obj
         self.attr = attr
@@ -190,6 +403,16 @@ class OwnsAttribute(Lock):
             # If the attr doesn't exist, the lock fails.
             return False
 
+    def compile(self):
+        obj, attr = self.obj, self.attr
+
+        def check(player):
+            try:
+                return obj.attr_locks[attr].owner is player
+            except KeyError:
+                return False
+        return check
+
     def __repr__(self):
         return "OwnsAttribute({!r}, {}".format(self.obj, self.attr)
 
@@ -199,8 +422,11 @@ class And(Lock):
     Passes iff all of the given locks pass.
     """
 
+    __slots__ = ("locks", "cacheable")
+
     def __init__(self, *locks):
         self.locks = locks
+        self.cacheable = all(lock.cacheable for lock in locks)
 
     def check(self, player):
         for lock in self.locks:
@@ -209,6 +435,21 @@ class And(Lock):
         else:
             return True
 
+    def compile(self):
+        predicates = [lock.compile() for lock in self.locks]
+
+        def check(player):
+            for predicate in predicates:
+                if not predicate(player):
+                    return False
+            return True
+        return check
+
+    def __setstate__(self, state):
+        super(And, self).__setstate__(state)
+        # Locks saved before cacheable existed don't have it.
+        self.cacheable = all(lock.cacheable for lock in self.locks)
+
     def __repr__(self):
         return " & ".join("({!r})".format(lock) if isinstance(lock, Or)
                           else repr(lock) for lock in self.locks)
@@ -218,8 +459,11 @@ class Or(Lock):
     Passes iff any of the given locks passes.
     """
 
+    __slots__ = ("locks", "cacheable")
+
     def __init__(self, *locks):
         self.locks = locks
+        self.cacheable = all(lock.cacheable for lock in locks)
 
     def check(self, player):
         for lock in self.locks:
@@ -228,6 +472,20 @@ class Or(Lock):
         else:
             return False
 
+    def compile(self):
+        predicates = [lock.compile() for lock in self.locks]
+
+        def check(player):
+            for predicate in predicates:
+                if predicate(player):
+                    return True
+            return False
+        return check
+
+    def __setstate__(self, state):
+        super(Or, self).__setstate__(state)
+        self.cacheable = all(lock.cacheable for lock in self.locks)
+
     def __repr__(self):
         return " | ".join("({!r})".format(lock) if isinstance(lock, And)
                           else repr(lock) for lock in self.locks)
@@ -238,39 +496,81 @@ class Not(Lock):
     Passes iff the given lock fails.
     """
 
+    __slots__ = ("lock", "cacheable")
+
     def __init__(self, lock):
         self.lock = lock
+        self.cacheable = lock.cacheable
 
     def check(self, player):
         return not self.lock(player)
 
+    def compile(self):
+        predicate = self.lock.compile()
+        return lambda player: not predicate(player)
+
+    def __setstate__(self, state):
+        super(Not, self).__setstate__(state)
+        self.cacheable = self.lock.cacheable
+
     def __repr__(self):
         return "Not({!r})".format(self.lock)
 
 
-class Pass(Lock):
+class _Constant(Lock):
+    """
+    A lock with no attributes of its own, so every instance of it would be
+    alike. They all share one instance instead.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls):
+        instance = cls.__dict__.get("_instance")
+        if instance is None:
+            instance = super(_Constant, cls).__new__(cls)
+            cls._instance = instance
+        return instance
+
+    def __reduce__(self):
+        return (type(self), ())
+
+
+class Pass(_Constant):
     """
     Always passes.
     """
 
+    __slots__ = ()
+
     def __call__(self, player=None):
         # Override default behavior; doesn't matter what the authority is, or
         # even if there is authority, just pass.
         return True
 
+    def compile(self):
+        return lambda player: True
+
     def __repr__(self):
         return "Pass()"
 
 
-class Fail(Lock):
+class Fail(_Constant):
     """
     Always fails, except for SYSTEM (in which case the lock should not be
     checked).
     """
 
+    __slots__ = ()
+
+    cacheable = True
+
     def check(self, player):
         return False
 
+    def compile(self):
+        return lambda player: False
+
     def __repr__(self):
         return "Fail()"
 
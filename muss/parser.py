@@ -247,8 +247,7 @@ def location_options(location):
     """
     if not isinstance(location, db.Object):
         raise TypeError("Invalid location: {}".format(location))
-    return [(obj.name, obj)
-            for obj in db.find_all(lambda obj: obj.location == location)]
+    return [(obj.name, obj) for obj in db.contents_of(location)]
 
 
 def ObjectIn(*locations, **kwargs):
@@ -517,22 +516,14 @@ class CommandName(pyp.Word):
         loc, text = super(CommandName, self).parseImpl(instring, loc, doActions)
         test_name = text.lower()
         try:
-            if self.fullOnly:
-                attributes = ["names"]
-            else:
-                attributes = ["names", "nospace_names"]
-            from muss.handler import all_commands
-            perfect_matches, partial_matches = utils.find_by_name(
-                test_name, all_commands(), attributes=attributes)
-            adjusted_perfect = [x[1] for x in perfect_matches]
-            adjusted_partial = []
-            for match_tuple in partial_matches:
-                name, command = match_tuple
-                if not command.require_full:
-                    adjusted_partial.append(command)
-            matches = adjusted_perfect + adjusted_partial
-            command_tuple = utils.find_one(test_name, matches,
-                                           attributes=attributes)
+            from muss.handler import registry
+            perfect_matches, partial_matches = registry.find_by_name(
+                test_name, full_only=self.fullOnly)
+            partial_matches = [(name, command)
+                               for name, command in partial_matches
+                               if not command.require_full]
+            command_tuple = utils.best_match(test_name, perfect_matches,
+                                             partial_matches)
             return loc, (command_tuple,)
         except MatchError as exc:
             exc.token = "command"
@@ -543,7 +534,7 @@ class CommandName(pyp.Word):
 class PlayerName(OneOf):
     def __init__(self):
         super(PlayerName, self).__init__(
-            [(p.name, p) for p in db.find_all(lambda p: p.type == 'player')],
+            [(p.name, p) for p in db.objects_of_type('player')],
             pyp.Word(pyp.alphas))
         self.setName('player')
 
@@ -576,6 +567,13 @@ class ReachableOrUid(pyp.Token):
                 raise e
 
 
+# Maps (command class, player) to the argument grammar most recently built for
+# them, with the state of the world it was built from. See Command.args_for.
+_grammar_cache = {}
+# Once the cache holds this many grammars, start over.
+GRAMMAR_CACHE_SIZE = 4096
+
+
 class Command(object):
     """
     The superclass for all commands -- local or global, built-in or
@@ -586,6 +584,11 @@ class Command(object):
     # matches.
     require_full = False
 
+    # Whether args() depends only on the player, the player's location, the
+    # names of those and the things in them, and the set of players, so that
+    # args_for() may reuse its grammar as long as none of those change.
+    cache_args = True
+
     @classmethod
     def args(cls, player):
         """
@@ -596,6 +599,29 @@ class Command(object):
         # By default, accept no arguments
         return pyp.LineEnd()
 
+    @classmethod
+    def args_for(cls, player):
+        """
+        Return args(player), reusing the grammar from last time if the player
+        hasn't moved and nothing has entered, left, or been renamed in their
+        location or inventory since. (Unless cache_args is False.)
+        """
+        if not cls.cache_args:
+            return cls.args(player)
+        location = player.location
+        state = (location, db.contents_version(player),
+                 db.contents_version(location), db.players_version())
+        key = (cls, player)
+        cached = _grammar_cache.get(key)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+
+        grammar = cls.args(player)
+        if len(_grammar_cache) >= GRAMMAR_CACHE_SIZE:
+            _grammar_cache.clear()
+        _grammar_cache[key] = (state, grammar)
+        return grammar
+
     @property
     def names(self):
         if hasattr(self, "name"):
@@ -1,10 +1,64 @@
-import traceback
+import collections
+import contextlib
+import re
+import timeit
 
 from twisted.conch import telnet
-from twisted.internet import protocol, reactor
-from twisted.python import log
+from twisted.internet import defer, protocol, reactor
+from twisted.python import failure, log
 
-from muss import db, handler, locks
+from muss import db, handler, locks, timing
+
+
+# Telnet clients end lines with \r\n or \r\0; others just send \n.
+_DELIMITER = re.compile(r"\r?\n|\r\0")
+
+# While coalesced_output() is active, a list of the protocols holding output.
+_coalescing = None
+# How many noncritical_output() blocks are active.
+_noncritical = 0
+
+# What a LineTelnetProtocol does when more than its HIGH_WATER bytes of output
+# are waiting for a slow client (see LineTelnetProtocol.OVERFLOW_POLICY).
+DROP_OLDEST = "drop oldest"
+DROP_NONCRITICAL = "drop noncritical"
+DISCONNECT = "disconnect"
+
+
+@contextlib.contextmanager
+def coalesced_output():
+    """
+    Hold every line sent to any LineTelnetProtocol within this block, then
+    write out each protocol's lines with a single writeSequence call at the
+    end. Nested blocks are part of the outermost one.
+    """
+    global _coalescing
+    if _coalescing is not None:
+        yield
+        return
+
+    _coalescing = []
+    try:
+        yield
+    finally:
+        protocols, _coalescing = _coalescing, None
+        for protocol in protocols:
+            protocol.flushOutput()
+
+
+@contextlib.contextmanager
+def noncritical_output():
+    """
+    Mark every line sent to any LineTelnetProtocol within this block as one a
+    client that's fallen behind can do without, like channel chatter. See
+    LineTelnetProtocol.OVERFLOW_POLICY.
+    """
+    global _noncritical
+    _noncritical += 1
+    try:
+        yield
+    finally:
+        _noncritical -= 1
 
 
 class LineTelnetProtocol(telnet.TelnetProtocol):
@@ -12,28 +66,202 @@ class LineTelnetProtocol(telnet.TelnetProtocol):
     Using an underlying TelnetProtocol for telnet-specific functionality like
     feature negotiation, split everything up into lines in the style of
     Twisted's own LineReceiver.
+
+    The protocol registers itself as a producer with its transport, so it
+    hears when the client stops reading and the transport's buffer fills up.
+    Until the transport catches up, output waits in the protocol's own queue.
+
+    Attributes:
+        MAX_LENGTH: The longest line, in bytes, we'll accept. Anything longer
+            is thrown away, and lineLengthExceeded() is called instead of
+            lineReceived().
+        HIGH_WATER: The most output, in bytes, to queue for a client that's
+            fallen behind before applying OVERFLOW_POLICY.
+        OVERFLOW_POLICY: What to do when the queue passes HIGH_WATER.
+            DROP_OLDEST throws away the oldest queued lines. DROP_NONCRITICAL
+            also stops queueing lines sent in noncritical_output() blocks as
+            soon as the client falls behind, then drops the oldest as above.
+            DISCONNECT drops the connection.
+        queuedBytes: How much output is queued now.
+        peakQueuedBytes: The most output that's ever been queued at once.
+        droppedLines, droppedBytes: How much output has been thrown away.
     """
+    MAX_LENGTH = 16384
+    HIGH_WATER = 65536
+    OVERFLOW_POLICY = DROP_OLDEST
+
     def __init__(self):
-        self._buffer = ""
+        self._pieces = []  # The incomplete line received so far
+        self._length = 0  # The total length of _pieces
+        self._overflow = False  # Whether we're discarding an overlong line
+        self._carriage_return = False  # Whether the last byte was a held \r
+        self._output = []
+        self._paused = False  # Whether the transport has asked us to wait
+        self._queue = collections.deque()  # Output waiting for the transport
+        self._droppedSincePause = 0  # Lines thrown away since we last paused
+        self._registered = False  # Whether we're the transport's producer
+        self._aborting = False  # Whether we've given up on the connection
+        self.queuedBytes = 0
+        self.peakQueuedBytes = 0
+        self.droppedLines = 0
+        self.droppedBytes = 0
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+        self._registered = True
+
+    def connectionLost(self, reason):
+        self._unregister()
+
+    def _unregister(self):
+        if self._registered:
+            self._registered = False
+            self.transport.unregisterProducer()
 
     def dataReceived(self, data):
         """
         Buffer incoming data. When one or more complete lines are received,
-        strip them from the buffer and pass them individually to lineReceived,
-        sans delimiter.
+        pass them individually to lineReceived, sans delimiter. A line may end
+        with \r\n, \n, or \r\0.
+
+        Only the new data is searched for delimiters, and no more than
+        MAX_LENGTH bytes of an incomplete line are kept, so a client can't
+        cost us more than its own bandwidth's worth of work or memory.
+        """
+        if self._carriage_return:
+            data = "\r" + data
+        # Hold onto a trailing \r until we know what comes after it.
+        self._carriage_return = data.endswith("\r")
+        if self._carriage_return:
+            data = data[:-1]
+
+        start = 0
+        for match in _DELIMITER.finditer(data):
+            piece = data[start:match.start()]
+            start = match.end()
+            overflow = (self._overflow or
+                        self._length + len(piece) > self.MAX_LENGTH)
+            self._pieces.append(piece)
+            line = "".join(self._pieces)
+            self._pieces = []
+            self._length = 0
+            self._overflow = False
+            if overflow:
+                self.lineLengthExceeded()
+            else:
+                self.lineReceived(line)
+
+        rest = data[start:]
+        if self._overflow:
+            return
+        if self._length + len(rest) > self.MAX_LENGTH:
+            self._pieces = []
+            self._length = 0
+            self._overflow = True
+        elif rest:
+            self._pieces.append(rest)
+            self._length += len(rest)
+
+    def lineLengthExceeded(self):
         """
-        self._buffer += data
-        # TODO: handle the various line delimiters well
-        lines = self._buffer.split("\r\n")
-        for line in lines[:-1]:
-            self.lineReceived(line)
-        self._buffer = lines[-1]
+        Called in place of lineReceived when a line longer than MAX_LENGTH is
+        received.
+        """
+        self.sendLine("That line was too long, so it was ignored.")
 
     def sendLine(self, line):
         """
-        Slap a delimiter on it and ship it out.
+        Slap a delimiter on it and ship it out, or hold onto it until the end
+        of the current coalesced_output() block, if any.
+        """
+        if (_noncritical and self._paused
+                and self.OVERFLOW_POLICY == DROP_NONCRITICAL):
+            self._drop(line + "\r\n")
+            return
+        if _coalescing is None:
+            if self._paused:
+                self._enqueue([line + "\r\n"])
+            else:
+                self.transport.write(line + "\r\n")
+            return
+        if not self._output:
+            _coalescing.append(self)
+        self._output.append(line + "\r\n")
+
+    def flushOutput(self):
+        """
+        Write out all the lines being held, at once.
+        """
+        if self._output:
+            output, self._output = self._output, []
+            if self._paused:
+                self._enqueue(output)
+            else:
+                self.transport.writeSequence(output)
+
+    def _enqueue(self, output):
+        if self._aborting:
+            # The connection is on its way down; nothing more will be sent.
+            return
+        self._queue.extend(output)
+        self.queuedBytes += sum(len(data) for data in output)
+        self.peakQueuedBytes = max(self.peakQueuedBytes, self.queuedBytes)
+        if self.queuedBytes <= self.HIGH_WATER:
+            return
+
+        if self.OVERFLOW_POLICY == DISCONNECT:
+            log.msg("Disconnecting {}: {} bytes of output waiting."
+                    .format(self.transport.getPeer(), self.queuedBytes))
+            self._aborting = True
+            self.stopProducing()
+            self.transport.abortConnection()
+            return
+        while self.queuedBytes > self.HIGH_WATER:
+            data = self._queue.popleft()
+            self.queuedBytes -= len(data)
+            self._drop(data)
+
+    def _drop(self, data):
+        self.droppedLines += 1
+        self.droppedBytes += len(data)
+        self._droppedSincePause += 1
+
+    def pauseProducing(self):
+        """
+        Called by the transport when the client has fallen behind. Queue
+        output until resumeProducing() is called.
+        """
+        self._paused = True
+
+    def resumeProducing(self):
+        """
+        Called by the transport when the client has caught up. Write out
+        everything queued, noting any lines that were thrown away.
+        """
+        self._paused = False
+        output = list(self._queue)
+        if self._droppedSincePause == 1:
+            output.insert(0, "[1 line of output was dropped because it "
+                          "couldn't be sent fast enough.]\r\n")
+        elif self._droppedSincePause:
+            output.insert(0, "[{} lines of output were dropped because they "
+                          "couldn't be sent fast enough.]\r\n"
+                          .format(self._droppedSincePause))
+        self._droppedSincePause = 0
+        self._queue.clear()
+        self.queuedBytes = 0
+        if output:
+            self.transport.writeSequence(output)
+
+    def stopProducing(self):
         """
-        self.transport.write(line + "\r\n")
+        Called by the transport when the connection is closed. Forget any
+        queued output, and stop being its producer.
+        """
+        self._paused = True
+        self._queue.clear()
+        self.queuedBytes = 0
+        self._unregister()
 
 
 class WorldProtocol(LineTelnetProtocol):
@@ -46,10 +274,20 @@ class WorldProtocol(LineTelnetProtocol):
     Attributes:
         player: The Player at the other end (or None if we're in LoginMode or
             AccountCreateMode).
+        SLOW_LINE: Any line that takes longer than this many seconds to handle
+            is logged, along with the command it ran, how long each phase of
+            handling it took (if timing.ENABLED), and how much of the
+            database it scanned. None to log nothing.
     """
 
+    SLOW_LINE = 0.1
+
     def __init__(self):
         LineTelnetProtocol.__init__(self)
+        # Lines received while waiting for a mode to finish with an earlier
+        # one (see handler.Mode.handle), to be handled in order after it does.
+        self._held_lines = collections.deque()
+        self._waiting = False
 
         class DummyPlayer:
             def __init__(self):
@@ -72,37 +310,113 @@ class WorldProtocol(LineTelnetProtocol):
 
     def connectionMade(self):
         """Respond to a new connection by dropping directly into LoginMode."""
-        self.player.enter_mode(LoginMode(self))
+        LineTelnetProtocol.connectionMade(self)
+        with coalesced_output():
+            self.player.enter_mode(LoginMode(self))
 
     def lineReceived(self, line):
         """
         Respond to a received line by passing to whatever mode is current.
+        Everything sent to anyone as a result goes out together at the end.
+        If the mode is still busy with an earlier line, wait for it first.
 
         Args:
             line: The line received, without a trailing delimiter.
         """
-        try:
-            with locks.authority_of(self.player):
-                self.player.mode.handle(self.player, line)
-        except Exception:
-            # Exceptions are supposed to be caught somewhere lower down and
-            # handled specifically. If we catch one here, it's a code error.
-            log.err()
-
-            if hasattr(self.player, "debug") and self.player.debug:
-                for line in traceback.format_exc().split("\n"):
-                    self.player.send(line)
-            else:
-                self.player.send("Sorry! Something went wrong. We'll look into "
-                                 "it.")
+        self._held_lines.append(line)
+        if not self._waiting:
+            with coalesced_output():
+                self._handleHeldLines()
+
+    def _handleHeldLines(self):
+        while self._held_lines and not self._waiting:
+            self._handleLine(self._held_lines.popleft())
+
+    def _handleLine(self, line):
+        player = self.player
+        mode = player.mode
+        start = timeit.default_timer()
+        scans = db.scan_totals()
+        with timing.capture() as timers:
+            try:
+                with locks.authority_of(player):
+                    result = mode.handle(player, line)
+            except Exception:
+                self._reportError(failure.Failure())
+                result = None
+        elapsed = timeit.default_timer() - start
+        if self.SLOW_LINE is not None and elapsed > self.SLOW_LINE:
+            self._logSlowLine(line, player, mode, elapsed, timers, scans)
+
+        if isinstance(result, defer.Deferred):
+            self._waiting = True
+            # Stop reading from the client until it fires, so lines can't pile
+            # up in _held_lines in the meantime.
+            self.transport.pauseProducing()
+            result.addErrback(self._reportError)
+            result.addBoth(self._lineHandled)
+            return
+        self._finishLine()
 
+    def _logSlowLine(self, line, player, mode, elapsed, timers, scans):
+        """
+        Log what we know about a line that took elapsed seconds to handle.
+        """
+        scans_now, examined_now = db.scan_totals()
+        parts = ["Slow line from {} in {}: {:.1f} ms".format(
+            getattr(player, "name", "a new connection"),
+            type(mode).__name__, elapsed * 1e3)]
+        # Other modes might be reading passwords.
+        if isinstance(mode, handler.NormalMode):
+            parts.append("line {!r}".format(line))
+        if timers:
+            # The last one to finish is the line itself, rather than one it
+            # handled on someone's behalf.
+            timer = timers[-1]
+            parts.append("command {}".format(timer.command_name()))
+            parts.append("phases {} ms".format(timer.breakdown()))
+        parts.append("{} find_all scans of {} objects".format(
+            scans_now - scans[0], examined_now - scans[1]))
+        log.msg("; ".join(parts))
+
+    def _lineHandled(self, result):
+        """
+        Called when the Deferred returned by a mode fires, to finish up its
+        line and go on to any held since.
+        """
+        self._waiting = False
+        if not self.connected or not self.player.mode_stack:
+            # The client left while we were waiting; there's nothing to
+            # finish, and no one to finish it for.
+            return
+        self.transport.resumeProducing()
+        with coalesced_output():
+            self._finishLine()
+            self._handleHeldLines()
+
+    def _finishLine(self):
         if self.player.mode.blank_line:
             self.player.send("")
 
+    def _reportError(self, reason):
+        # Exceptions are supposed to be caught somewhere lower down and
+        # handled specifically. If we catch one here, it's a code error.
+        log.err(reason)
+
+        if hasattr(self.player, "debug") and self.player.debug:
+            for line in reason.getTraceback().split("\n"):
+                self.player.send(line)
+        else:
+            self.player.send("Sorry! Something went wrong. We'll look into "
+                             "it.")
+
     def connectionLost(self, reason):
         """
         Respond to a dropped connection by dropping reference to this protocol.
         """
+        LineTelnetProtocol.connectionLost(self, reason)
+        self.connected = False
+        self._held_lines.clear()
         if (isinstance(self.player, db.Player) and
                 self.factory.allProtocols[self.player.name] == self):
             # The second condition is important: if we're dropping this
@@ -137,18 +451,50 @@ class WorldFactory(protocol.Factory):
         # Maintain a list of all open connections.
         self.allProtocols = {}
 
+    def startFactory(self):
+        """
+        When starting the factory, start journaling changes to the database
+        and hashing passwords in the background, and load the command registry
+        so the first player to type something doesn't have to wait for it.
+        """
+        db.open_journal()
+        db.start_hash_pool()
+        handler.registry.load()
+
     def stopFactory(self):
         """
         When stopping the factory, save the database.
         """
         with locks.authority_of(locks.SYSTEM):
             db.backup()
+        db.close_journal()
+        db.stop_hash_pool()
 
     def sendToAll(self, line):
         """Send a line to every connected player."""
         for protocol in self.allProtocols.values():
             protocol.sendLine(line)
 
+    def outputStats(self):
+        """
+        Report on output waiting for slow clients, across all connected
+        players.
+
+        Returns:
+            A dict of the number of connections, how many of them have fallen
+            behind, and the total queued bytes, peak queued bytes, dropped
+            lines, and dropped bytes.
+        """
+        protocols = self.allProtocols.values()
+        return {
+            "connections": len(protocols),
+            "paused": sum(1 for p in protocols if p._paused),
+            "queued_bytes": sum(p.queuedBytes for p in protocols),
+            "peak_queued_bytes": sum(p.peakQueuedBytes for p in protocols),
+            "dropped_lines": sum(p.droppedLines for p in protocols),
+            "dropped_bytes": sum(p.droppedBytes for p in protocols),
+        }
+
 
 class LoginMode(handler.Mode):
     """
@@ -199,35 +545,45 @@ class LoginMode(handler.Mode):
             self.protocol.sendLine("Invalid login.")
             return
 
-        if player.hash(password) == player.password:
-            # Associate this protocol with this player, dropping any existing
-            # one.
-            if player.name in factory.allProtocols:
-                factory.allProtocols[player.name].transport.loseConnection()
-                reconnect = True
-            else:
-                reconnect = False
-            factory.allProtocols[player.name] = self.protocol
-            self.protocol.player = player
-
-            # Drop into normal mode
-            with locks.authority_of(player):
-                self.protocol.sendLine("Hello, {}!".format(player.name))
-                self.protocol.sendLine("")
-                from muss.commands.world import Look
-                # Exit LoginMode and enter NormalMode
-                player.enter_mode(handler.NormalMode())
-                Look().execute(player, {"obj": player.location})
-                if reconnect:
-                    player.emit("{} has reconnected.".format(player.name),
-                                exceptions=[player])
-                else:
-                    player.emit("{} has connected.".format(player.name),
-                                exceptions=[player])
-        else:
-            # Wrong password
+        d = player.check_password(password)
+        d.addCallback(locks.bind_authority(self.password_checked), player)
+        return d
+
+    def password_checked(self, correct, player):
+        """
+        Finish logging in, once we know whether the password was right.
+        """
+        if not correct:
             self.protocol.sendLine("Invalid login.")
             return
+        if not self.protocol.connected:
+            # They left while we were checking.
+            return
+
+        # Associate this protocol with this player, dropping any existing
+        # one.
+        if player.name in factory.allProtocols:
+            factory.allProtocols[player.name].transport.loseConnection()
+            reconnect = True
+        else:
+            reconnect = False
+        factory.allProtocols[player.name] = self.protocol
+        self.protocol.player = player
+
+        # Drop into normal mode
+        with locks.authority_of(player):
+            self.protocol.sendLine("Hello, {}!".format(player.name))
+            self.protocol.sendLine("")
+            from muss.commands.world import Look
+            # Exit LoginMode and enter NormalMode
+            player.enter_mode(handler.NormalMode())
+            Look().execute(player, {"obj": player.location})
+            if reconnect:
+                player.emit("{} has reconnected.".format(player.name),
+                            exceptions=[player])
+            else:
+                player.emit("{} has connected.".format(player.name),
+                            exceptions=[player])
 
 
 class AccountCreateMode(handler.Mode):
@@ -281,21 +637,39 @@ class AccountCreateMode(handler.Mode):
 
         elif self.stage == 'password2':
             if self.password == line:
-                player = db.Player(self.name, self.password)
-                self.protocol.player = player
-                db.store(player)
-                factory.allProtocols[player.name] = self.protocol
-                with locks.authority_of(player):
-                    player.enter_mode(handler.NormalMode())
-                    self.protocol.sendLine("Hello, {}!".format(player.name))
-                    self.protocol.sendLine("")
-                    from muss.commands.world import Look
-                    Look().execute(player, {"obj": player.location})
-                    player.emit("{} has connected for the first time."
-                                .format(player.name), exceptions=[player])
-                return
+                d = db.hash_password_in_thread(self.password)
+                d.addCallback(locks.bind_authority(self.password_hashed))
+                return d
             else:
                 self.protocol.sendLine("Passwords don't match; try again. "
                                        "Please enter a password.")
                 self.stage = 'password1'
                 return
+
+    def password_hashed(self, password_hash):
+        """
+        Create the new player, once the password is hashed.
+        """
+        del self.password
+        if not self.protocol.connected:
+            # They left while we were hashing.
+            return
+        if db.player_name_taken(self.name):
+            # Someone else took it in the meantime.
+            self.protocol.sendLine("Sorry, someone else just took that name. "
+                                   "What username would you like?")
+            self.stage = 'name'
+            return
+
+        player = db.Player(self.name, None, password_hash)
+        self.protocol.player = player
+        db.store(player)
+        factory.allProtocols[player.name] = self.protocol
+        with locks.authority_of(player):
+            player.enter_mode(handler.NormalMode())
+            self.protocol.sendLine("Hello, {}!".format(player.name))
+            self.protocol.sendLine("")
+            from muss.commands.world import Look
+            Look().execute(player, {"obj": player.location})
+            player.emit("{} has connected for the first time."
+                        .format(player.name), exceptions=[player])
@@ -1,3 +1,7 @@
+import mock
+
+from muss import db, handler, server, timing
+from muss.commands import social
 from muss.test import common_tools
 
 
@@ -10,3 +14,65 @@ class AdminTestCase(common_tools.MUSSTestCase):
                              "You don't have permission to set sudotest on x.")
         self.assert_response("sudo set x.sudotest=6",
                              "Set x's sudotest attribute to 6")
+
+    def test_rehash(self):
+        handler.registry.commands  # Make sure it's loaded before mocking load
+        self.patch(handler.registry, "load", mock.MagicMock())
+        self.assert_response("rehash", "You need sudo to reload commands.")
+        self.assertFalse(handler.registry.load.called)
+        self.assert_response("sudo rehash", startswith="Reloaded ")
+        handler.registry.load.assert_called_once_with(reload_modules=True)
+
+    def test_rehash_modes(self):
+        handler.registry.commands
+        self.patch(handler.registry, "load", mock.MagicMock())
+        self.player.send_line("say")
+        old_mode = self.player.mode
+        # Pretend social was reloaded: SayMode is now a new class.
+        attrs = dict((name, value)
+                     for name, value in vars(social.SayMode).items()
+                     if name not in ("__dict__", "__weakref__"))
+        self.patch(social, "SayMode",
+                   type("SayMode", social.SayMode.__bases__, attrs))
+        self.assertNotIsInstance(self.player.mode, social.SayMode)
+
+        # Everyone's modes are rebound, not just those of whoever rehashed.
+        with self.assert_max_scans(0):
+            self.neighbor.send_line("sudo rehash")
+        self.assertIs(self.player.mode, old_mode)
+        self.assertIsInstance(self.player.mode, social.SayMode)
+        self.assert_response("hello", '* You say, "hello"')
+        self.assert_response(".", "You are now in Normal Mode.")
+
+    def test_stats(self):
+        self.patch(timing, "ENABLED", True)
+        self.player.send_line("look")
+        self.assert_response("stats", "You need sudo to see server "
+                                      "statistics.")
+        self.patch(server, "factory", None)
+        self.player.send_line("sudo stats")
+        # Look and the unsudoed stats, in whichever order took longer.
+        responses = self.player.response_stack(3)
+        self.assertEqual(responses[0], "Command timings:")
+        self.assertEqual(sorted(r.split(":")[0] for r in responses[1:]),
+                         ["Look", "Stats"])
+
+        self.assert_response("sudo stats off", "Command timing is off.")
+        self.assertFalse(timing.ENABLED)
+        self.assert_response("sudo stats reset", "Command timings reset.")
+        self.assert_response("sudo stats", "No commands timed yet.")
+        self.assert_response("sudo stats on", "Command timing is on.")
+        self.assertTrue(timing.ENABLED)
+
+    def test_scans(self):
+        self.assert_response("scans", "You need sudo to see database scans.")
+        self.assert_response("sudo scans", "No scans yet.")
+        for _ in range(2):
+            db.find_all()
+        self.assert_response("sudo scans", startswith="muss/test/commands/"
+                                                      "test_admin.py:")
+        self.assertTrue(self.player.last_response().endswith(
+            " (test_scans): 2 calls, {} objects examined, {} returned"
+            .format(2 * len(db._objects), 2 * len(db._objects))))
+        self.assert_response("sudo scans reset", "Scan counts reset.")
+        self.assert_response("sudo scans", "No scans yet.")
@@ -1,6 +1,8 @@
+import contextlib
+
 import mock
 from twisted.trial import unittest
-from muss import db, handler, locks, parser, utils, equipment
+from muss import db, handler, locks, parser, utils, equipment, timing
 
 
 class PlayerMock(db.Player):
@@ -46,11 +48,22 @@ class MUSSTestCase(unittest.TestCase):
      * assert_response(string, response) -- asserts that the given command,
        if it were typed into the game by self.player, would produce the
        given response. (See the method definition for more options.)
+     * assert_max_scans(count) -- a context manager asserting that no more
+       than count find_all() or find() scans of the database happen inside it.
     """
 
     def setUp(self):
         self.patch(db, "_objects", {})
+        self.patch(db, "_contents", {})
+        self.patch(db, "_listeners", {})
+        self.patch(db, "_types", {})
+        self.patch(db, "_players_by_name", {})
         self.patch(db, "_nextUid", 0)
+        self.patch(parser, "_grammar_cache", {})
+        self.patch(timing, "_histograms", {})
+        self.patch(db, "_scan_counts", {})
+        # Real password hashes are slow on purpose.
+        self.patch(db, "PASSWORD_ROUNDS", 1)
         with locks.authority_of(locks.SYSTEM):
             self.lobby = db.Room("lobby")
         db.store(self.lobby)
@@ -150,3 +163,24 @@ class MUSSTestCase(unittest.TestCase):
             self.assertEqual(response[-len(endswith):], endswith)
         if contains:
             self.assertTrue(contains in response)
+
+    @contextlib.contextmanager
+    def assert_max_scans(self, count):
+        """
+        Assert that the code in this block scans the whole database with
+        find_all() or find() no more than count times, so that anything
+        meant to use an index keeps doing so.
+        """
+        before = db.scan_counts()
+        yield
+        total = 0
+        scans = []
+        for site, (calls, _, _) in sorted(db.scan_counts().items()):
+            calls -= before.get(site, (0, 0, 0))[0]
+            if calls:
+                total += calls
+                scans.append("{}:{} ({}) {} times".format(site[0], site[1],
+                                                         site[2], calls))
+        if total > count:
+            self.fail("{} database scans, expected at most {}: {}".format(
+                total, count, ", ".join(scans)))
@@ -1,6 +1,6 @@
 import pyparsing as pyp
 
-from muss import parser, utils
+from muss import db, locks, parser, utils
 from muss.test.parser import parser_tools
 
 
@@ -106,3 +106,30 @@ class ParserMiscTestCase(parser_tools.ParserTestCase):
         obj = self.objects["hat"]
         self.assert_parse(pattern, "hat on frog", obj)
         self.assert_parse(pattern, "#"+str(obj.uid), obj)
+
+    def test_args_for(self):
+        from muss.commands.world import Drop
+        grammar = Drop.args_for(self.player)
+        self.assertIs(Drop.args_for(self.player), grammar)
+        self.assertIsNot(Drop.args_for(self.neighbor), grammar)
+
+        # Something entering the player's inventory makes a new grammar.
+        frog = self.objects["frog"]
+        with locks.authority_of(locks.SYSTEM):
+            frog.location = self.player
+        grammar = Drop.args_for(self.player)
+        self.assert_parse(grammar, "frog", [frog])
+        self.assertIs(Drop.args_for(self.player), grammar)
+
+        # So does renaming it.
+        with locks.authority_of(locks.SYSTEM):
+            frog.name = "toad"
+        grammar = Drop.args_for(self.player)
+        self.assert_parse(grammar, "toad", [frog])
+
+        # Changes elsewhere don't.
+        with locks.authority_of(locks.SYSTEM):
+            elsewhere = db.Room("elsewhere")
+            db.store(elsewhere)
+            db.store(db.Object("ball", elsewhere))
+        self.assertIs(Drop.args_for(self.player), grammar)
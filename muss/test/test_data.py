@@ -109,6 +109,55 @@ class DataTestCase(common_tools.MUSSTestCase):
         self.assertNotIn(inside_containee, neighbors)
         self.assertEqual(len(neighbors), 4)
 
+    def test_emit_listeners(self):
+        with locks.authority_of(locks.SYSTEM):
+            room = db.Room("room")
+            db.store(room)
+            props = []
+            for i in range(50):
+                prop = db.Object("prop {}".format(i), location=room)
+                db.store(prop)
+                props.append(prop)
+            speaker = self.new_player("Speaker")
+            speaker.location = room
+            listener = self.new_player("Listener")
+            listener.location = room
+            bag = db.Container("bag", location=speaker)
+            db.store(bag)
+        for player in [speaker, listener, self.player]:
+            # Forget what they saw when they moved.
+            player.send.reset_mock()
+
+        # Only the players in the room are listeners.
+        self.assertEqual(db.listeners_in(room), set([speaker, listener]))
+        self.assertEqual(db.listeners_in(self.lobby),
+                         set([self.player, self.neighbor]))
+        with mock.patch.object(db.Object, "send") as prop_send:
+            # Patching Object.send makes every object a listener, but the
+            # index was built before that.
+            speaker.emit("Hello.", exceptions=[speaker])
+            self.assertEqual(prop_send.call_count, 0)
+        listener.send.assert_called_once_with("Hello.")
+        self.assertEqual(speaker.send.call_count, 0)
+        self.assertEqual(self.player.send.call_count, 0)
+
+        # Assigning send makes an object a listener, and deleting it doesn't.
+        with locks.authority_of(locks.SYSTEM):
+            props[0].send = mock.MagicMock()
+            bag.send = mock.MagicMock()
+        speaker.emit("Hello again.")
+        props[0].send.assert_called_once_with("Hello again.")
+        bag.send.assert_called_once_with("Hello again.")
+        with locks.authority_of(locks.SYSTEM):
+            del props[0].send
+        self.assertEqual(db.listeners_in(room), set([speaker, listener]))
+
+        # Listeners leave the index when they leave the room.
+        with locks.authority_of(locks.SYSTEM):
+            listener.location = self.lobby
+        self.assertEqual(db.listeners_in(room), set([speaker]))
+        self.assertIn(listener, db.listeners_in(self.lobby))
+
     def test_move_insert_remove(self):
         with locks.authority_of(locks.SYSTEM):
             hat = db.Object("hat")
@@ -271,3 +320,102 @@ class DataTestCase(common_tools.MUSSTestCase):
             self.assertTrue(hat.equipped)
             self.assertNotIn("hat", location.contents_string())
             self.assertIn("hat", location.equipment_string())
+
+    def test_contents_of(self):
+        with locks.authority_of(locks.SYSTEM):
+            box = db.Container("box")
+            bag = db.Container("bag")
+            ball = db.Object("ball", location=box)
+        db.store(box)
+        db.store(bag)
+        self.assertEqual(db.contents_of(box), set())
+        db.store(ball)
+        self.assertEqual(db.contents_of(box), set([ball]))
+
+        with locks.authority_of(locks.SYSTEM):
+            ball.location = bag
+        self.assertEqual(db.contents_of(box), set())
+        self.assertEqual(db.contents_of(bag), set([ball]))
+
+        db.delete(ball)
+        self.assertEqual(db.contents_of(bag), set())
+
+    def test_contents_of_matches_find_all(self):
+        self.setup_objects()
+        for location in [self.lobby, self.player, self.neighbor,
+                         self.objects["frog"]]:
+            self.assertEqual(db.contents_of(location),
+                             db.find_all(lambda x: x.location is location))
+
+    def test_objects_of_type(self):
+        with locks.authority_of(locks.SYSTEM):
+            room = db.Room("room")
+            thing = db.Object("thing")
+        db.store(room)
+        db.store(thing)
+        self.assertEqual(db.objects_of_type('room'), set([self.lobby, room]))
+        self.assertEqual(db.objects_of_type('player'),
+                         set([self.player, self.neighbor]))
+        self.assertIn(thing, db.objects_of_type('thing'))
+        db.delete(thing)
+        self.assertNotIn(thing, db.objects_of_type('thing'))
+
+    def test_objects_of_type_changed(self):
+        with locks.authority_of(locks.SYSTEM):
+            thing = db.Object("thing")
+        db.store(thing)
+        with locks.authority_of(locks.SYSTEM):
+            thing.type = 'player'
+        self.assertNotIn(thing, db.objects_of_type('thing'))
+        self.assertIn(thing, db.objects_of_type('player'))
+        self.assertIs(db.player_by_name("thing"), thing)
+        with locks.authority_of(locks.SYSTEM):
+            del thing.type
+        self.assertNotIn(thing, db.objects_of_type('player'))
+        self.assertFalse(db.player_name_taken("thing"))
+
+    def test_player_by_name(self):
+        self.assertIs(db.player_by_name("player"), self.player)
+        self.assertIs(db.player_by_name("Player", case_sensitive=True),
+                      self.player)
+        self.assertRaises(KeyError, db.player_by_name, "player",
+                          case_sensitive=True)
+        self.assertRaises(KeyError, db.player_by_name, "Play")
+        self.assertTrue(db.player_name_taken("PLAYER"))
+
+        with locks.authority_of(locks.SYSTEM):
+            self.player.name = "Renamed"
+        self.assertFalse(db.player_name_taken("Player"))
+        self.assertIs(db.player_by_name("renamed"), self.player)
+
+        db.delete(self.player)
+        self.assertFalse(db.player_name_taken("Renamed"))
+
+    def test_scan_counts(self):
+        objects = len(db._objects)
+        scans, examined = db.scan_totals()
+        db.find_all(lambda x: x.type == "player")
+        db.find(lambda x: x is self.lobby)
+        self.assertEqual(db.scan_totals(), (scans + 2, examined + 2 * objects))
+
+        counts = db.scan_counts()
+        self.assertEqual(len(counts), 2)
+        find_all_site, find_site = sorted(counts)
+        self.assertEqual(find_all_site[2], "test_scan_counts")
+        self.assertEqual(counts[find_all_site], (1, objects, 2))
+        self.assertEqual(counts[find_site], (1, objects, 1))
+        self.assertEqual(len(set(site[1] for site in counts)), 2)
+        for filename, _, _ in counts:
+            self.assertIn("test_data", filename)
+
+        db.reset_scan_counts()
+        self.assertEqual(db.scan_counts(), {})
+        self.assertEqual(db.scan_totals(), (scans + 2, examined + 2 * objects))
+
+    def test_assert_max_scans(self):
+        with self.assert_max_scans(1):
+            db.find_all()
+        with self.assertRaises(self.failureException):
+            with self.assert_max_scans(1):
+                db.find_all()
+                db.find_all()
@@ -1,4 +1,4 @@
-from muss import db, handler, locks, parser
+from muss import db, handler, locks, parser, utils
 from muss.test import common_tools
 
 
@@ -118,5 +118,55 @@ class HandlerTestCase(common_tools.MUSSTestCase):
         db.store(self.exit_zzzb)
         self.assert_response("zzz foo", "Spaaaaaaaaaaaaaace. (foo).")
 
+    def test_no_scans(self):
+        # Everyday commands find things through the database's indexes.
+        self.setup_objects()
+        with locks.authority_of(locks.SYSTEM):
+            foyer = db.Room("foyer")
+            exit = db.Exit("exit", self.lobby, foyer)
+            back = db.Exit("back", foyer, self.lobby)
+        for obj in foyer, exit, back:
+            db.store(obj)
+        with self.assert_max_scans(0):
+            for line in ["look", "look frog", "take ant", "drop ant",
+                         "inventory", "say hi", ":waves", "who", "exit",
+                         "back", "tell playersneighbor hi"]:
+                self.player.send_line(line)
+
     def test_re(self):
         self.assert_response("re", startswith="Which command do you mean")
+
+    def test_registry(self):
+        from muss.commands.social import Say
+        registry = handler.CommandRegistry()
+        self.assertIn(Say, registry.commands)
+        self.assertIn(("say", Say), registry.names)
+        self.assertIn(("'", Say), registry.nospace_names)
+        self.assertEqual(len(registry.commands), len(set(registry.commands)))
+        perfect, partial = registry.find_by_name("SAY")
+        self.assertEqual(perfect, [("say", Say)])
+        perfect, partial = registry.find_by_name("'", full_only=True)
+        self.assertEqual(perfect, [])
+
+    def test_name_trie(self):
+        class Named(object):
+            def __init__(self, name):
+                self.name = name
+
+        objects = [Named(n) for n in ["big blue cat", "blue", "bluebird",
+                                      "Cat", "cat o' nine tails", "a a"]]
+        trie = handler.NameTrie((obj.name, obj) for obj in objects)
+        for name in ["blue", "BLUE", "cat", "c", "blue c", "g blue", "", "a",
+                     "nine", "dog", "big blue cat"]:
+            expected = utils.find_by_name(name, objects)
+            found = trie.find(name)
+            self.assertEqual(set(found[0]), set(expected[0]))
+            self.assertEqual(set(found[1]), set(expected[1]))
+
+    def test_name_trie_prefixes(self):
+        trie = handler.NameTrie([("z", 1), ("zzz", 2), ("Z", 3), ("y", 4)],
+                                case_sensitive=True)
+        self.assertEqual(trie.find_prefixes("zzzap"),
+                         [("z", 1), ("zzz", 2)])
+        self.assertEqual(trie.find_prefixes("Zzz"), [("Z", 3)])
+        self.assertEqual(trie.find_prefixes("x"), [])
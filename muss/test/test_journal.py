@@ -0,0 +1,287 @@
+import os
+import pickle
+
+from twisted.trial import unittest
+
+from muss import db, locks
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = self.mktemp()
+        os.makedirs(directory)
+        self.patch(db, "DATABASE_FILE", os.path.join(directory, "muss.db"))
+        self.patch(db, "JOURNAL_FILE", os.path.join(directory, "muss.journal"))
+        self.patch(db, "_journal", None)
+        self.patch(db, "_generation", 0)
+        self.patch(db, "_journal_end", None)
+        self.patch(db, "_dirty", False)
+        self.patch(db, "_snapshot_in_progress", None)
+        self.patch(db, "last_snapshot_duration", None)
+        self.patch(db, "_snapshot_data", None)
+        self.patch(db, "_unloaded", {})
+        self.patch(db, "_snapshot_objects", {})
+        self.patch(db, "_objects", {})
+        self.patch(db, "_nextUid", 0)
+        self.patch(db, "_contents", {})
+        self.patch(db, "_listeners", {})
+        self.patch(db, "_types", {})
+        self.patch(db, "_players_by_name", {})
+        self.patch(db, "PASSWORD_ROUNDS", 1)
+        self.addCleanup(db.close_journal)
+
+        with locks.authority_of(locks.SYSTEM):
+            self.lobby = db.Room("lobby")
+        db.store(self.lobby)
+        self.player = db.Player("Player", "password")
+        db.store(self.player)
+        db.open_journal()
+
+    def restart(self):
+        """
+        Throw away the in-memory database and restore it from disk, as if the
+        server had crashed and come back up.
+        """
+        db.close_journal()
+        db._objects = {}
+        db._nextUid = 0
+        with locks.authority_of(locks.SYSTEM):
+            db.restore()
+
+    def test_open_takes_snapshot(self):
+        self.assertTrue(os.path.exists(db.DATABASE_FILE))
+        self.assertEqual(db._generation, 1)
+        self.restart()
+        self.assertEqual(sorted(db._objects), [0, 1])
+        self.assertEqual(db.get(1).name, "Player")
+        self.assertIs(db.get(1).location, db.get(0))
+        self.assertIs(db.get(0).owner, locks.SYSTEM)
+
+    def test_replay(self):
+        with locks.authority_of(self.player):
+            kitchen = db.Room("kitchen")
+            db.store(kitchen)
+            spoon = db.Object("spoon", location=kitchen)
+            db.store(spoon)
+            spoon.color = "silver"
+            spoon.name = "ladle"
+            spoon.lock_attr("color", get_lock=locks.Fail())
+            del spoon.description
+            self.player.location = kitchen
+            doomed = db.Object("doomed")
+            db.store(doomed)
+            doomed.destroy()
+
+        self.restart()
+        kitchen = db.get(kitchen.uid)
+        spoon = db.get(spoon.uid)
+        player = db.player_by_name("player")
+        self.assertEqual(db._nextUid, doomed.uid + 1)
+        self.assertRaises(KeyError, db.get, doomed.uid)
+        self.assertIs(spoon.location, kitchen)
+        self.assertIs(player.location, kitchen)
+        self.assertIs(spoon.owner, player)
+        self.assertEqual(db.contents_of(kitchen), set([spoon, player]))
+        self.assertEqual(spoon.name, "ladle")
+        self.assertFalse(hasattr(spoon, "description"))
+        with locks.authority_of(player):
+            self.assertRaises(locks.LockFailedError, getattr, spoon, "color")
+        with locks.authority_of(locks.SYSTEM):
+            self.assertEqual(spoon.color, "silver")
+            self.assertIs(spoon.attr_locks["color"].owner, player)
+
+    def test_damaged_tail(self):
+        with locks.authority_of(locks.SYSTEM):
+            self.lobby.description = "A nice lobby."
+        good_end = db._journal_end
+        with open(db.JOURNAL_FILE, "ab") as f:
+            f.write("\x80\x02(U\x04attr")
+        self.restart()
+        self.assertEqual(db.get(0).description, "A nice lobby.")
+        self.assertEqual(db._journal_end, good_end)
+
+        # Journaling picks up where the good records left off.
+        db.open_journal()
+        with locks.authority_of(locks.SYSTEM):
+            db.get(0).description = "A nicer lobby."
+        self.restart()
+        self.assertEqual(db.get(0).description, "A nicer lobby.")
+
+    def test_snapshot(self):
+        with locks.authority_of(locks.SYSTEM):
+            self.lobby.description = "Before the snapshot."
+        d = db.snapshot()
+        # The server carries on while the snapshot is written.
+        with locks.authority_of(locks.SYSTEM):
+            self.lobby.name = "foyer"
+
+        def check(_):
+            self.assertEqual(db._generation, 2)
+            self.assertIsNot(db.last_snapshot_duration, None)
+            # Only the change made during the snapshot is left in the journal.
+            with open(db.JOURNAL_FILE, "rb") as f:
+                self.assertEqual(pickle.load(f), ("generation", 2))
+            self.restart()
+            self.assertEqual(db.get(0).description, "Before the snapshot.")
+            self.assertEqual(db.get(0).name, "foyer")
+            os.remove(db.JOURNAL_FILE)
+            self.restart()
+            self.assertEqual(db.get(0).name, "lobby")
+        return d.addCallback(check)
+
+    def test_synced(self):
+        synced = []
+        self.patch(os, "fsync", synced.append)
+        with locks.authority_of(locks.SYSTEM):
+            self.lobby.description = "Synced."
+            db.backup()
+        # The new snapshot, and the new journal's generation marker.
+        self.assertEqual(len(synced), 2)
+        db._trim_journal(db._generation, db._journal_end)
+        self.assertEqual(len(synced), 3)
+
+    def test_snapshot_unchanged(self):
+        d = db.snapshot()
+        self.assertTrue(d.called)
+        self.assertEqual(db._generation, 1)
+
+    def test_snapshot_failed(self):
+        def fail(generation):
+            raise IOError("Disk full")
+        self.patch(db, "_write_snapshot", fail)
+        # Keep the child's traceback out of the test output.
+        self.patch(os, "write", lambda fd, data: len(data))
+        with locks.authority_of(locks.SYSTEM):
+            self.lobby.description = "Only in the journal."
+
+        def check(_):
+            self.assertTrue(db._dirty)
+            self.restart()
+            self.assertEqual(db.get(0).description, "Only in the journal.")
+            # The failed snapshot's generation isn't used again.
+            self.assertEqual(db._generation, 2)
+        return db.snapshot().addCallback(check)
+
+    def test_snapshot_interrupted(self):
+        # The snapshot was written, but we crashed before trimming the journal.
+        with locks.authority_of(locks.SYSTEM):
+            self.lobby.description = "Snapshotted."
+            db._generation += 1
+            db._journal_write(("generation", db._generation), None)
+            db._write_snapshot(db._generation)
+            self.lobby.name = "foyer"
+        self.restart()
+        self.assertEqual(db._generation, 2)
+        self.assertEqual(db.get(0).description, "Snapshotted.")
+        self.assertEqual(db.get(0).name, "foyer")
+        self.assertIsNot(db._journal_end, None)
+
+    def test_stale_journal_ignored(self):
+        with locks.authority_of(locks.SYSTEM):
+            self.lobby.description = "Journaled."
+        db.close_journal()
+        # Take a snapshot, but leave the old journal lying around.
+        with locks.authority_of(locks.SYSTEM):
+            self.lobby.description = "Snapshotted."
+            db.backup()
+        self.restart()
+        self.assertEqual(db.get(0).description, "Snapshotted.")
+
+    def test_lazy_restore(self):
+        with locks.authority_of(self.player):
+            kitchen = db.Room("kitchen")
+            db.store(kitchen)
+            spoon = db.Object("spoon", location=kitchen)
+            db.store(spoon)
+        with locks.authority_of(locks.SYSTEM):
+            db.backup()
+        self.restart()
+        self.assertEqual(len(db._unloaded), 4)
+
+        # The indexes are built without loading anything.
+        kitchen = db.get(kitchen.uid)
+        player = db.player_by_name("player")
+        self.assertEqual(db.objects_of_type("room"), set([db.get(0), kitchen]))
+        self.assertEqual(db.contents_of(db.get(0)), set([player]))
+        self.assertEqual(db.contents_of(kitchen), set([db.get(spoon.uid)]))
+        self.assertEqual(len(db._unloaded), 4)
+
+        # Objects load one at a time, as they're used.
+        spoon = db.get(spoon.uid)
+        self.assertEqual(spoon.name, "spoon")
+        self.assertEqual(len(db._unloaded), 3)
+        self.assertIs(spoon.location, kitchen)
+        self.assertIs(spoon.owner, player)
+        self.assertEqual(len(db._unloaded), 3)
+        self.assertEqual(kitchen.name, "kitchen")
+        self.assertEqual(len(db._unloaded), 2)
+
+        # Unloaded objects are written to the next snapshot as they were.
+        with locks.authority_of(locks.SYSTEM):
+            spoon.name = "ladle"
+            db.backup()
+        self.restart()
+        self.assertEqual(db.get(spoon.uid).name, "ladle")
+        with locks.authority_of(locks.SYSTEM):
+            self.assertEqual(db.player_by_name("player").password,
+                             self.player.password)
+
+    def test_lazy_deleted_reference(self):
+        with locks.authority_of(self.player):
+            spoon = db.Object("spoon")
+            db.store(spoon)
+        with locks.authority_of(locks.SYSTEM):
+            db.backup()
+        self.restart()
+        # The spoon still refers to its owner after the owner is gone.
+        with locks.authority_of(locks.SYSTEM):
+            db.delete(db.player_by_name("player"))
+        self.assertEqual(db.get(spoon.uid).owner.name, "Player")
+
+    def test_lazy_deleted_reference_snapshot(self):
+        with locks.authority_of(self.player):
+            spoon = db.Object("spoon")
+            db.store(spoon)
+        with locks.authority_of(locks.SYSTEM):
+            db.backup()
+        self.restart()
+        # Delete the owner while the spoon is still unloaded, and snapshot.
+        with locks.authority_of(locks.SYSTEM):
+            db.delete(db.player_by_name("player"))
+            db.backup()
+        self.restart()
+        spoon = db.get(spoon.uid)
+        self.assertEqual(spoon.name, "spoon")
+        self.assertEqual(spoon.owner.name, "Player")
+        # And it survives yet another snapshot.
+        with locks.authority_of(locks.SYSTEM):
+            db.backup()
+        self.restart()
+        self.assertEqual(db.get(spoon.uid).owner.name, "Player")
+
+    def test_lazy_deleted_in_journal(self):
+        with locks.authority_of(self.player):
+            spoon = db.Object("spoon")
+            db.store(spoon)
+        with locks.authority_of(locks.SYSTEM):
+            db.backup()
+            db.delete(self.player)
+        # The deletion is replayed from the journal, before anything's loaded.
+        self.restart()
+        with locks.authority_of(locks.SYSTEM):
+            db.backup()
+        self.restart()
+        self.assertEqual(db.get(spoon.uid).owner.name, "Player")
+
+    def test_materialize_failure_keeps_unloaded(self):
+        with locks.authority_of(locks.SYSTEM):
+            db.backup()
+        self.restart()
+        lobby = db._objects[0]
+
+        def fail(self, uid):
+            raise KeyError(uid)
+        self.patch(db._JournalUnpickler, "persistent_load", fail)
+        with locks.authority_of(locks.SYSTEM):
+            self.assertRaises(KeyError, db._materialize, lobby)
+        self.assertIn(lobby, db._unloaded)
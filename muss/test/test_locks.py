@@ -1,3 +1,9 @@
+import mock
+import pickle
+import threading
+
+from twisted.internet import defer
+
 from muss import db, locks
 from muss.test import common_tools
 
@@ -18,19 +24,19 @@ class LockTestCase(common_tools.MUSSTestCase):
             db.store(self.obj)
 
     def test_contextmanager(self):
-        self.assertIs(locks._authority, None)
+        self.assertIs(locks.authority(), None)
         with locks.authority_of(self.player):
-            self.assertIs(locks._authority, self.player)
-        self.assertIs(locks._authority, None)
+            self.assertIs(locks.authority(), self.player)
+        self.assertIs(locks.authority(), None)
 
     def test_contextmanager_nested(self):
-        self.assertIs(locks._authority, None)
+        self.assertIs(locks.authority(), None)
         with locks.authority_of(self.player):
-            self.assertIs(locks._authority, self.player)
+            self.assertIs(locks.authority(), self.player)
             with locks.authority_of(self.player2):
-                self.assertIs(locks._authority, self.player2)
-            self.assertIs(locks._authority, self.player)
-        self.assertIs(locks._authority, None)
+                self.assertIs(locks.authority(), self.player2)
+            self.assertIs(locks.authority(), self.player)
+        self.assertIs(locks.authority(), None)
 
     def test_get_authority(self):
         self.assertIs(locks.authority(), None)
@@ -38,6 +44,79 @@ class LockTestCase(common_tools.MUSSTestCase):
             self.assertIs(locks.authority(), self.player)
         self.assertIs(locks.authority(), None)
 
+    def make_players(self, count):
+        with locks.authority_of(locks.SYSTEM):
+            return [db.Player("Concurrent{}".format(i), "password")
+                    for i in range(count)]
+
+    def test_authority_per_thread(self):
+        players = self.make_players(20)
+        entered = threading.Semaphore(0)
+        go = threading.Event()
+        results = {}
+
+        def run(player):
+            with locks.authority_of(player):
+                entered.release()
+                # Hold every authority at once before checking any of them.
+                go.wait()
+                results[player] = (locks.authority(),
+                                   locks.Is(player)(),
+                                   locks.Is(self.player)())
+            results[player] += (locks.authority(),)
+
+        threads = [threading.Thread(target=run, args=(player,))
+                   for player in players]
+        with locks.authority_of(self.player):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                entered.acquire()
+            go.set()
+            for thread in threads:
+                thread.join()
+            self.assertIs(locks.authority(), self.player)
+
+        for player in players:
+            self.assertEqual(results[player], (player, True, False, None))
+        self.assertIs(locks.authority(), None)
+
+    def test_new_thread_has_no_authority(self):
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(locks.authority()))
+        with locks.authority_of(self.player):
+            thread.start()
+            thread.join()
+        self.assertEqual(results, [None])
+
+    def test_bind_authority(self):
+        players = self.make_players(20)
+        deferreds = []
+        results = []
+        for player in players:
+            d = defer.Deferred()
+            with locks.authority_of(player):
+                d.addCallback(locks.bind_authority(
+                    lambda _: results.append(locks.authority())))
+            deferreds.append(d)
+
+        # Fire them in a different order, from no authority at all.
+        for d in reversed(deferreds):
+            d.callback(None)
+        self.assertEqual(results, list(reversed(players)))
+        self.assertIs(locks.authority(), None)
+
+    def test_bind_authority_thread(self):
+        results = []
+        with locks.authority_of(self.player):
+            func = locks.bind_authority(
+                lambda: results.append(locks.authority()))
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [self.player])
+
     def test_pass(self):
         lock = locks.Pass()
         self.assertTrue(lock(self.player))
@@ -118,6 +197,123 @@ class LockTestCase(common_tools.MUSSTestCase):
         self.assertTrue(lock(self.player2))
 
 
+    def test_cached(self):
+        class CountingOwns(locks.Lock):
+            cacheable = True
+            check = mock.MagicMock(
+                side_effect=lambda player: self.obj.owner is player)
+        lock = CountingOwns()
+        self.assertTrue(lock(self.player))
+        self.assertTrue(lock(self.player))
+        self.assertFalse(lock(self.player2))
+        self.assertEqual(lock.check.call_count, 2)
+
+        with locks.authority_of(locks.SYSTEM):
+            self.obj.owner = self.player2
+        self.assertFalse(lock(self.player))
+        self.assertTrue(lock(self.player2))
+        self.assertEqual(lock.check.call_count, 4)
+
+    def test_cached_invalidated_during_check(self):
+        # While the lock is being checked, something changes and another lock
+        # is checked, as if on other threads, so the first result is already
+        # stale.
+        results = [False, True]
+        other = locks.Is(self.player)
+
+        class Racing(locks.Lock):
+            cacheable = True
+
+            def check(self, player):
+                result = results.pop(0)
+                if results:
+                    locks.invalidate()
+                    other(player)
+                return result
+        lock = Racing()
+        self.assertFalse(lock(self.player))
+        self.assertTrue(lock(self.player))
+        self.assertTrue(lock(self.player))
+        self.assertEqual(results, [])
+
+    def test_cached_invalidation(self):
+        with locks.authority_of(self.player):
+            key = db.Object("a key")
+            db.store(key)
+        has = locks.Has(key)
+        owns_attribute = locks.OwnsAttribute(self.obj, "new_attr")
+        self.assertFalse(has(self.player))
+        self.assertFalse(owns_attribute(self.player))
+
+        with locks.authority_of(self.player):
+            key.location = self.player
+            self.obj.new_attr = 0
+        self.assertTrue(has(self.player))
+        self.assertTrue(owns_attribute(self.player))
+
+        with locks.authority_of(locks.SYSTEM):
+            self.obj.attr_locks["new_attr"].owner = self.player2
+        self.assertFalse(owns_attribute(self.player))
+
+    def test_compiled(self):
+        key = db.Object("a key", owner=self.player)
+        lock = locks.Or(
+            locks.And(locks.Owns(self.obj), locks.Not(locks.Fail())),
+            locks.Has(key),
+            locks.In([self.player2]))
+        self.assertTrue(lock(self.player))
+        self.assertTrue(lock(self.player2))
+        self.assertIsNot(lock._compiled, None)
+        # Only the top-level lock switches authority.
+        with mock.patch.object(locks, "authority_of",
+                               wraps=locks.authority_of) as authority_of:
+            locks.invalidate()
+            lock(self.player)
+        self.assertEqual(authority_of.call_count, 1)
+
+    def test_compiled_not_pickled(self):
+        lock = locks.Not(locks.Is(self.player))
+        self.assertFalse(lock(self.player))
+        with locks.authority_of(locks.SYSTEM):
+            copy = pickle.loads(pickle.dumps(lock, pickle.HIGHEST_PROTOCOL))
+        self.assertFalse(hasattr(copy, "_compiled"))
+        self.assertFalse(copy(copy.lock.trustee))
+
+    def test_shared_constants(self):
+        self.assertIs(locks.Pass(), locks.Pass())
+        self.assertIs(locks.Fail(), locks.Fail())
+        self.assertIsNot(locks.Pass(), locks.Fail())
+        with locks.authority_of(locks.SYSTEM):
+            copy = pickle.loads(pickle.dumps(locks.Pass()))
+        self.assertIs(copy, locks.Pass())
+
+    def test_pickle_slots(self):
+        lock = locks.Or(locks.Is(self.player), locks.Owns(self.obj))
+        self.assertFalse(hasattr(lock, "__dict__"))
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            with locks.authority_of(locks.SYSTEM):
+                copy = pickle.loads(pickle.dumps(lock, protocol))
+            self.assertEqual(repr(copy), repr(lock))
+            self.assertTrue(copy.cacheable)
+            self.assertTrue(copy(copy.locks[0].trustee))
+
+    def test_unpickle_old_lock(self):
+        # Locks used to keep their attributes in a __dict__, and And, Or, and
+        # Not didn't have cacheable.
+        lock = locks.And.__new__(locks.And)
+        lock.__setstate__({"locks": (locks.Is(self.player),)})
+        self.assertTrue(lock.cacheable)
+        self.assertTrue(lock(self.player))
+
+    def test_not_cached(self):
+        trustees = set()
+        lock = locks.And(locks.Is(self.player), locks.In(trustees))
+        self.assertFalse(lock.cacheable)
+        self.assertFalse(lock(self.player))
+        trustees.add(self.player)
+        self.assertTrue(lock(self.player))
+
+
 class AttrLockTestCase(common_tools.MUSSTestCase):
     def setUp(self):
         super(AttrLockTestCase, self).setUp()
@@ -223,3 +419,62 @@ class AttrLockTestCase(common_tools.MUSSTestCase):
                 pass
             else:
                 self.fail("Expected LockFailedError when deleting attribute")
+
+    def test_unguarded(self):
+        with locks.authority_of(locks.SYSTEM):
+            lock = self.obj.attr_locks["attr"]
+        self.assertFalse(lock.unguarded)
+        lock.get_lock = locks.Pass()
+        self.assertTrue(lock.unguarded)
+        with locks.authority_of(self.setter):
+            self.assertEqual(self.get(), "value")
+        lock.get_lock = locks.Not(locks.Pass())
+        self.assertFalse(lock.unguarded)
+        with locks.authority_of(self.setter):
+            self.assertRaises(locks.LockFailedError, self.get)
+
+    def test_unpickle_old_attribute_lock(self):
+        # AttributeLocks used to keep get_lock as a plain attribute.
+        lock = locks.AttributeLock.__new__(locks.AttributeLock)
+        lock.__setstate__({"owner": self.attr_owner,
+                           "get_lock": locks.Is(self.getter),
+                           "set_lock": locks.Pass()})
+        self.assertIs(lock.get_lock.trustee, self.getter)
+        self.assertFalse(lock.unguarded)
+
+        lock.__setstate__({"owner": self.attr_owner,
+                           "_get_lock": locks.Pass(),
+                           "set_lock": locks.Is(self.setter),
+                           "unguarded": True})
+        self.assertTrue(lock.unguarded)
+        self.assertTrue(lock.may_set(self.setter))
+
+    def test_pickle_attribute_lock(self):
+        with locks.authority_of(locks.SYSTEM):
+            lock = self.obj.attr_locks["attr"]
+            copy = pickle.loads(pickle.dumps(lock, pickle.HIGHEST_PROTOCOL))
+        # Pickling copies the players too, so compare them by uid.
+        self.assertEqual(copy.owner.uid, self.attr_owner.uid)
+        self.assertEqual(copy.get_lock.trustee.uid, self.getter.uid)
+        self.assertEqual(copy.set_lock.trustee.uid, self.setter.uid)
+        self.assertFalse(copy.unguarded)
+
+    def test_default_set_lock(self):
+        with locks.authority_of(self.attr_owner):
+            self.obj.other_attr = "value"
+        with locks.authority_of(locks.SYSTEM):
+            lock = self.obj.attr_locks["other_attr"]
+        self.assertIs(lock.set_lock, None)
+        self.assertTrue(lock.may_set(self.attr_owner))
+        self.assertFalse(lock.may_set(self.setter))
+        self.assertTrue(lock.may_set(locks.SYSTEM))
+        self.assertRaises(locks.MissingAuthorityError, lock.may_set)
+
+        # The default follows the attribute's owner.
+        with locks.authority_of(locks.SYSTEM):
+            lock.owner = self.setter
+        with locks.authority_of(self.setter):
+            self.obj.other_attr = "new value"
+        with locks.authority_of(self.attr_owner):
+            with self.assertRaises(locks.LockFailedError):
+                self.obj.other_attr = "old value"
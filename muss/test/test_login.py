@@ -1,6 +1,11 @@
+import hashlib
+import threading
+
+import mock
+from twisted.internet import defer
 from twisted.test import proto_helpers
 
-from muss import server, db
+from muss import server, db, handler, locks
 from muss.test import common_tools
 
 
@@ -124,3 +129,223 @@ class LoginTestCase(common_tools.MUSSTestCase):
 
         self.proto.dataReceived("quit\r\n")
         self.assertTrue(player.connected)
+
+    def test_login_coalesced(self):
+        self.proto.dataReceived("new\r\nname\r\npass\r\npass\r\n")
+        self.new_connection()
+        self.tr.clear()
+        self.tr.write = mock.MagicMock(side_effect=self.tr.write)
+        self.tr.writeSequence = mock.MagicMock(
+            side_effect=self.tr.writeSequence)
+
+        # The greeting, the room description, and so on all go out together.
+        self.assert_response("name pass\r\n", startswith="Hello, name!\r\n\r\n")
+        self.assertEqual(self.tr.write.call_count, 0)
+        self.assertEqual(self.tr.writeSequence.call_count, 1)
+
+    def hold_hashing(self):
+        """
+        Make password hashing wait until the test fires it, and return a list
+        of (function, args, Deferred) for each hash asked for.
+        """
+        pending = []
+
+        def in_hash_pool(func, *args):
+            d = defer.Deferred()
+            pending.append((func, args, d))
+            return d
+        self.patch(db, "_in_hash_pool", in_hash_pool)
+        return pending
+
+    def test_login_waits_for_password(self):
+        self.proto.dataReceived("new\r\nname\r\npass\r\npass\r\n")
+        self.new_connection()
+        self.tr.clear()
+        pending = self.hold_hashing()
+
+        # Nothing after the login line is handled until the password has
+        # been checked.
+        self.proto.dataReceived("name pass\r\nsay hello world\r\n")
+        self.assertEqual(self.tr.value(), "")
+        self.assertEqual(len(pending), 1)
+
+        func, args, d = pending[0]
+        d.callback(func(*args))
+        response = self.tr.value()
+        self.assertTrue(response.startswith("Hello, name!\r\n\r\n"))
+        self.assertIn('You say, "hello world"\r\n', response)
+
+    def test_login_bad_password_waits(self):
+        self.proto.dataReceived("new\r\nname\r\npass\r\npass\r\n")
+        self.new_connection()
+        self.tr.clear()
+        pending = self.hold_hashing()
+
+        self.proto.dataReceived("name wrongpass\r\nname pass\r\n")
+        self.assertEqual(len(pending), 1)
+        func, args, d = pending.pop()
+        d.callback(func(*args))
+        # The second attempt starts only after the first fails.
+        self.assertEqual(self.tr.value(), "Invalid login.\r\n")
+        self.assertEqual(len(pending), 1)
+
+    def test_disconnect_while_checking(self):
+        self.proto.dataReceived("new\r\nname\r\npass\r\npass\r\n")
+        self.proto.connectionLost(reason=None)
+        self.new_connection()
+        pending = self.hold_hashing()
+
+        self.proto.dataReceived("name pass\r\n")
+        self.proto.connectionLost(reason=None)
+        func, args, d = pending[0]
+        d.callback(func(*args))
+        self.assertNotIn("name", self.factory.allProtocols)
+        self.assertFalse(db.player_by_name("name").connected)
+
+    def test_create_name_taken_while_hashing(self):
+        pending = self.hold_hashing()
+        self.proto.dataReceived("new\r\nname\r\npass\r\npass\r\n")
+        self.tr.clear()
+
+        self.new_player("name")
+        func, args, d = pending[0]
+        d.callback(func(*args))
+        self.assertEqual(self.tr.value(),
+                         "Sorry, someone else just took that name. What "
+                         "username would you like?\r\n")
+
+    def test_hash_pool(self):
+        threads = []
+
+        def verify_password(*args):
+            threads.append(threading.current_thread())
+            return original(*args)
+        original = db.verify_password
+        self.patch(db, "verify_password", verify_password)
+        self.patch(db, "HASH_THREADS", 2)
+        db.start_hash_pool()
+        self.addCleanup(db.stop_hash_pool)
+
+        d = self.player.check_password("password")
+
+        def check(correct):
+            self.assertTrue(correct)
+            self.assertEqual(len(threads), 1)
+            self.assertIsNot(threads[0], threading.current_thread())
+        return d.addCallback(check)
+
+    def test_hash_pool_disabled(self):
+        self.patch(db, "HASH_THREADS", 0)
+        db.start_hash_pool()
+        self.assertIs(db._hash_pool, None)
+        results = []
+        self.player.check_password("wrong").addCallback(results.append)
+        self.assertEqual(results, [False])
+
+    def test_salted(self):
+        first = db.hash_password("password")
+        second = db.hash_password("password")
+        self.assertNotEqual(first, second)
+        self.assertEqual(first.split("$")[:2], ["pbkdf2_sha256", "1"])
+        self.assertEqual(db.verify_password("Player", "password", first),
+                         (True, False))
+        self.assertEqual(db.verify_password("Player", "wrong", first),
+                         (False, False))
+
+    def check_password(self, player, password):
+        results = []
+        player.check_password(password).addCallback(results.append)
+        return results[0]
+
+    def test_rehash_old_hash(self):
+        # Hashes used to be unsalted SHA-512 of the name and password.
+        old_hash = hashlib.sha512("Player" + "password").hexdigest()
+        with locks.authority_of(locks.SYSTEM):
+            self.player.password = old_hash
+
+        self.assertFalse(self.check_password(self.player, "wrong"))
+        self.assertEqual(self.player.password, old_hash)
+        self.assertTrue(self.check_password(self.player, "password"))
+        self.assertTrue(self.player.password.startswith("pbkdf2_sha256$1$"))
+        self.assertTrue(self.check_password(self.player, "password"))
+
+    def test_rehash_new_rounds(self):
+        old_hash = self.player.password
+        self.patch(db, "PASSWORD_ROUNDS", 2)
+        self.assertTrue(self.check_password(self.player, "password"))
+        self.assertNotEqual(self.player.password, old_hash)
+        self.assertTrue(self.player.password.startswith("pbkdf2_sha256$2$"))
+
+        self.patch(db, "PASSWORD_SCHEME", "pbkdf2_sha512")
+        self.assertTrue(self.check_password(self.player, "password"))
+        self.assertTrue(self.player.password.startswith("pbkdf2_sha512$2$"))
+
+    def test_rehash_changed_meanwhile(self):
+        pending = self.hold_hashing()
+        self.patch(db, "PASSWORD_ROUNDS", 2)
+        results = []
+        self.player.check_password("password").addCallback(results.append)
+        with locks.authority_of(locks.SYSTEM):
+            self.player.password = db.hash_password("new password")
+        changed = self.player.password
+
+        func, args, d = pending[0]
+        d.callback(func(*args))
+        self.assertEqual(results, [True])
+        self.assertEqual(self.player.password, changed)
+
+    def slow_lines(self):
+        return [call[0][0] for call in server.log.msg.call_args_list
+                if call[0][0].startswith("Slow line")]
+
+    def test_slow_line(self):
+        self.patch(server.log, "msg", mock.MagicMock())
+        self.proto.SLOW_LINE = 0
+        self.proto.dataReceived("Player password\r\n")
+        # Login lines may hold passwords, so they're never logged.
+        [message] = self.slow_lines()
+        self.assertTrue(message.startswith("Slow line from a new connection "
+                                           "in LoginMode: "), message)
+        self.assertNotIn("password", message)
+
+        from muss.commands import world
+        self.patch(world.Look, "execute",
+                   lambda self, player, args: db.find_all())
+        objects = len(db._objects)
+        self.proto.dataReceived("look\r\n")
+        message = self.slow_lines()[-1]
+        self.assertTrue(message.startswith("Slow line from Player in "
+                                           "NormalMode: "), message)
+        self.assertIn("; line 'look'; command Look; phases nospace ", message)
+        self.assertTrue(message.endswith("; 1 find_all scans of {} objects"
+                                         .format(objects)), message)
+
+    def test_fast_line(self):
+        self.patch(server.log, "msg", mock.MagicMock())
+        self.proto.SLOW_LINE = 60
+        self.proto.dataReceived("Player password\r\nlook\r\n")
+        self.assertEqual(self.slow_lines(), [])
+
+    def test_paused_while_checking(self):
+        pending = self.hold_hashing()
+        self.proto.dataReceived("Player password\r\n")
+        self.assertEqual(self.tr.producerState, "paused")
+        func, args, d = pending[0]
+        d.callback(func(*args))
+        self.assertEqual(self.tr.producerState, "producing")
+
+    def test_disconnect_during_prompt(self):
+        self.proto.dataReceived("Player password\r\n")
+        self.patch(server.log, "err", mock.MagicMock())
+        waiting = defer.Deferred()
+        d = handler.prompt(self.player, "Really?")
+        d.addCallback(lambda line: waiting)
+
+        self.proto.dataReceived("yes\r\nlook\r\n")
+        self.assertEqual(self.tr.producerState, "paused")
+        self.proto.connectionLost(reason=None)
+        self.assertEqual(self.player.mode_stack, [])
+        self.tr.clear()
+        waiting.callback(None)
+        self.assertEqual(self.tr.value(), "")
+        self.assertFalse(server.log.err.called)
@@ -1,4 +1,5 @@
 import mock
+from twisted.test import proto_helpers
 from twisted.trial import unittest
 
 from muss import server
@@ -42,3 +43,169 @@ class NetworkTestCase(unittest.TestCase):
         calls = [mock.call("one"), mock.call("two")]
         self.proto.lineReceived.assert_has_calls(calls)
         self.assertEqual(self.proto.lineReceived.call_count, 2)
+
+    def test_send(self):
+        tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(tr)
+        self.proto.sendLine("one")
+        self.assertEqual(tr.value(), "one\r\n")
+
+    def test_coalesced(self):
+        tr = proto_helpers.StringTransport()
+        tr.writeSequence = mock.MagicMock(side_effect=tr.writeSequence)
+        self.proto.makeConnection(tr)
+        with server.coalesced_output():
+            self.proto.sendLine("one")
+            with server.coalesced_output():
+                self.proto.sendLine("two")
+            self.assertEqual(tr.value(), "")
+        self.assertEqual(tr.value(), "one\r\ntwo\r\n")
+        tr.writeSequence.assert_called_once_with(["one\r\n", "two\r\n"])
+
+    def test_delimiters(self):
+        self.proto.dataReceived("one\ntwo\r\0three\r\n")
+        calls = [mock.call("one"), mock.call("two"), mock.call("three")]
+        self.assertEqual(self.proto.lineReceived.call_args_list, calls)
+
+    def test_split_delimiter(self):
+        self.proto.dataReceived("one\r")
+        self.assertEqual(self.proto.lineReceived.call_count, 0)
+        self.proto.dataReceived("\ntwo\r")
+        self.proto.lineReceived.assert_called_once_with("one")
+        self.proto.dataReceived("\0")
+        calls = [mock.call("one"), mock.call("two")]
+        self.assertEqual(self.proto.lineReceived.call_args_list, calls)
+
+    def test_trickle(self):
+        for char in "one\r\ntwo\r\n":
+            self.proto.dataReceived(char)
+        calls = [mock.call("one"), mock.call("two")]
+        self.assertEqual(self.proto.lineReceived.call_args_list, calls)
+
+    def test_too_long(self):
+        self.proto.MAX_LENGTH = 5
+        self.proto.lineLengthExceeded = mock.MagicMock()
+        self.proto.dataReceived("12345\r\n123456\r\n")
+        self.proto.lineReceived.assert_called_once_with("12345")
+        self.assertEqual(self.proto.lineLengthExceeded.call_count, 1)
+
+    def test_too_long_incomplete(self):
+        self.proto.MAX_LENGTH = 5
+        self.proto.lineLengthExceeded = mock.MagicMock()
+        self.proto.dataReceived("123")
+        self.proto.dataReceived("456")
+        # The overlong line isn't kept around.
+        self.assertEqual(self.proto._pieces, [])
+        self.proto.dataReceived("789\r\none\r\n")
+        self.assertEqual(self.proto.lineLengthExceeded.call_count, 1)
+        self.proto.lineReceived.assert_called_once_with("one")
+
+    def test_registered_producer(self):
+        tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(tr)
+        self.assertIs(tr.producer, self.proto)
+        self.assertTrue(tr.streaming)
+
+    def test_paused(self):
+        tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(tr)
+        self.proto.pauseProducing()
+        self.proto.sendLine("one")
+        with server.coalesced_output():
+            self.proto.sendLine("two")
+        self.assertEqual(tr.value(), "")
+        self.assertEqual(self.proto.queuedBytes, 10)
+        self.proto.resumeProducing()
+        self.assertEqual(tr.value(), "one\r\ntwo\r\n")
+        self.assertEqual(self.proto.queuedBytes, 0)
+        self.assertEqual(self.proto.peakQueuedBytes, 10)
+        self.proto.sendLine("three")
+        self.assertEqual(tr.value(), "one\r\ntwo\r\nthree\r\n")
+
+    def test_overflow_drop_oldest(self):
+        tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(tr)
+        self.proto.HIGH_WATER = 12
+        self.proto.pauseProducing()
+        for line in ["one", "two", "three"]:
+            self.proto.sendLine(line)
+        self.assertEqual(list(self.proto._queue), ["two\r\n", "three\r\n"])
+        self.assertEqual(self.proto.queuedBytes, 12)
+        self.assertEqual(self.proto.droppedLines, 1)
+        self.assertEqual(self.proto.droppedBytes, 5)
+        self.proto.resumeProducing()
+        self.assertEqual(tr.value(),
+                         "[1 line of output was dropped because it "
+                         "couldn't be sent fast enough.]\r\ntwo\r\nthree\r\n")
+
+    def test_overflow_drop_noncritical(self):
+        tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(tr)
+        self.proto.OVERFLOW_POLICY = server.DROP_NONCRITICAL
+        with server.noncritical_output():
+            self.proto.sendLine("chatter")
+        self.proto.pauseProducing()
+        with server.noncritical_output():
+            self.proto.sendLine("more chatter")
+        self.proto.sendLine("important")
+        self.assertEqual(list(self.proto._queue), ["important\r\n"])
+        self.assertEqual(self.proto.droppedLines, 1)
+        self.proto.resumeProducing()
+        self.assertTrue(tr.value().startswith("chatter\r\n[1 line of"))
+        self.assertTrue(tr.value().endswith("]\r\nimportant\r\n"))
+
+    def test_overflow_disconnect(self):
+        tr = proto_helpers.StringTransport()
+        tr.abortConnection = mock.MagicMock()
+        self.proto.makeConnection(tr)
+        self.proto.OVERFLOW_POLICY = server.DISCONNECT
+        self.proto.HIGH_WATER = 8
+        self.proto.pauseProducing()
+        self.proto.sendLine("one")
+        self.assertEqual(tr.abortConnection.call_count, 0)
+        self.proto.sendLine("two")
+        self.assertEqual(tr.abortConnection.call_count, 1)
+        self.assertEqual(self.proto.queuedBytes, 0)
+        self.assertEqual(tr.value(), "")
+        self.assertIs(tr.producer, None)
+
+        # Anything sent while the connection goes down is ignored.
+        self.proto.sendLine("three")
+        self.assertEqual(tr.abortConnection.call_count, 1)
+        self.assertEqual(self.proto.queuedBytes, 0)
+        self.assertEqual(self.proto.droppedLines, 0)
+
+    def test_overflow_notice_once(self):
+        tr = proto_helpers.StringTransport()
+        tr.writeSequence = mock.MagicMock()
+        self.proto.makeConnection(tr)
+        self.proto.HIGH_WATER = 7
+        self.proto.pauseProducing()
+        for line in ["one", "two"]:
+            self.proto.sendLine(line)
+        self.proto.resumeProducing()
+        self.assertTrue(tr.writeSequence.call_args[0][0][0].startswith(
+            "[1 line of output was dropped"))
+        self.proto.pauseProducing()
+        self.proto.sendLine("three")
+        self.proto.resumeProducing()
+        self.assertEqual(tr.writeSequence.call_args[0][0], ["three\r\n"])
+
+    def test_overflow_plural(self):
+        tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(tr)
+        self.proto.HIGH_WATER = 7
+        self.proto.pauseProducing()
+        for line in ["one", "two", "three"]:
+            self.proto.sendLine(line)
+        self.proto.resumeProducing()
+        self.assertEqual(tr.value(),
+                         "[2 lines of output were dropped because they "
+                         "couldn't be sent fast enough.]\r\nthree\r\n")
+
+    def test_connection_lost(self):
+        tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(tr)
+        self.proto.connectionLost(None)
+        self.assertIs(tr.producer, None)
+        self.proto.stopProducing()
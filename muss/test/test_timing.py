@@ -0,0 +1,74 @@
+import itertools
+
+from muss import db, locks, timing
+from muss.test import common_tools
+
+
+class TimingTestCase(common_tools.MUSSTestCase):
+    def test_histogram(self):
+        histogram = timing.Histogram()
+        for microseconds in range(1, 101):
+            histogram.add(microseconds / 1e6)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.mean(), 50.5e-6)
+        self.assertEqual(histogram.max, 100e-6)
+        # 50us is in the 32-63us bucket; 99us in 64-127us, capped at the max.
+        self.assertEqual(histogram.percentile(0.5), 64e-6)
+        self.assertEqual(histogram.percentile(0.99), 100e-6)
+
+    def test_empty_histogram(self):
+        histogram = timing.Histogram()
+        self.assertEqual(histogram.mean(), 0.0)
+        self.assertEqual(histogram.percentile(0.5), 0.0)
+
+    def test_line_timer(self):
+        self.patch(timing, "_clock", itertools.count().next)
+        timer = timing.LineTimer("nospace")  # 0
+        timer.enter("name")  # 1
+        timer.enter("args")  # 2
+        timer.enter("name")  # 3
+        timer.finish()  # 4
+        self.assertEqual(timer.phases, {"nospace": 1, "name": 2, "args": 1})
+        self.assertEqual(timer.total, 4)
+        histograms = timing._histograms[timing.UNRESOLVED]
+        self.assertEqual(histograms["total"].count, 1)
+        self.assertEqual(histograms["name"].total, 2)
+
+    def test_phases(self):
+        self.player.send_line("look")
+        histograms = timing._histograms["Look"]
+        self.assertEqual(histograms["total"].count, 1)
+        self.assertEqual(set(histograms), set(["total", "nospace", "name",
+                                               "args", "execute"]))
+
+    def test_exit_phase(self):
+        with locks.authority_of(locks.SYSTEM):
+            foyer = db.Room("foyer")
+            exit = db.Exit("exit", self.lobby, foyer)
+        db.store(foyer)
+        db.store(exit)
+        self.player.send_line("exit")
+        self.assertIn("exits", timing._histograms["Go"])
+
+    def test_unresolved(self):
+        self.player.send_line("xyzzy")
+        self.player.send_line("   ")
+        histograms = timing._histograms[timing.UNRESOLVED]
+        self.assertEqual(histograms["total"].count, 1)
+        self.assertNotIn("execute", histograms)
+
+    def test_disabled(self):
+        self.patch(timing, "ENABLED", False)
+        self.player.send_line("look")
+        self.assertEqual(timing._histograms, {})
+
+    def test_summary(self):
+        self.player.send_line("look")
+        self.player.send_line("look")
+        self.player.send_line("xyzzy")
+        lines = timing.summary()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("Look: 2 lines, ") or
+                        lines[1].startswith("Look: 2 lines, "))
+        timing.reset()
+        self.assertEqual(timing.summary(), [])
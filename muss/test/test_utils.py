@@ -1,3 +1,7 @@
+import collections
+import textwrap
+
+import mock
 from twisted.trial import unittest
 
 from muss import utils
@@ -20,3 +24,49 @@ class UtilsTestCase(unittest.TestCase):
     def test_comma_and_four(self):
         self.assertEqual(utils.comma_and(["one", "two", "three", "four"]),
                          "one, two, three, and four")
+
+    def patch_wrap_cache(self, size):
+        self.patch(utils, "_wrap_cache", collections.OrderedDict())
+        self.patch(utils, "WRAP_CACHE_SIZE", size)
+
+    def test_wrap(self):
+        self.patch_wrap_cache(10)
+        wrapper = textwrap.TextWrapper(width=10)
+        text = "one two three four\n\nfive six"
+        self.assertEqual(utils.wrap(wrapper, text),
+                         ("one two", "three four", "", "five six"))
+        self.assertEqual(utils.wrap(wrapper, text),
+                         ("one two", "three four", "", "five six"))
+
+    def test_wrap_once_per_width(self):
+        self.patch_wrap_cache(10)
+        wrappers = ([textwrap.TextWrapper() for i in range(50)] +
+                    [textwrap.TextWrapper(width=20) for i in range(50)])
+        text = "The quick brown fox jumps over the lazy dog. " * 5
+        with mock.patch.object(textwrap.TextWrapper, "wrap",
+                               autospec=True,
+                               side_effect=textwrap.TextWrapper.wrap) as wrap:
+            results = set(utils.wrap(wrapper, text) for wrapper in wrappers)
+        self.assertEqual(wrap.call_count, 2)
+        self.assertEqual(len(results), 2)
+
+    def test_wrap_evicts_least_recent(self):
+        self.patch_wrap_cache(2)
+        wrapper = textwrap.TextWrapper()
+        utils.wrap(wrapper, "one")
+        utils.wrap(wrapper, "two")
+        utils.wrap(wrapper, "one")
+        utils.wrap(wrapper, "three")
+        self.assertEqual(list(utils._wrap_cache),
+                         [(70, "one"), (70, "three")])
+
+    def test_wrap_other_options(self):
+        self.patch_wrap_cache(10)
+        wrapper = textwrap.TextWrapper(width=10, initial_indent="> ")
+        self.assertEqual(utils.wrap(wrapper, "one two three"),
+                         ("> one two", "three"))
+        self.assertEqual(len(utils._wrap_cache), 0)
+        # Not to be confused with the same width and text without the indent.
+        self.assertEqual(utils.wrap(textwrap.TextWrapper(width=10),
+                                    "one two three"),
+                         ("one two", "three"))
@@ -0,0 +1,215 @@
+import collections
+import contextlib
+import timeit
+
+from twisted.python import log
+
+
+# Whether NormalMode times the phases of each line it handles. Timing a line
+# costs about ten microseconds; not timing it costs one attribute lookup.
+ENABLED = True
+
+# Seconds between dumps of the timing summary to the log.
+LOG_INTERVAL = 600
+
+# The phases of handling a line, in the order NormalMode goes through them:
+# looking for nospace commands, matching the first word to a command name,
+# falling back on exit names, choosing between ambiguous commands, parsing the
+# command's arguments, and executing it.
+PHASES = ["nospace", "name", "exits", "ambiguity", "args", "execute"]
+
+# What lines that never resolved to a command are counted under.
+UNRESOLVED = "(unresolved)"
+
+_clock = timeit.default_timer
+
+
+class Histogram(object):
+    """
+    A record of durations, in buckets by powers of two microseconds, so that
+    adding one is cheap and percentiles are accurate to within a factor of
+    two.
+
+    Attributes:
+        count: How many durations have been added.
+        total: Their sum, in seconds.
+        max: The longest, in seconds.
+        buckets: buckets[i] counts the durations from 2**(i - 1) up to 2**i
+            microseconds (and buckets[0] those under one microsecond).
+    """
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * 32
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1e6).bit_length(), 31)] += 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """
+        Return the upper bound, in seconds, of the bucket holding the given
+        fraction of durations, but no more than the longest duration.
+        """
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** i / 1e6, self.max)
+        return self.max
+
+
+# Mapping from command names (or UNRESOLVED) to dicts mapping each phase, and
+# "total", to a Histogram.
+_histograms = {}
+
+# While capture() is active, a list of the LineTimers finished.
+_captured = None
+
+
+class LineTimer(object):
+    """
+    Times the phases of handling a single line. Time counts toward one phase
+    at a time, from when it's entered until the next phase is entered or the
+    timer finishes.
+
+    Attributes:
+        command: The command class the line resolved to, if any.
+        phases: A dict mapping each phase entered to the seconds spent in it.
+        total: Seconds from the timer's creation until it finished.
+    """
+
+    __slots__ = ("command", "phases", "total", "_phase", "_start", "_last")
+
+    def __init__(self, phase):
+        self.command = None
+        self.phases = {}
+        self.total = None
+        self._phase = phase
+        self._start = self._last = _clock()
+
+    def enter(self, phase):
+        now = _clock()
+        self.phases[self._phase] = (self.phases.get(self._phase, 0.0) +
+                                    now - self._last)
+        self._phase = phase
+        self._last = now
+
+    def finish(self):
+        """
+        Close the current phase and add this line's timings to its command's
+        histograms.
+        """
+        self.enter(None)
+        self.total = self._last - self._start
+        name = self.command_name()
+        try:
+            histograms = _histograms[name]
+        except KeyError:
+            histograms = collections.defaultdict(Histogram)
+            _histograms[name] = histograms
+        histograms["total"].add(self.total)
+        for phase, seconds in self.phases.items():
+            histograms[phase].add(seconds)
+        if _captured is not None:
+            _captured.append(self)
+
+    def command_name(self):
+        if self.command is None:
+            return UNRESOLVED
+        return self.command.__name__
+
+    def breakdown(self):
+        """
+        Describe the time spent in each phase, in milliseconds.
+        """
+        return ", ".join("{} {}".format(phase, _ms(self.phases[phase]))
+                         for phase in PHASES if phase in self.phases)
+
+
+def start_line(phase):
+    """
+    Start timing a line, in the given phase, if timing is enabled.
+
+    Returns:
+        A LineTimer, or None.
+    """
+    if ENABLED:
+        return LineTimer(phase)
+    return None
+
+
+@contextlib.contextmanager
+def capture():
+    """
+    Collect the LineTimer of every line finished within this block (including
+    lines handled on behalf of other lines, as sudo does), in the order they
+    finish.
+
+    Yields:
+        The list they're collected in.
+    """
+    global _captured
+    outer, _captured = _captured, []
+    try:
+        yield _captured
+    finally:
+        if outer is not None:
+            outer.extend(_captured)
+        _captured = outer
+
+
+def reset():
+    """
+    Forget everything recorded so far.
+    """
+    _histograms.clear()
+
+
+def _ms(seconds):
+    return "{:.2f}".format(seconds * 1e3)
+
+
+def summary():
+    """
+    Describe the timings recorded so far, one line per command, busiest
+    command first: how many lines it handled, the percentiles and maximum of
+    their total time, and the mean time in each phase, all in milliseconds.
+
+    Returns:
+        A list of strings.
+    """
+    rows = sorted(_histograms.items(), key=lambda item: -item[1]["total"].total)
+    lines = []
+    for name, histograms in rows:
+        total = histograms["total"]
+        phases = ", ".join("{} {}".format(phase, _ms(histograms[phase].mean()))
+                           for phase in PHASES if phase in histograms)
+        lines.append("{}: {} lines, {} s; mean {}, p50 {}, p99 {}, max {} ms "
+                     "({})".format(name, total.count,
+                                   "{:.3f}".format(total.total),
+                                   _ms(total.mean()),
+                                   _ms(total.percentile(0.5)),
+                                   _ms(total.percentile(0.99)),
+                                   _ms(total.max), phases))
+    return lines
+
+
+def log_summary():
+    """
+    Write the summary to the log, if there's anything in it.
+    """
+    lines = summary()
+    if lines:
+        log.msg("Command timings:\n" + "\n".join(lines))
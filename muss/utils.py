@@ -1,3 +1,7 @@
+import collections
+import textwrap
+
+
 class UserError(Exception):
     def __init__(self, string=""):
         if string:
@@ -14,9 +18,18 @@ def find_one(name, objects, attributes=["name"], case_sensitive=False):
     exactly one and no perfect match. Otherwise, it raises an AmbiguityError or
     NotFoundError.
     """
-    from muss.parser import AmbiguityError, NotFoundError
     perfect_matches, partial_matches = find_by_name(name, objects, attributes,
                                                     case_sensitive)
+    return best_match(name, perfect_matches, partial_matches)
+
+
+def best_match(name, perfect_matches, partial_matches):
+    """
+    Given lists of perfect and partial (name, object) matches for a name, as
+    returned by find_by_name, return the best single match or raise an
+    AmbiguityError or NotFoundError as find_one does.
+    """
+    from muss.parser import AmbiguityError, NotFoundError
     perfect_matches = set(perfect_matches)
     partial_matches = set(partial_matches)
     if len(perfect_matches) == 1:
@@ -111,3 +124,50 @@ def comma_and(strings):
         return "{} and {}".format(strings[0], strings[1])
     else:
         return ", ".join(strings[:-1]) + ", and " + strings[-1]
+
+
+# Wrapped text is remembered, keyed by the wrapping width and the text, since
+# the same line usually goes to everyone in a room or on a channel at once.
+# Once WRAP_CACHE_SIZE are remembered, the least recently used is forgotten.
+WRAP_CACHE_SIZE = 1024
+_wrap_cache = collections.OrderedDict()
+# The options of a default TextWrapper, besides width. Only text wrapped with
+# these is remembered.
+_DEFAULT_WRAP_OPTIONS = [
+    (option, getattr(textwrap.TextWrapper(), option))
+    for option in ["initial_indent", "subsequent_indent", "expand_tabs",
+                   "replace_whitespace", "fix_sentence_endings",
+                   "break_long_words", "drop_whitespace", "break_on_hyphens"]]
+
+
+def wrap(wrapper, text):
+    """
+    Wrap text using the given textwrap.TextWrapper, first splitting it at
+    newlines and keeping any blank lines (which TextWrapper would drop).
+
+    Returns:
+        A tuple of the wrapped lines.
+    """
+    for option, default in _DEFAULT_WRAP_OPTIONS:
+        if getattr(wrapper, option) != default:
+            return _wrap(wrapper, text)
+
+    key = (wrapper.width, text)
+    try:
+        lines = _wrap_cache.pop(key)
+    except KeyError:
+        lines = _wrap(wrapper, text)
+        if len(_wrap_cache) >= WRAP_CACHE_SIZE:
+            _wrap_cache.popitem(last=False)
+    _wrap_cache[key] = lines
+    return lines
+
+
+def _wrap(wrapper, text):
+    wrapped = []
+    for line in text.split("\n"):
+        if line:
+            wrapped.extend(wrapper.wrap(line))
+        else:  # TextWrapper strips blank lines, so let's preserve them
+            wrapped.append("")
+    return tuple(wrapped)